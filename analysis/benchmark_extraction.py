@@ -0,0 +1,292 @@
+######################################
+
+# This script benchmarks the extraction of the study definitions (the main
+# study definition, the all waves and wave definitions, the flowchart
+# definition and the ethnicity definition) with the TPP backend of cohortextractor, the backend
+# used in the secure environment:
+# - always: the backend generates the SQL of every variable (as before an
+#   extraction); per variable the number of queries (temporary tables,
+#   codelist uploads and indexes) and the size of the SQL are recorded. They
+#   do not depend on the machine, so a changed variable that adds queries or
+#   a bigger codelist shows up on any machine
+# - if the environment variable DATABASE_URL points at a TPP database (e.g. a
+#   seeded MSSQL container, see the cohortextractor documentation), the
+#   queries are also run against it; per variable the time the database
+#   spends on its queries is recorded, and the wall time of the final join
+#   (including fetching the rows); for the whole run the number of patients
+#   (the population size of the database, e.g. a database seeded with 1e5,
+#   1e6 or 1e7 patients), the wall time and the peak resident set size (every
+#   study definition is benchmarked in a separate process)
+# The results are written to output/benchmarks/extraction.json and compared
+# with the baselines in analysis/extraction_baselines.json; a measure of a
+# study definition or a variable that is more than TOLERANCE bigger (or
+# slower) than its baseline is reported as a regression (exit code 1).
+# Study definitions, variables and measures without a baseline are not
+# compared; new variables are listed with their measures. The baselines
+# committed in the repo are the generated SQL only (database timings and
+# memory are machine specific: --write-baselines with DATABASE_URL adds them
+# locally).
+# usage:
+# python analysis/benchmark_extraction.py [study_definition ...]
+# python analysis/benchmark_extraction.py --write-baselines [study_definition ...]
+# (default: all study definitions in STUDY_DEFINITIONS)
+
+######################################
+
+# IMPORT STATEMENTS ----
+import importlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from cohortextractor.tpp_backend import TPPBackend
+
+BASELINES_FILE = Path(__file__).parent / "extraction_baselines.json"
+RESULTS_FILE = Path("output/benchmarks/extraction.json")
+STUDY_DEFINITIONS = (
+    "study_definition",
+    "study_definition_ethnicity",
+    "study_definition_all_waves",
+    "study_definition_wave1",
+    "study_definition_wave2",
+    "study_definition_wave3",
+    "study_definition_wave4",
+    "study_definition_wave5",
+    "study_definition_flowchart",
+)
+# (used to generate the SQL if there is no database)
+DUMMY_DATABASE_URL = "mssql://localhost/dummy"
+# relative increase that counts as a regression
+TOLERANCE = 0.25
+# timings smaller than this (in seconds) are not compared (noise)
+MIN_SECONDS = 0.05
+# measures of a study definition and of a variable; the measures ending in
+# '_seconds' are timings
+STUDY_MEASURES = (
+    "queries",
+    "sql_chars",
+    "database_seconds",
+    "output_seconds",
+    "wall_seconds",
+    "peak_rss_mb",
+)
+VARIABLE_MEASURES = ("queries", "sql_chars", "database_seconds")
+
+
+# --- SQL ---
+def variable_queries(backend, covariate_definitions):
+    """
+    Generate the queries of covariate_definitions with backend; return
+    (dict variable -> queries of the variables with a table query, final
+    join query)
+    """
+    generated = []
+    get_queries_for_column = backend.get_queries_for_column
+
+    def recorded(column_name, *args):
+        sql_list = get_queries_for_column(column_name, *args)
+        generated.append((column_name, len(sql_list)))
+        return sql_list
+
+    backend.get_queries_for_column = recorded
+    try:
+        queries = backend.get_queries(covariate_definitions)
+    finally:
+        del backend.get_queries_for_column
+    variables = {}
+    position = 0
+    for name, n_queries in generated:
+        # (get_queries() adds an index query to the queries of every table)
+        variables[name] = queries[position:position + n_queries + 1]
+        position += n_queries + 1
+    return variables, queries[-1]
+
+
+def run_queries(backend, variables, join_query):
+    """
+    Run the queries of every variable and the final join on the database of
+    backend; return (dict variable -> seconds, seconds of the join, number
+    of patients)
+    """
+    cursor = backend.get_db_connection().cursor()
+    database_seconds = {}
+    for name, queries in variables.items():
+        start = time.perf_counter()
+        for query in queries:
+            cursor.execute(query, log_desc=f"Benchmark {name}")
+        database_seconds[name] = time.perf_counter() - start
+    start = time.perf_counter()
+    cursor.execute(join_query, log_desc="Benchmark join")
+    patients = sum(1 for _ in cursor)
+    return database_seconds, time.perf_counter() - start, patients
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB (ru_maxrss is in kB on
+    Linux)
+    """
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+# --- BENCHMARK ---
+def benchmark(study_definition, database_url=None):
+    """
+    Return the measurements of study_definition: the generated SQL and, if
+    database_url is given, the time the database spends on it
+    """
+    start = time.perf_counter()
+    study = importlib.import_module(study_definition).study
+    backend = TPPBackend(
+        database_url or DUMMY_DATABASE_URL, {}, dummy_data=not database_url
+    )
+    variables, join_query = variable_queries(backend, study.covariate_definitions)
+    result = {
+        "study_definition": study_definition,
+        "variables": {
+            name: {
+                "queries": len(queries),
+                "sql_chars": sum(len(query) for query in queries),
+            }
+            for name, queries in variables.items()
+        },
+    }
+    if database_url:
+        database_seconds, output_seconds, patients = run_queries(
+            backend, variables, join_query
+        )
+        backend.close()
+        for name, seconds in database_seconds.items():
+            result["variables"][name]["database_seconds"] = round(seconds, 3)
+        result["output_seconds"] = round(output_seconds, 3)
+        result["patients"] = patients
+    for measure in VARIABLE_MEASURES:
+        values = [
+            variable[measure]
+            for variable in result["variables"].values()
+            if measure in variable
+        ]
+        if values:
+            result[measure] = round(sum(values), 3)
+    result["queries"] += 1
+    result["sql_chars"] += len(join_query)
+    if database_url:
+        result["wall_seconds"] = round(time.perf_counter() - start, 3)
+        result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def benchmark_in_process(study_definition, database_url=None):
+    """
+    Run benchmark() in a new process, so its peak resident set size is the
+    peak of this study definition only
+    """
+    with ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return executor.submit(benchmark, study_definition, database_url).result()
+
+
+# --- BASELINES ---
+def load_baselines(baselines_file=BASELINES_FILE):
+    if not Path(baselines_file).exists():
+        return {}
+    with open(baselines_file, "r") as f:
+        return json.load(f)
+
+
+def write_results(results, output_file, previous=None):
+    """
+    Write results (added to the previous results, if given) as json
+    """
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    results = {
+        **(previous or {}),
+        **{result["study_definition"]: result for result in results},
+    }
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+
+
+def is_regression(measure, value, baseline):
+    if measure.endswith("_seconds") and value < MIN_SECONDS:
+        return False
+    return value > baseline * (1 + TOLERANCE)
+
+
+def compare_measures(key, values, baseline, measures):
+    return [
+        f"{key}: {measure} {values[measure]} (baseline {baseline[measure]})"
+        for measure in measures
+        if measure in values
+        and measure in baseline
+        and is_regression(measure, values[measure], baseline[measure])
+    ]
+
+
+def compare(results, baselines):
+    """
+    Return list of messages describing the regressions of results (only
+    measures with a baseline are compared)
+    """
+    regressions = []
+    for result in results:
+        key = result["study_definition"]
+        baseline = baselines.get(key)
+        if baseline is None:
+            continue
+        regressions.extend(compare_measures(key, result, baseline, STUDY_MEASURES))
+        for name, values in result["variables"].items():
+            regressions.extend(
+                compare_measures(
+                    f"{key}: {name}",
+                    values,
+                    baseline["variables"].get(name, {}),
+                    VARIABLE_MEASURES,
+                )
+            )
+    return regressions
+
+
+def new_variables(results, baselines):
+    """
+    Return list of messages describing the variables of results without a
+    baseline (of the study definitions with a baseline)
+    """
+    return [
+        f"{result['study_definition']}: new variable {name} "
+        + ", ".join(f"{measure} {value}" for measure, value in values.items())
+        for result in results
+        if result["study_definition"] in baselines
+        for name, values in result["variables"].items()
+        if name not in baselines[result["study_definition"]]["variables"]
+    ]
+
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    write_baselines = "--write-baselines" in arguments
+    study_definitions = [a for a in arguments if a != "--write-baselines"]
+    database_url = os.environ.get("DATABASE_URL")
+    results = [
+        benchmark_in_process(study_definition, database_url)
+        for study_definition in study_definitions or STUDY_DEFINITIONS
+    ]
+    write_results(results, RESULTS_FILE)
+    if write_baselines:
+        write_results(results, BASELINES_FILE, previous=load_baselines())
+    else:
+        baselines = load_baselines()
+        for message in new_variables(results, baselines):
+            print(message)
+        regressions = compare(results, baselines)
+        for regression in regressions:
+            print(regression)
+        sys.exit(1 if regressions else 0)
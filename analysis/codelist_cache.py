@@ -0,0 +1,250 @@
+######################################
+
+# Compiled cache of the codelists in the codelists folder.
+# Parsing the csv files in codelists/ is repeated by every study definition
+# (and every index date). Here all codelists are compiled into one binary
+# bundle (codelists/.cache/codelists.pickle) that is read once per process.
+# - An entry of a csv is valid as long as the sha of the csv in
+#   codelists/codelists.json (and the size and modification time of the csv)
+#   are unchanged; otherwise the csv is parsed again and the bundle rewritten
+# - Codes and categories are interned: every distinct code/category string is
+#   stored once and a codelist is an array of integer ids into those tables;
+#   codes no longer used by any codelist (e.g. after a csv changed) are
+#   dropped from the tables when the bundle is saved
+# - Relative codelist file names are relative to the root of the repo (as
+#   the actions run from there), not to the working directory
+
+######################################
+
+# IMPORT STATEMENTS ----
+import atexit
+import csv
+import json
+import os
+import pickle
+from array import array
+from pathlib import Path
+
+from cohortextractor import codelist
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+CODELISTS_DIR = REPO_DIR / "codelists"
+CODELISTS_JSON = CODELISTS_DIR / "codelists.json"
+CACHE_FILE = CODELISTS_DIR / ".cache" / "codelists.pickle"
+# bump when the layout of the bundle changes
+BUNDLE_VERSION = 1
+
+
+class CompiledCodelist:
+    """
+    Codelist as arrays of integer ids into the code (and category) tables of
+    the bundle
+    """
+
+    def __init__(self, code_ids, category_ids, codes, categories):
+        self.code_ids = code_ids
+        self.category_ids = category_ids
+        self.codes = codes
+        self.categories = categories
+        self._code_id_set = None
+
+    def __len__(self):
+        return len(self.code_ids)
+
+    @property
+    def has_categories(self):
+        return self.category_ids is not None
+
+    def contains_id(self, code_id):
+        if self._code_id_set is None:
+            self._code_id_set = frozenset(self.code_ids)
+        return code_id in self._code_id_set
+
+    def to_codes(self):
+        """
+        Return codes as strings (or (code, category) tuples)
+        """
+        if self.category_ids is None:
+            return [self.codes[i] for i in self.code_ids]
+        return [
+            (self.codes[i], self.categories[j])
+            for i, j in zip(self.code_ids, self.category_ids)
+        ]
+
+
+class CodelistBundle:
+    """
+    All compiled codelists, loaded from and saved to CACHE_FILE
+    """
+
+    def __init__(self, cache_file=CACHE_FILE, codelists_json=CODELISTS_JSON):
+        self.cache_file = Path(cache_file)
+        self.codelists_json = Path(codelists_json)
+        self.dirty = False
+        self.shas = self.read_shas()
+        data = self.read_cache()
+        self.codes = data["codes"]
+        self.categories = data["categories"]
+        # file name -> (sha, size, mtime_ns) the entries were compiled from
+        self.files = data["files"]
+        # (file name, column, category_column) -> (code ids, category ids)
+        self.entries = data["entries"]
+        self.code_index = {code: i for i, code in enumerate(self.codes)}
+        self.category_index = {
+            category: i for i, category in enumerate(self.categories)
+        }
+
+    def read_shas(self):
+        try:
+            with open(self.codelists_json, "r") as f:
+                files = json.load(f)["files"]
+        except (OSError, ValueError, KeyError):
+            return {}
+        return {name: info.get("sha") for name, info in files.items()}
+
+    def read_cache(self):
+        empty = {"codes": [], "categories": [], "files": {}, "entries": {}}
+        try:
+            with open(self.cache_file, "rb") as f:
+                data = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return empty
+        if data.get("version") != BUNDLE_VERSION:
+            return empty
+        return data
+
+    def file_key(self, path):
+        stat = os.stat(path)
+        return (self.shas.get(path.name), stat.st_size, stat.st_mtime_ns)
+
+    def intern(self, value, table, index):
+        try:
+            return index[value]
+        except KeyError:
+            index[value] = len(table)
+            table.append(value)
+            return index[value]
+
+    def compile(self, path, column, category_column):
+        """
+        Parse a csv in the same way as cohortextractor's codelist_from_csv()
+        """
+        code_ids = array("I")
+        category_ids = array("I") if category_column else None
+        with open(path, "r") as f:
+            for row in csv.DictReader(f):
+                code = row[column].strip()
+                # Ignore blanks
+                if not code:
+                    continue
+                code_ids.append(self.intern(code, self.codes, self.code_index))
+                if category_column:
+                    category_ids.append(
+                        self.intern(
+                            row[category_column].strip(),
+                            self.categories,
+                            self.category_index,
+                        )
+                    )
+        return code_ids, category_ids
+
+    def get(self, filename, column="code", category_column=None):
+        """
+        Return the CompiledCodelist of a csv, compiling it if it is not in
+        the bundle or if the csv changed
+        """
+        path = Path(filename)
+        if not path.is_absolute():
+            path = REPO_DIR / path
+        key = (path.name, column, category_column)
+        file_key = self.file_key(path)
+        if self.files.get(path.name) != file_key:
+            # csv changed: drop all entries compiled from the old version
+            self.entries = {k: v for k, v in self.entries.items() if k[0] != path.name}
+            self.files[path.name] = file_key
+        if key not in self.entries:
+            self.entries[key] = self.compile(path, column, category_column)
+            self.dirty = True
+        code_ids, category_ids = self.entries[key]
+        return CompiledCodelist(code_ids, category_ids, self.codes, self.categories)
+
+    def compact(self):
+        """
+        Drop the codes and categories that are not used by any entry (the
+        ids of the entries are renumbered)
+        """
+        code_map = {}
+        category_map = {}
+        codes = []
+        categories = []
+        entries = {}
+        for key, (code_ids, category_ids) in self.entries.items():
+            code_ids = array(
+                "I", (self.intern(self.codes[i], codes, code_map) for i in code_ids)
+            )
+            if category_ids is not None:
+                category_ids = array(
+                    "I",
+                    (
+                        self.intern(self.categories[i], categories, category_map)
+                        for i in category_ids
+                    ),
+                )
+            entries[key] = (code_ids, category_ids)
+        self.codes = codes
+        self.categories = categories
+        self.entries = entries
+        self.code_index = code_map
+        self.category_index = category_map
+
+    def save(self):
+        """
+        Write the bundle (atomically) if anything was compiled
+        """
+        if not self.dirty:
+            return
+        self.compact()
+        data = {
+            "version": BUNDLE_VERSION,
+            "codes": self.codes,
+            "categories": self.categories,
+            "files": self.files,
+            "entries": self.entries,
+        }
+        tmp_file = self.cache_file.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_file, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self.cache_file)
+        except OSError:
+            # e.g. read only file system: the bundle is only a cache
+            return
+        self.dirty = False
+
+
+_bundle = None
+
+
+def get_bundle():
+    """
+    Return the bundle of this process (loaded on first use)
+    """
+    global _bundle
+    if _bundle is None:
+        _bundle = CodelistBundle()
+        atexit.register(_bundle.save)
+    return _bundle
+
+
+def compiled_codelist(filename, column="code", category_column=None):
+    return get_bundle().get(filename, column, category_column)
+
+
+def codelist_from_cache(filename, system, column="code", category_column=None):
+    """
+    Drop-in replacement of cohortextractor's codelist_from_csv() reading the
+    codelist from the compiled bundle
+    """
+    compiled = compiled_codelist(filename, column, category_column)
+    return codelist(compiled.to_codes(), system)
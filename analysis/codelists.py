@@ -4,6 +4,11 @@
 # conditions or numerical values available on a patient's records.
 # This script fetches all of the codelists identified in codelists.txt from
 # OpenCodelists.
+# The csv files are read via the compiled codelist cache (see
+# codelist_cache.py), so they are only parsed again when they change.
+# Codelists from csv files are loaded lazily: a csv is only read when its
+# codelist is first used (e.g. 'from codelists import ethnicity_codes' only
+# reads the ethnicity codelist).
 
 ######################################
 
@@ -11,13 +16,47 @@
 # Import code building blocks from cohort extractor package
 from cohortextractor import (
     codelist,
-    codelist_from_csv,
 )
 
+from codelist_cache import codelist_from_cache
+
+# --- LAZY LOADING ---
+# name of codelist -> arguments of codelist_from_cache()
+csv_codelists = {}
+
+
+def csv_codelist(name, filename, system, column="code", category_column=None):
+    """
+    Register a codelist that is read from a csv file on first use
+    """
+    csv_codelists[name] = dict(
+        filename=filename,
+        system=system,
+        column=column,
+        category_column=category_column,
+    )
+
+
+def __getattr__(name):
+    # only called for names that are not (yet) in the module namespace
+    try:
+        arguments = csv_codelists[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = codelist_from_cache(**arguments)
+    # memoise, so __getattr__ is not called again for this name
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(csv_codelists))
+
 # --- CODELISTS ---
 # DEMOGRAPHICS
 # Ethnicity
-ethnicity_codes = codelist_from_csv(
+csv_codelist(
+    "ethnicity_codes",
     "codelists/opensafely-ethnicity.csv",
     system="ctv3",
     column="Code",
@@ -25,7 +64,8 @@ ethnicity_codes = codelist_from_csv(
 )
 
 # Smoking
-clear_smoking_codes = codelist_from_csv(
+csv_codelist(
+    "clear_smoking_codes",
     "codelists/opensafely-smoking-clear.csv",
     system="ctv3",
     column="CTV3Code",
@@ -34,21 +74,24 @@ clear_smoking_codes = codelist_from_csv(
 
 # COMORBIDITIES
 # Hypertension diagnosis
-hypertension_codes = codelist_from_csv(
+csv_codelist(
+    "hypertension_codes",
     "codelists/opensafely-hypertension.csv",
     system="ctv3",
     column="CTV3ID",
 )
 
 # Chronic respiratory disease diagnosis
-chronic_respiratory_disease_codes = codelist_from_csv(
+csv_codelist(
+    "chronic_respiratory_disease_codes",
     "codelists/opensafely-chronic-respiratory-disease.csv",
     system="ctv3",
     column="CTV3ID",
 )
 
 # Asthma diagnosis
-asthma_codes = codelist_from_csv(
+csv_codelist(
+    "asthma_codes",
     "codelists/opensafely-asthma-diagnosis.csv",
     system="ctv3",
     column="CTV3ID",
@@ -64,21 +107,24 @@ diastolic_blood_pressure_codes = codelist(
 
 # Presence of a prescription for a course of prednisolone (likely to be related
 # to poor asthma control)
-pred_codes = codelist_from_csv(
+csv_codelist(
+    "pred_codes",
     "codelists/opensafely-asthma-oral-prednisolone-medication.csv",
     system="snomed",
     column="snomed_id",
 )
 
 # Chronic cardiac disease diagnosis
-chronic_cardiac_disease_codes = codelist_from_csv(
+csv_codelist(
+    "chronic_cardiac_disease_codes",
     "codelists/opensafely-chronic-cardiac-disease.csv",
     system="ctv3",
     column="CTV3ID",
 )
 
 # Diabetes diagnosis
-diabetes_codes = codelist_from_csv(
+csv_codelist(
+    "diabetes_codes",
     "codelists/opensafely-diabetes.csv",
     system="ctv3",
     column="CTV3ID",
@@ -86,7 +132,8 @@ diabetes_codes = codelist_from_csv(
 
 # Measures of hba1c
 # 'new' codes: hba1c in mmol/mol
-hba1c_new_codes = codelist_from_csv(
+csv_codelist(
+    "hba1c_new_codes",
     "codelists/opensafely-glycated-haemoglobin-hba1c-tests-ifcc.csv",
     system="ctv3",
     column="code",
@@ -96,33 +143,38 @@ hba1c_new_codes = codelist_from_csv(
 hba1c_old_codes = codelist(["X772q", "XaERo", "XaERp"], system="ctv3")
 
 # Cancer diagnosis
-haem_cancer_codes = codelist_from_csv(
+csv_codelist(
+    "haem_cancer_codes",
     "codelists/opensafely-haematological-cancer.csv",
     system="ctv3",
     column="CTV3ID",
 )
 
-lung_cancer_codes = codelist_from_csv(
+csv_codelist(
+    "lung_cancer_codes",
     "codelists/opensafely-lung-cancer.csv",
     system="ctv3",
     column="CTV3ID",
 )
 
-other_cancer_codes = codelist_from_csv(
+csv_codelist(
+    "other_cancer_codes",
     "codelists/opensafely-cancer-excluding-lung-and-haematological.csv",
     system="ctv3",
     column="CTV3ID",
 )
 
 # Dialysis
-dialysis_codes = codelist_from_csv(
+csv_codelist(
+  "dialysis_codes",
   "codelists/opensafely-dialysis.csv",
   system="ctv3",
   column="CTV3ID",
 )
 
 # Kidney transplant
-kidney_transplant_codes = codelist_from_csv(
+csv_codelist(
+  "kidney_transplant_codes",
   "codelists/opensafely-kidney-transplant.csv",
   system="ctv3",
   column="CTV3ID",
@@ -132,80 +184,92 @@ kidney_transplant_codes = codelist_from_csv(
 creatinine_codes = codelist(["XE2q5"], system="ctv3")
 
 # Chronic liver disease diagnosis
-chronic_liver_disease_codes = codelist_from_csv(
+csv_codelist(
+    "chronic_liver_disease_codes",
     "codelists/opensafely-chronic-liver-disease.csv",
     system="ctv3",
     column="CTV3ID",
 )
 
 # Stroke
-stroke = codelist_from_csv(
+csv_codelist(
+    "stroke",
     "codelists/opensafely-stroke-updated.csv",
     system="ctv3",
     column="CTV3ID",
 )
 
 # Dementia diagnosis
-dementia = codelist_from_csv(
+csv_codelist(
+    "dementia",
     "codelists/opensafely-dementia.csv",
     system="ctv3",
     column="CTV3ID",
 )
 
 # Other neurolgoical conditions
-other_neuro = codelist_from_csv(
+csv_codelist(
+    "other_neuro",
     "codelists/opensafely-other-neurological-conditions.csv",
     system="ctv3",
     column="CTV3ID",
 )
 
 # Presence of organ transplant (excluding kidney transplants)
-other_organ_transplant_codes = codelist_from_csv(
+csv_codelist(
+    "other_organ_transplant_codes",
     "codelists/opensafely-other-organ-transplant.csv",
     system="ctv3",
     column="CTV3ID",
 )
 
 # Asplenia or dysplenia (acquired or congenital) diagnosis
-spleen_codes = codelist_from_csv(
+csv_codelist(
+    "spleen_codes",
     "codelists/opensafely-asplenia.csv",
     system="ctv3",
     column="CTV3ID",
 )
 
 # Sickle cell disease diagnosis
-sickle_cell_codes = codelist_from_csv(
+csv_codelist(
+    "sickle_cell_codes",
     "codelists/opensafely-sickle-cell-disease.csv",
     system="ctv3",
     column="CTV3ID",
 )
 # Rheumatoid/Lupus/Psoriasis diagnosis
-ra_sle_psoriasis_codes = codelist_from_csv(
+csv_codelist(
+    "ra_sle_psoriasis_codes",
     "codelists/opensafely-ra-sle-psoriasis.csv",
     system="ctv3",
     column="CTV3ID",
 )
 
 # Immunosuppressive condition
-immunosupression_diagnosis_codes = codelist_from_csv(
+csv_codelist(
+    "immunosupression_diagnosis_codes",
     "codelists/primis-covid19-vacc-uptake-immdx_cov.csv",
     system="snomed",
     column="code",
 )
-immunosuppression_medication_codes = codelist_from_csv(
+csv_codelist(
+    "immunosuppression_medication_codes",
     "codelists/primis-covid19-vacc-uptake-immrx.csv",
     system="snomed",
     column="code",
 )
 # Learning disabilities
-learning_disability_codes = codelist_from_csv(
+csv_codelist(
+  "learning_disability_codes",
   "codelists/nhsd-primary-care-domain-refsets-ld_cod.csv",
   system="snomed",
   column="code",
 )
 
 # Severe mental illness
-sev_mental_ill_codes = codelist_from_csv(
+csv_codelist(
+  "sev_mental_ill_codes",
   "codelists/primis-covid19-vacc-uptake-sev_mental.csv",
   system="snomed",
   column="code",
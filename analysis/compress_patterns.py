@@ -0,0 +1,155 @@
+######################################
+
+# This script compresses the processed data of a wave into the covariate
+# patterns of the Cox models of analysis/utils/model_coxph.R, with frequency
+# weights: for every subgroup the patients are collapsed into the unique
+# combinations of the columns of its model (subgroup, age, sex, stp, fu and
+# status; agegroup is not adjusted for age and sex not for sex) and the number
+# of patients with that combination (column 'n'). A model fitted on the
+# patterns with frequency weights, e.g.
+#   coxph(Surv(fu, status == '1') ~ subgroup + rcs(age, 4) + sex + strata(stp),
+#         data = patterns, weights = n, ties = "breslow")
+# has the same partial likelihood as the model fitted on the patients (with
+# the default Efron approximation of ties the estimates can differ slightly),
+# and its fitting time and memory scale with the number of patterns instead
+# of the number of patients.
+# The columns are encoded as integer codes once per wave; the patterns of a
+# subgroup are the unique values of the combined codes of its columns.
+# fu (days) and age are part of the patterns, so the reduction depends on
+# how many patients share the same age, sex, stp, fu and status. It is not
+# assumed but reported per wave and subgroup (patients, patterns and
+# patients per pattern). The patterns are not coarsened, as that would
+# change the models.
+# The subgroups are those of analysis/waves_model_survival.R.
+# Input: output/processed/input_<wave>.parquet (written by data_process.R;
+#   factors keep their levels, so the reference levels of the models too)
+# Output: output/processed/patterns/<wave>_<subgroup>.parquet and
+#   output/processed/patterns/compression.csv (wave, subgroup, patients,
+#   patterns, reduction)
+# usage: python analysis/compress_patterns.py [wave ...]
+#   (default: all waves in config.json)
+
+######################################
+
+# IMPORT STATEMENTS ----
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from config import load_config
+
+INPUT_DIR = Path("output/processed")
+OUTPUT_DIR = Path("output/processed/patterns")
+OUTCOME_COLUMNS = ["fu", "status"]
+WEIGHT_COLUMN = "n"
+REPORT_FILE = "compression.csv"
+
+
+# --- MODELS ---
+def model_subgroups(config):
+    """
+    Return the subgroups of the Cox models (as in waves_model_survival.R:
+    models are stratified by stp, so region is left out)
+    """
+    demographics = [d for d in config.demographics if d != "region"]
+    return ["agegroup", "sex", *demographics, *config.comorbidities, "imp_vax"]
+
+
+def model_columns(subgroup):
+    """
+    Return the columns of the model of subgroup (see coxmodel() in
+    analysis/utils/model_coxph.R)
+    """
+    if subgroup == "agegroup":
+        covariates = ["sex"]
+    elif subgroup == "sex":
+        covariates = ["age"]
+    else:
+        covariates = ["age", "sex"]
+    return [subgroup, *covariates, "stp", *OUTCOME_COLUMNS]
+
+
+# --- COMPRESSION ---
+class PatternEncoder:
+    """
+    Integer codes (and number of levels) of the columns of a data frame,
+    missing values are a level too; every column is encoded once
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.codes = {}
+        self.n_levels = {}
+
+    def encode(self, column):
+        if column not in self.codes:
+            codes, levels = pd.factorize(self.data[column], use_na_sentinel=False)
+            self.codes[column] = codes
+            self.n_levels[column] = max(len(levels), 1)
+        return self.codes[column], self.n_levels[column]
+
+    def patterns(self, columns):
+        """
+        Return data frame with the unique combinations of columns and their
+        number of rows (column WEIGHT_COLUMN)
+        """
+        codes, shape = zip(*(self.encode(column) for column in columns))
+        key = np.ravel_multi_index(codes, shape)
+        _, first_row, counts = np.unique(key, return_index=True, return_counts=True)
+        patterns = self.data[columns].iloc[first_row].reset_index(drop=True)
+        patterns[WEIGHT_COLUMN] = counts
+        return patterns
+
+
+def compress_wave(input_file, subgroups, output_dir, wave):
+    """
+    Write the patterns of every subgroup of the processed data of wave and
+    return the number of patients and dict subgroup -> number of patterns
+    """
+    columns = list(dict.fromkeys(
+        column for subgroup in subgroups for column in model_columns(subgroup)
+    ))
+    data = pd.read_parquet(input_file, columns=columns)
+    encoder = PatternEncoder(data)
+    n_patterns = {}
+    for subgroup in subgroups:
+        patterns = encoder.patterns(model_columns(subgroup))
+        patterns.to_parquet(
+            Path(output_dir) / f"{wave}_{subgroup}.parquet", index=False
+        )
+        n_patterns[subgroup] = len(patterns)
+    return len(data), n_patterns
+
+
+def compression_report(results):
+    """
+    Return data frame wave, subgroup, patients, patterns and reduction
+    (patients per pattern) of results (dict wave -> output of
+    compress_wave())
+    """
+    rows = [
+        (wave, subgroup, n_patients, patterns)
+        for wave, (n_patients, n_patterns) in results.items()
+        for subgroup, patterns in n_patterns.items()
+    ]
+    report = pd.DataFrame(
+        rows, columns=["wave", "subgroup", "patients", "patterns"]
+    )
+    report["reduction"] = report["patients"] / report["patterns"].clip(lower=1)
+    return report
+
+
+if __name__ == "__main__":
+    config = load_config()
+    waves = sys.argv[1:] or list(config.waves)
+    subgroups = model_subgroups(config)
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    results = {
+        wave: compress_wave(
+            INPUT_DIR / f"input_{wave}.parquet", subgroups, OUTPUT_DIR, wave
+        )
+        for wave in waves
+    }
+    compression_report(results).to_csv(OUTPUT_DIR / REPORT_FILE, index=False)
@@ -0,0 +1,139 @@
+######################################
+
+# This script reads analysis/config.json (dates, waves, list of demographics
+# and list of comorbidities) into an immutable, typed config object.
+# The file is parsed and validated once per process: every study definition
+# and every python stage should use load_config() instead of reading the
+# json file itself.
+
+######################################
+
+# IMPORT STATEMENTS ----
+import datetime
+import json
+import re
+from dataclasses import dataclass
+from functools import cached_property, lru_cache
+from pathlib import Path
+from types import MappingProxyType
+from typing import Mapping, Tuple
+
+CONFIG_FILE = Path(__file__).parent / "config.json"
+WAVE_KEY_REGEX = re.compile(r"^wave\d+$")
+
+
+@dataclass(frozen=True)
+class Period:
+    start_date: datetime.date
+    end_date: datetime.date
+
+    @classmethod
+    def from_json(cls, name, value):
+        try:
+            start_date = datetime.date.fromisoformat(value["start_date"])
+            end_date = datetime.date.fromisoformat(value["end_date"])
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(
+                f"config: '{name}' needs a start_date and end_date in "
+                f"YYYY-MM-DD format ({e})"
+            )
+        if start_date > end_date:
+            raise ValueError(f"config: start_date of '{name}' is after its end_date")
+        return cls(start_date=start_date, end_date=end_date)
+
+    def contains(self, date):
+        return self.start_date <= date <= self.end_date
+
+
+@dataclass(frozen=True)
+class Config:
+    dates: Period
+    # wave name (e.g. 'wave1') -> period, in order of config.json
+    waves: Mapping[str, Period]
+    demographics: Tuple[str, ...]
+    comorbidities: Tuple[str, ...]
+
+    # DERIVED VIEWS ----
+    @cached_property
+    def subgroups(self):
+        """
+        Demographics and comorbidities
+        """
+        return self.demographics + self.comorbidities
+
+    @cached_property
+    def month_index_dates(self):
+        """
+        First day of every month between dates.start_date and dates.end_date
+        """
+        month = self.dates.start_date.replace(day=1)
+        if month < self.dates.start_date:
+            month = next_month(month)
+        index_dates = []
+        while month <= self.dates.end_date:
+            index_dates.append(month)
+            month = next_month(month)
+        return tuple(index_dates)
+
+    @cached_property
+    def index_date_range(self):
+        """
+        Monthly index dates in the format of cohortextractor's
+        --index-date-range argument
+        """
+        return (
+            f"{self.month_index_dates[0].isoformat()} to "
+            f"{self.month_index_dates[-1].isoformat()} by month"
+        )
+
+    def wave_dates(self, wave):
+        """
+        Start and end date of a wave as YYYY-MM-DD strings
+        """
+        period = self.waves[wave]
+        return period.start_date.isoformat(), period.end_date.isoformat()
+
+
+def next_month(date):
+    if date.month == 12:
+        return date.replace(year=date.year + 1, month=1)
+    return date.replace(month=date.month + 1)
+
+
+def names_from_json(name, value):
+    if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+        raise ValueError(f"config: '{name}' should be a list of variable names")
+    if len(set(value)) != len(value):
+        raise ValueError(f"config: '{name}' contains duplicate variable names")
+    return tuple(value)
+
+
+def parse_config(data):
+    """
+    Validate the content of config.json and return a Config
+    """
+    for key in ("dates", "demographics", "comorbidities"):
+        if key not in data:
+            raise ValueError(f"config: '{key}' is missing")
+    waves = {
+        key: Period.from_json(key, value)
+        for key, value in data.items()
+        if WAVE_KEY_REGEX.match(key)
+    }
+    if not waves:
+        raise ValueError("config: no waves defined (keys 'wave1', 'wave2', ...)")
+    return Config(
+        dates=Period.from_json("dates", data["dates"]),
+        waves=MappingProxyType(waves),
+        demographics=names_from_json("demographics", data["demographics"]),
+        comorbidities=names_from_json("comorbidities", data["comorbidities"]),
+    )
+
+
+@lru_cache(maxsize=None)
+def load_config(config_file=CONFIG_FILE):
+    """
+    Return the Config in config_file (parsed once per process)
+    """
+    with open(config_file, "r") as f:
+        return parse_config(json.load(f))
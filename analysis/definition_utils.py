@@ -0,0 +1,373 @@
+######################################
+
+# Helpers to inspect and rewrite cohortextractor variable definitions.
+# A variable definition (e.g. the output of patients.age_as_of()) is a tuple
+# (query_type, query_args); categorised_as/satisfying definitions carry their
+# hidden variables in query_args["extra_columns"].
+# These helpers only look at the definitions and never need a database.
+
+######################################
+
+import calendar
+import datetime
+import re
+
+# Query arguments that hold a date or a date expression
+DATE_ARGUMENTS = (
+    "date",
+    "reference_date",
+    "start_date",
+    "end_date",
+    "on_or_before",
+    "on_or_after",
+)
+# Query arguments that hold the name of another column
+COLUMN_ARGUMENTS = ("source",)
+# Columns added by cohortextractor next to the column of a variable (e.g.
+# include_date_of_match=True adds '<name>_date')
+COMPANION_SUFFIXES = ("_date_measured", "_date")
+
+# Same grammar as cohortextractor's date expressions, e.g.
+# "index_date - 3 months" or "last_day_of_month(index_date)"
+DATE_EXPRESSION_REGEX = re.compile(
+    r"""^((?P<function>[A-Za-z][A-Za-z0-9_]*)\()?
+    (?P<name>\d{4}-\d{2}-\d{2}|[A-Za-z][A-Za-z0-9_]*)\)?
+    ((?P<operator>[+\-])(?P<quantity>\d+)(?P<units>[A-Za-z]+))?$""",
+    re.VERBOSE,
+)
+ISO_DATE_REGEX = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+# Tokens in a categorised_as/satisfying expression: string literals (kept
+# as they are) or names
+EXPRESSION_TOKEN_REGEX = re.compile(
+    r"(?P<string>'[^']*'|\"[^\"]*\")|(?P<name>\b[A-Za-z_][A-Za-z0-9_]*\b)"
+)
+EXPRESSION_KEYWORDS = {"AND", "OR", "NOT", "DEFAULT"}
+
+
+# --- FLATTENING ---
+def flatten_definitions(definitions):
+    """
+    Return a dict name -> (query_type, query_args, hidden) with the hidden
+    variables of categorised_as/satisfying pulled out (recursively), in the
+    order cohortextractor evaluates them (hidden variables first)
+    """
+    flattened = {}
+
+    def add(name, definition, hidden):
+        query_type, query_args = definition
+        for extra_name, extra_definition in query_args.get(
+            "extra_columns", {}
+        ).items():
+            add(extra_name, extra_definition, True)
+        query_args = {k: v for k, v in query_args.items() if k != "extra_columns"}
+        if name in flattened:
+            raise ValueError(f"Duplicate columns named '{name}'")
+        flattened[name] = (query_type, query_args, hidden)
+
+    for name, definition in definitions.items():
+        add(name, definition, False)
+    return flattened
+
+
+# --- DATE EXPRESSIONS ---
+def is_iso_date(value):
+    return isinstance(value, str) and bool(ISO_DATE_REGEX.match(value))
+
+
+def parse_date_expression(expression):
+    """
+    Split a date expression in its parts (function, name, operator, quantity,
+    units); returns None if expression is not a date expression
+    """
+    if not isinstance(expression, str):
+        return None
+    match = DATE_EXPRESSION_REGEX.match(expression.replace(" ", ""))
+    if not match:
+        return None
+    return match.groupdict()
+
+
+def add_months(date, months):
+    # same as cohortextractor: clip day to the last day of the new month
+    month_index = date.month - 1 + months
+    year = date.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return date.replace(year=year, month=month, day=day)
+
+
+def shift_date(date, operator, quantity, units):
+    value = int(quantity)
+    if operator == "-":
+        value = -value
+    units = units.rstrip("s")
+    if units == "day":
+        return date + datetime.timedelta(days=value)
+    if units == "month":
+        return add_months(date, value)
+    if units == "year":
+        return add_months(date, 12 * value)
+    raise ValueError(f"Unknown date unit '{units}'")
+
+
+def apply_date_function(date, function):
+    if function == "first_day_of_month":
+        return date.replace(day=1)
+    if function == "last_day_of_month":
+        return date.replace(day=calendar.monthrange(date.year, date.month)[1])
+    if function == "first_day_of_year":
+        return date.replace(month=1, day=1)
+    if function == "last_day_of_year":
+        return date.replace(month=12, day=31)
+    raise ValueError(f"Unknown date function '{function}'")
+
+
+def evaluate_date_expression(expression, index_date):
+    """
+    Evaluate a date expression relative to index_date (a YYYY-MM-DD string).
+    Expressions that refer to another column (e.g.
+    "covid_vax_date_1 + 1 day") are returned unchanged, as are values that
+    are not date expressions.
+    """
+    parts = parse_date_expression(expression)
+    if parts is None or parts["name"] != "index_date":
+        return expression
+    date = datetime.date.fromisoformat(index_date)
+    if parts["function"]:
+        date = apply_date_function(date, parts["function"])
+    if parts["operator"]:
+        date = shift_date(
+            date, parts["operator"], parts["quantity"], parts["units"]
+        )
+    return date.isoformat()
+
+
+def iter_date_values(query_args):
+    """
+    Yield all date (expression) values in query_args
+    """
+    for key in DATE_ARGUMENTS:
+        if isinstance(query_args.get(key), str):
+            yield query_args[key]
+    between = query_args.get("between")
+    if between:
+        for value in between:
+            if isinstance(value, str):
+                yield value
+
+
+def map_date_values(query_args, function):
+    """
+    Return a copy of query_args with function applied to all date values
+    """
+    query_args = dict(query_args)
+    for key in DATE_ARGUMENTS:
+        if isinstance(query_args.get(key), str):
+            query_args[key] = function(query_args[key])
+    if query_args.get("between"):
+        query_args["between"] = [
+            function(value) if isinstance(value, str) else value
+            for value in query_args["between"]
+        ]
+    return query_args
+
+
+def map_expectation_dates(query_args, function):
+    """
+    Return a copy of query_args with function applied to the earliest and
+    latest dates of its return_expectations
+    """
+    expectations = query_args.get("return_expectations")
+    if not expectations or not isinstance(expectations.get("date"), dict):
+        return query_args
+    date_expectations = {
+        key: function(value) if isinstance(value, str) else value
+        for key, value in expectations["date"].items()
+    }
+    return dict(
+        query_args,
+        return_expectations=dict(expectations, date=date_expectations),
+    )
+
+
+# --- COLUMN REFERENCES ---
+def expression_names(expression):
+    """
+    Return the column names referenced in a categorised_as expression
+    """
+    return [
+        match.group("name")
+        for match in EXPRESSION_TOKEN_REGEX.finditer(expression)
+        if match.group("name") and match.group("name") not in EXPRESSION_KEYWORDS
+    ]
+
+
+def rename_in_expression(expression, rename):
+    def replace(match):
+        name = match.group("name")
+        if not name or name in EXPRESSION_KEYWORDS:
+            return match.group(0)
+        return rename(name)
+    return EXPRESSION_TOKEN_REGEX.sub(replace, expression)
+
+
+def referenced_columns(query_type, query_args):
+    """
+    Return the set of column names a (flattened) definition refers to
+    """
+    names = set()
+    for value in iter_date_values(query_args):
+        parts = parse_date_expression(value)
+        if parts and parts["name"] not in ("index_date", "today") and not (
+            is_iso_date(parts["name"])
+        ):
+            names.add(parts["name"])
+    for key in COLUMN_ARGUMENTS:
+        if isinstance(query_args.get(key), str):
+            names.add(query_args[key])
+    for column_name in query_args.get("column_names", ()):
+        if not is_iso_date(column_name):
+            names.add(column_name)
+    if query_type == "categorised_as":
+        for expression in query_args["category_definitions"].values():
+            names.update(expression_names(expression))
+    return names
+
+
+def uses_index_date(query_args):
+    """
+    Does a (flattened) definition refer to index_date itself?
+    """
+    for value in iter_date_values(query_args):
+        parts = parse_date_expression(value)
+        if parts and parts["name"] == "index_date":
+            return True
+    return False
+
+
+def index_date_dependent_columns(definitions, date_dependent=()):
+    """
+    Return the names of the (flattened) columns in definitions that depend on
+    the index date: columns that use index_date, columns in date_dependent
+    and all columns that refer to one of those
+    """
+    flattened = flatten_definitions(definitions)
+    dependent = {
+        name
+        for name, (query_type, query_args, hidden) in flattened.items()
+        if name in date_dependent or uses_index_date(query_args)
+    }
+    changed = True
+    while changed:
+        changed = False
+        for name, (query_type, query_args, hidden) in flattened.items():
+            if name in dependent:
+                continue
+            references = {
+                column if column in flattened else companion_base(column)[0]
+                for column in referenced_columns(query_type, query_args)
+            }
+            if references & dependent:
+                dependent.add(name)
+                changed = True
+    return dependent
+
+
+# --- EVENT DATE CHAINS ---
+def event_date_chain(query, names, between, return_expectations, **query_args):
+    """
+    Return the definitions of the first len(names) distinct dates of the
+    events of query (e.g. patients.with_tpp_vaccination_record) in between:
+    names[0] is the first date, names[k] the first date after names[k - 1].
+    This only generates the queries: every date is still a separate query
+    that depends on the previous date, not a single scan of the events.
+    The dates are sorted, so the chain with an earlier end date is this chain
+    without the dates after that end date (see analysis/split_waves.py)
+    """
+    definitions = {}
+    start_date, end_date = between
+    for name, expectations in zip(names, return_expectations):
+        definitions[name] = query(
+            between=[start_date, end_date],
+            find_first_match_in_period=True,
+            returning="date",
+            date_format="YYYY-MM-DD",
+            return_expectations=expectations,
+            **query_args,
+        )
+        # from day after previous event
+        start_date = f"{name} + 1 day"
+    return definitions
+
+
+# --- REWRITING ---
+def companion_base(name):
+    """
+    Return (base, suffix) if name is a companion column (e.g.
+    'creatinine_date' -> ('creatinine', '_date')), otherwise (name, '')
+    """
+    for suffix in COMPANION_SUFFIXES:
+        if name.endswith(suffix):
+            return name[: -len(suffix)], suffix
+    return name, ""
+
+
+def make_renamer(mapping):
+    """
+    Return a function that renames a column using mapping, following renamed
+    variables to their companion columns
+    """
+    def rename(name):
+        if name in mapping:
+            return mapping[name]
+        base, suffix = companion_base(name)
+        if suffix and base in mapping:
+            return mapping[base] + suffix
+        return name
+    return rename
+
+
+def rewrite_definition(definition, rename=None, index_date=None):
+    """
+    Return a copy of a (nested) definition with column references renamed
+    and, if index_date is given, all index_date based date expressions
+    evaluated to ISO dates. Names of hidden variables are renamed too.
+    """
+    query_type, query_args = definition
+    query_args = dict(query_args)
+    if index_date is not None:
+        query_args = map_date_values(
+            query_args, lambda value: evaluate_date_expression(value, index_date)
+        )
+        query_args = map_expectation_dates(
+            query_args, lambda value: evaluate_date_expression(value, index_date)
+        )
+    if rename is not None:
+        def rename_date(value):
+            parts = parse_date_expression(value)
+            if not parts or parts["name"] in ("index_date", "today"):
+                return value
+            return value.replace(parts["name"], rename(parts["name"]), 1)
+        query_args = map_date_values(query_args, rename_date)
+        for key in COLUMN_ARGUMENTS:
+            if isinstance(query_args.get(key), str):
+                query_args[key] = rename(query_args[key])
+        if "column_names" in query_args:
+            query_args["column_names"] = [
+                rename(column_name) for column_name in query_args["column_names"]
+            ]
+        if query_type == "categorised_as":
+            query_args["category_definitions"] = {
+                category: rename_in_expression(expression, rename)
+                for category, expression in query_args[
+                    "category_definitions"
+                ].items()
+            }
+    if "extra_columns" in query_args:
+        query_args["extra_columns"] = {
+            (rename(name) if rename else name): rewrite_definition(
+                extra_definition, rename, index_date
+            )
+            for name, extra_definition in query_args["extra_columns"].items()
+        }
+    return query_type, query_args
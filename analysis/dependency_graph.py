@@ -0,0 +1,211 @@
+######################################
+
+# This script parses the variables of a study definition into a dependency
+# graph: a variable depends on the variables it refers to by name (in a
+# categorised_as/satisfying expression, in a date expression such as
+# 'died_ons_covid_any_date + 1 day', or as source of value_from), hidden
+# variables included (see definition_utils.py).
+# From the graph it reports:
+# - levels: variables in the same level only depend on variables in earlier
+#   levels and can be computed concurrently
+# - dead variables: hidden variables that no output column (or the
+#   population) needs; eliminate_dead_variables() removes them from the
+#   definitions
+# - the critical path: the chain of dependent variables with the largest
+#   total cost, which bounds the latency of an extraction however many
+#   variables are computed concurrently (cost of a variable is the time the
+#   database spent on it in output/benchmarks/extraction.json, see
+#   benchmark_extraction.py, or 1 if there are no database timings)
+# Output: output/dependency_graph/<study_definition>.json
+# usage: python analysis/dependency_graph.py [study_definition]
+#   [benchmark_results]
+
+######################################
+
+# IMPORT STATEMENTS ----
+import importlib
+import json
+import sys
+from pathlib import Path
+
+from definition_utils import companion_base, flatten_definitions, referenced_columns
+
+OUTPUT_DIR = Path("output/dependency_graph")
+BENCHMARK_RESULTS = Path("output/benchmarks/extraction.json")
+
+
+# --- GRAPH ---
+class DependencyGraph:
+    """
+    Variables of a study definition with the variables they depend on
+    """
+
+    def __init__(self, definitions):
+        flattened = flatten_definitions(definitions)
+        self.dependencies = {}
+        # variables that are not written to the extract
+        self.hidden = set()
+        for name, (query_type, query_args, hidden) in flattened.items():
+            if hidden or query_args.get("hidden"):
+                self.hidden.add(name)
+            dependencies = set()
+            for column in referenced_columns(query_type, query_args):
+                # (a companion column, e.g. 'dialysis_date', depends on its
+                # variable)
+                if column not in flattened:
+                    column = companion_base(column)[0]
+                if column not in flattened:
+                    raise ValueError(
+                        f"Variable '{name}' refers to undefined column '{column}'"
+                    )
+                if column != name:
+                    dependencies.add(column)
+            self.dependencies[name] = dependencies
+
+    @property
+    def outputs(self):
+        return [name for name in self.dependencies if name not in self.hidden]
+
+    def required(self, names):
+        """
+        Return names and all variables they depend on (recursively)
+        """
+        required = set()
+        stack = list(names)
+        while stack:
+            name = stack.pop()
+            if name not in required:
+                required.add(name)
+                stack.extend(self.dependencies[name])
+        return required
+
+    def dead_variables(self):
+        """
+        Return hidden variables that no output column needs
+        """
+        required = self.required(self.outputs)
+        return [name for name in self.dependencies if name not in required]
+
+    def levels(self):
+        """
+        Return list of lists of variables: the variables of a level only
+        depend on variables of earlier levels
+        """
+        level_of = {}
+        remaining = dict(self.dependencies)
+        levels = []
+        while remaining:
+            level = [
+                name
+                for name, dependencies in remaining.items()
+                if all(dependency in level_of for dependency in dependencies)
+            ]
+            if not level:
+                raise ValueError(f"Cyclic dependencies between {sorted(remaining)}")
+            for name in level:
+                level_of[name] = len(levels)
+                del remaining[name]
+            levels.append(level)
+        return levels
+
+    def critical_path(self, costs=None):
+        """
+        Return (total cost, variables) of the most expensive chain of
+        dependent variables; costs is a dict name -> cost (variables not in
+        costs cost 0), all variables cost 1 if costs is None
+        """
+        finish = {}
+        previous = {}
+        for level in self.levels():
+            for name in level:
+                cost = 1 if costs is None else costs.get(name, 0)
+                before = max(
+                    self.dependencies[name], key=finish.get, default=None
+                )
+                finish[name] = cost + (finish[before] if before else 0)
+                previous[name] = before
+        if not finish:
+            return 0, []
+        name = max(finish, key=finish.get)
+        total = finish[name]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = previous[name]
+        return total, path[::-1]
+
+
+# --- ELIMINATION ---
+def eliminate_dead_variables(definitions):
+    """
+    Return a copy of definitions without the hidden variables that no output
+    column needs
+    """
+    dead = set(DependencyGraph(definitions).dead_variables())
+
+    def eliminate(definition):
+        query_type, query_args = definition
+        if "extra_columns" not in query_args:
+            return definition
+        extra_columns = {
+            name: eliminate(extra_definition)
+            for name, extra_definition in query_args["extra_columns"].items()
+            if name not in dead
+        }
+        return query_type, dict(query_args, extra_columns=extra_columns)
+
+    return {
+        name: eliminate(definition)
+        for name, definition in definitions.items()
+        if name not in dead
+    }
+
+
+# --- REPORT ---
+def load_costs(study_definition, results_file=BENCHMARK_RESULTS):
+    """
+    Return the database time per variable of study_definition in the
+    benchmark results (None if it was not benchmarked against a database)
+    """
+    if not Path(results_file).exists():
+        return None
+    with open(results_file, "r") as f:
+        result = json.load(f).get(study_definition)
+    if result is None:
+        return None
+    costs = {
+        name: values["database_seconds"]
+        for name, values in result["variables"].items()
+        if "database_seconds" in values
+    }
+    return costs or None
+
+
+def report(graph, costs=None):
+    total, path = graph.critical_path(costs)
+    return {
+        "levels": graph.levels(),
+        "dead_variables": graph.dead_variables(),
+        "critical_path": {"cost": total, "variables": path},
+        "dependencies": {
+            name: sorted(dependencies)
+            for name, dependencies in graph.dependencies.items()
+        },
+    }
+
+
+if __name__ == "__main__":
+    study_definition = sys.argv[1] if len(sys.argv) > 1 else "study_definition"
+    results_file = sys.argv[2] if len(sys.argv) > 2 else BENCHMARK_RESULTS
+    study = importlib.import_module(study_definition).study
+    graph = DependencyGraph(study.covariate_definitions)
+    result = report(graph, load_costs(study_definition, results_file))
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    with open(OUTPUT_DIR / f"{study_definition}.json", "w") as f:
+        json.dump(result, f, indent=2)
+        f.write("\n")
+    print(f"{len(result['levels'])} levels, widest level: "
+          f"{max(map(len, result['levels']), default=0)} variables")
+    print(f"dead variables: {', '.join(result['dead_variables']) or 'none'}")
+    print(f"critical path ({result['critical_path']['cost']}): "
+          f"{' -> '.join(result['critical_path']['variables'])}")
@@ -0,0 +1,174 @@
+######################################
+
+# Variables derived from the columns of an extract that cohortextractor cannot
+# compute in the database (python versions of the R functions in
+# analysis/utils/kidney_functions.R, with the same rules):
+# - egfr: estimated glomerular filtration rate (CKD-EPI) from creatinine,
+#   creatinine_operator, creatinine_age and sex
+# - ckd_rrt: CKD stage or renal replacement therapy, from rrt_cat and egfr
+# Every derived variable is a vectorised function of whole columns, so it is
+# added to an extract in the same pass that reads the extract (see
+# measures_cube.py, which groups the measures by ckd_rrt like any other
+# subgroup). A derived variable can use other derived variables;
+# input_columns() gives the extracted columns needed for a set of derived
+# variables and add_derived_variables() adds them in order of dependency.
+
+######################################
+
+# IMPORT STATEMENTS ----
+from dataclasses import dataclass
+from typing import Callable, Tuple
+
+import numpy as np
+import pandas as pd
+
+# creatinine in umol/l is converted to mg/dl
+CREATININE_MG_DL = 88.4
+# creatinine values outside this range are not used
+CREATININE_RANGE = (20, 3000)
+# (upper bound of egfr, category), in order
+CKD_STAGES = (
+    (15, "Stage 5"),
+    (30, "Stage 4"),
+    (45, "Stage 3b"),
+    (60, "Stage 3a"),
+    (np.inf, "No CKD or RRT"),
+)
+RRT_CATEGORIES = {"1": "RRT (dialysis)", "2": "RRT (transplant)"}
+
+
+@dataclass(frozen=True)
+class DerivedVariable:
+    # columns (extracted or derived) the variable is calculated from
+    inputs: Tuple[str, ...]
+    # function of a data frame with the inputs, returning a series
+    function: Callable
+
+
+# --- KIDNEY FUNCTION ---
+def as_strings(column):
+    """
+    Column as strings, missing values as ''
+    """
+    return column.astype(object).where(column.notna(), "").astype(str)
+
+
+def egfr(data):
+    """
+    Estimated glomerular filtration rate based on the CKD-EPI formula (NaN
+    if the creatinine level can not be used); the equation for males is used
+    if sex is missing, the factor for females only if sex is 'F'
+    """
+    creatinine = pd.to_numeric(data["creatinine"], errors="coerce").to_numpy(
+        np.float64
+    )
+    creatinine_age = pd.to_numeric(
+        data["creatinine_age"], errors="coerce"
+    ).to_numpy(np.float64)
+    operator = as_strings(data["creatinine_operator"]).to_numpy()
+    sex = as_strings(data["sex"]).to_numpy()
+    male_equation = (sex == "M") | (sex == "")
+    scr_adj = creatinine / CREATININE_MG_DL
+    # (creatinine 0 or missing gives inf/NaN, these values are not usable)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        min_creat = np.where(
+            male_equation,
+            np.minimum(scr_adj / 0.9, 1) ** -0.411,
+            np.minimum(scr_adj / 0.7, 1) ** -0.329,
+        )
+        max_creat = (
+            np.maximum(scr_adj / np.where(male_equation, 0.9, 0.7), 1) ** -1.209
+        )
+        usable = (
+            ~np.isnan(creatinine)
+            & ~np.isnan(creatinine_age)
+            & ((operator == "") | (operator == "="))
+            & (creatinine >= CREATININE_RANGE[0])
+            & (creatinine <= CREATININE_RANGE[1])
+        )
+        values = min_creat * max_creat * 141 * 0.993 ** creatinine_age
+    values = np.where(usable, values, np.nan)
+    values = np.where(sex == "F", 1.018 * values, values)
+    return pd.Series(values, index=data.index)
+
+
+def ckd_rrt(data):
+    """
+    Categorise into RRT (dialysis); RRT (transplant); Stage 5; Stage 4;
+    Stage 3b; Stage 3a or No CKD or RRT (missing if rrt_cat and egfr are
+    missing, or if egfr is negative and rrt_cat is not RRT)
+    """
+    rrt_cat = as_strings(data["rrt_cat"]).to_numpy()
+    values = data["egfr"].to_numpy(np.float64)
+    stages = np.array([category for _, category in CKD_STAGES], dtype=object)
+    upper_bounds = np.array([upper for upper, _ in CKD_STAGES])
+    stage = stages[
+        np.minimum(
+            np.searchsorted(upper_bounds, values, side="right"), len(stages) - 1
+        )
+    ]
+    # (a missing egfr is No CKD or RRT if rrt_cat is "0", a negative egfr is
+    # missing, as in categorise_ckd_rrt() in kidney_functions.R)
+    categories = np.where(
+        np.isnan(values),
+        np.where(rrt_cat == "0", "No CKD or RRT", None),
+        np.where(values < 0, None, stage),
+    )
+    for code, category in RRT_CATEGORIES.items():
+        categories = np.where(rrt_cat == code, category, categories)
+    return pd.Series(categories, index=data.index, dtype=object)
+
+
+DERIVED_VARIABLES = {
+    "egfr": DerivedVariable(
+        inputs=("creatinine", "creatinine_operator", "creatinine_age", "sex"),
+        function=egfr,
+    ),
+    "ckd_rrt": DerivedVariable(inputs=("rrt_cat", "egfr"), function=ckd_rrt),
+}
+
+
+# --- DEPENDENCIES ---
+def derivation_order(names, derived_variables=DERIVED_VARIABLES):
+    """
+    Return the derived variables in names and the derived variables they
+    use, every variable after the variables it uses
+    """
+    order = []
+
+    def visit(name):
+        if name in order or name not in derived_variables:
+            return
+        for column in derived_variables[name].inputs:
+            visit(column)
+        order.append(name)
+
+    for name in names:
+        visit(name)
+    return order
+
+
+def input_columns(names, derived_variables=DERIVED_VARIABLES):
+    """
+    Return the extracted columns needed for the columns names (derived
+    variables are replaced by their inputs)
+    """
+    derived = derivation_order(names, derived_variables)
+    columns = [name for name in names if name not in derived_variables]
+    for name in derived:
+        columns.extend(
+            column
+            for column in derived_variables[name].inputs
+            if column not in derived_variables
+        )
+    return list(dict.fromkeys(columns))
+
+
+def add_derived_variables(data, names, derived_variables=DERIVED_VARIABLES):
+    """
+    Add the derived variables in names (and the derived variables they use)
+    to data
+    """
+    for name in derivation_order(names, derived_variables):
+        data[name] = derived_variables[name].function(data)
+    return data
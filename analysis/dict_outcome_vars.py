@@ -0,0 +1,80 @@
+# Define outcome and vaccination variables needed accross waves
+# (these depend on the end date of a wave, hence a function io a dict)
+
+from cohortextractor import (
+    patients,
+)
+
+import codelists
+
+from definition_utils import event_date_chain
+
+# Chain of COVID vaccination dates (see event_date_chain() in
+# definition_utils.py)
+covid_vax_dates = [f"covid_vax_date_{n}" for n in range(1, 7)]
+
+
+def outcome_variables(end_date):
+    return dict(
+        # Patients with ONS-registered death
+        died_ons_covid_any_date=patients.with_these_codes_on_death_certificate(
+            codelists.covid_codelist,  # imported from codelists.py
+            returning="date_of_death",
+            between=["index_date", end_date],
+            match_only_underlying_cause=False,  # boolean for indicating if filters
+            # results to only specified cause of death
+            date_format="YYYY-MM-DD",
+            return_expectations={
+                "date": {"earliest": "index_date", "latest": end_date},
+                "incidence": 0.05,
+            },
+        ),
+        # Death from any cause (to be used for censoring)
+        died_any_date=patients.died_from_any_cause(
+            between=["index_date", end_date],
+            returning="date_of_death",
+            date_format="YYYY-MM-DD",
+            return_expectations={
+                "date": {"earliest": "index_date", "latest": end_date},
+                "incidence": 0.01,
+            },
+        ),
+        # Is there an associated positive test in the 8 weeks before
+        # covid associated death?
+        covid_test_positive_date=patients.with_test_result_in_sgss(
+            between=["died_ons_covid_any_date - 57 days", "died_ons_covid_any_date + 2 days"],
+            pathogen="SARS-CoV-2",
+            test_result="positive",
+            find_first_match_in_period=False,
+            restrict_to_earliest_specimen_date=False,
+            returning="date",
+            date_format="YYYY-MM-DD",
+            return_expectations={
+                "date": {"earliest": "index_date", "latest": end_date},
+                "incidence": 0.01
+            },
+        ),
+        # Dates of first to sixth COVID vaccination - source
+        # nhs-covid-vaccination-coverage: any dose recorded after 01/12/2020,
+        # every next dose from the day after the previous dose
+        # (third dose primary or booster - modified from
+        # nhs-covid-vaccination-coverage
+        # 01 Sep 2021: 3rd dose (primary) at interval of >=8w recommended for
+        # immunosuppressed
+        # 14 Sep 2021: 3rd dose (booster) reommended for JCVI groups 1-9 at >=6m
+        # 15 Nov 2021: 3rd dose (booster) recommended for 40–49y at >=6m
+        # 29 Nov 2021: 3rd dose (booster) recommended for 18–39y at >=3m)
+        **event_date_chain(
+            patients.with_tpp_vaccination_record,
+            covid_vax_dates,
+            between=["2020-12-01", end_date],
+            return_expectations=[
+                {
+                    "date": {"earliest": "2020-12-01", "latest": "index_date"},
+                    "incidence": incidence,
+                }
+                for incidence in (0.8, 0.6, 0.5, 0.5, 0.5, 0.5)
+            ],
+            target_disease_matches="SARS-2 CORONAVIRUS",
+        ),
+    )
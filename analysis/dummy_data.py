@@ -0,0 +1,364 @@
+######################################
+
+# This script generates dummy data for a study definition from the
+# return_expectations and default_expectations of its variables, as
+# cohortextractor does with --expectations-population, but fast enough to
+# generate the size of the real population (tens of millions of patients):
+# - patients are generated in chunks of CHUNK_SIZE rows; every column of a
+#   chunk is drawn with one vectorised call of a numpy random generator
+# - every chunk is written to the output file (csv or csv.gz) before the next
+#   one is generated, so memory use does not grow with the population size
+# The distributions follow cohortextractor (expectation_generators.py):
+# - dates: 'uniform' or 'exponential_increase' (truncated exponential) between
+#   date['earliest'] and date['latest'], dates outside the period of the
+#   variable are empty
+# - a fraction 1 - incidence of the values is empty ('' for dates and
+#   categories, 0 for flags and numbers); companion columns (value_from, e.g.
+#   '<name>_date') are empty where their source is empty
+# - categories with the probabilities in category['ratios'], ints 'normal',
+#   'poisson' or 'population_ages', floats 'normal'
+# usage: python analysis/dummy_data.py <study definition> [population_size]
+#   [output_file] [index_date]
+# e.g. python analysis/dummy_data.py study_definition 10000000
+#   output/dummy/input_2020-03-01.csv.gz 2020-03-01
+
+######################################
+
+# IMPORT STATEMENTS ----
+import copy
+import gzip
+import importlib
+import re
+import sys
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+
+CHUNK_SIZE = 1_000_000
+# ratio of the range of the patient ids and the number of patients (as in
+# cohortextractor)
+PATIENT_ID_SPREAD = 10
+# scale of the exponential distribution of 'exponential_increase', as a
+# fraction of the period (values beyond the period are not used)
+EXPONENTIAL_SCALE = 0.1
+# (fast compression, the files are rewritten for every load test)
+GZIP_LEVEL = 1
+ISO_DATE_REGEX = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+EPOCH = np.datetime64("1970-01-01", "D")
+
+
+# --- EXPECTATIONS ---
+def merge(default, expectations):
+    """
+    Merge two (nested) expectation dicts, values of expectations win
+    """
+    result = copy.deepcopy(default)
+    for key, value in expectations.items():
+        if isinstance(value, dict):
+            result[key] = merge(result.get(key, {}), value)
+        else:
+            result[key] = copy.deepcopy(value)
+    return result
+
+
+def column_specs(study):
+    """
+    Return dict name -> spec of the columns of the extract of study (in the
+    order of the extract); spec is a dict with the type, the expectations and
+    the options of the column
+    """
+    args = study.get_pandas_csv_args(study.covariate_definitions)
+    specs = {}
+    for name, query_args in args["args"].items():
+        funcname = query_args["funcname"]
+        if funcname in ("aggregate_of", "with_value_from_file", "which_exist_in_file"):
+            raise ValueError(f"{funcname} ({name}) is not supported")
+        if name in args["parse_dates"]:
+            column_type = "date"
+        else:
+            column_type = args["dtype"][name]
+        if column_type == "date" and "source" in query_args:
+            # dates of value_from use the expectations of their source
+            query_args = {
+                **query_args,
+                "return_expectations": args["args"][query_args["source"]].get(
+                    "return_expectations"
+                ),
+            }
+        expectations = query_args.get("return_expectations") or {}
+        if funcname != "fixed_value" and not (
+            expectations or study.default_expectations
+        ):
+            raise ValueError(
+                f"No `return_expectations` defined for {name} and no "
+                "`default_expectations` defined for the study"
+            )
+        specs[name] = {
+            "type": column_type,
+            "funcname": funcname,
+            "expectations": merge(study.default_expectations, expectations),
+            "between": query_args.get("between"),
+            "date_format": query_args.get("date_format"),
+            "value": query_args.get("value"),
+            "match_incidence": None,
+        }
+    for source, date_column in args["date_col_for"].items():
+        specs[source]["match_incidence"] = date_column
+    return specs
+
+
+def static_date(value):
+    """
+    Date of a between argument, or None if the argument is not a fixed date
+    (e.g. an expression referring to another variable)
+    """
+    if isinstance(value, str) and ISO_DATE_REGEX.match(value):
+        return np.datetime64(value, "D")
+    return None
+
+
+# --- GENERATORS ---
+def population_ages_probabilities():
+    """
+    Probabilities of ages 0 to 109 approximating the UK population, see
+    generate_ages() in cohortextractor/expectation_generators.py
+    """
+    import cohortextractor
+
+    bands = pd.read_csv(
+        Path(cohortextractor.__file__).parent / "uk_population_bands_2018.csv",
+        thousands=",",
+    )
+    band_end = bands["band"].str.split("-").str[1].astype(int).to_numpy()
+    ages = np.arange(110)
+    band = np.searchsorted(band_end, ages)
+    p = bands["range"].to_numpy()[band] / bands["range"].sum() / 5
+    # ensure p adds up to 1 by trimming the largest value
+    p[np.argmax(p)] -= p.sum() - 1
+    return p
+
+
+class ChunkGenerator:
+    """
+    Draws the columns of chunks of patients from column specs
+    """
+
+    def __init__(self, specs, seed=None):
+        self.specs = specs
+        self.rng = np.random.default_rng(seed)
+        self.last_patient_id = 0
+        self._population_ages = None
+
+    def empty_mask(self, n, incidence):
+        """
+        Boolean array with exactly int((1 - incidence) * n) True values
+        """
+        n_empty = int((1 - incidence) * n)
+        return self.rng.permutation(n) < n_empty
+
+    def dates(self, n, expectations):
+        rate = expectations.get("rate", "exponential_increase")
+        earliest = np.datetime64(expectations["date"]["earliest"], "D")
+        latest = np.datetime64(expectations["date"]["latest"], "D")
+        elapsed = (latest - earliest).astype(int)
+        u = self.rng.random(n)
+        if rate == "exponential_increase":
+            # inverse of the cdf of the exponential distribution truncated at
+            # the end of the period
+            scale = EXPONENTIAL_SCALE * max(elapsed, 1)
+            days = -scale * np.log1p(u * np.expm1(-elapsed / scale))
+        elif rate in ("uniform", "universal"):
+            days = u * elapsed
+        else:
+            raise ValueError(
+                "Only exponential_increase and uniform distributions currently "
+                "supported"
+            )
+        return latest - np.minimum(days.astype(int), elapsed)
+
+    def values(self, n, column_type, expectations):
+        if column_type == "category":
+            ratios = expectations["category"]["ratios"]
+            p = np.array(list(ratios.values()), dtype=float)
+            codes = self.rng.choice(len(p), size=n, p=p / p.sum())
+            # a category None is an empty value
+            categories = list(ratios)
+            if None in categories:
+                none = categories.index(None)
+                codes = np.where(codes == none, -1, codes - (codes > none))
+                categories.remove(None)
+            return pd.Categorical.from_codes(codes, categories=categories)
+        if column_type == "Int64":
+            distribution = expectations["int"]
+            if distribution["distribution"] == "normal":
+                return self.rng.normal(
+                    distribution["mean"], distribution["stddev"], n
+                ).astype(np.int64)
+            if distribution["distribution"] == "poisson":
+                return self.rng.poisson(distribution["mean"], n)
+            if distribution["distribution"] == "population_ages":
+                if self._population_ages is None:
+                    self._population_ages = population_ages_probabilities()
+                return self.rng.choice(
+                    len(self._population_ages), size=n, p=self._population_ages
+                )
+            raise ValueError(
+                "Only `normal`, `poisson`, and `population_ages` distributions "
+                "currently supported for ints"
+            )
+        if column_type == "float":
+            distribution = expectations["float"]
+            if distribution["distribution"] != "normal":
+                raise ValueError(
+                    "Only `normal` distributions currently supported for floats"
+                )
+            return self.rng.normal(distribution["mean"], distribution["stddev"], n)
+        if column_type == "bool":
+            return np.ones(n, dtype=np.int8)
+        raise ValueError(f"Unable to generate values of type {column_type}")
+
+    def patient_ids(self, n):
+        """
+        Unique, increasing patient ids spread over PATIENT_ID_SPREAD times
+        the number of patients
+        """
+        gaps = self.rng.integers(1, 2 * PATIENT_ID_SPREAD, n)
+        patient_ids = self.last_patient_id + np.cumsum(gaps)
+        self.last_patient_id = patient_ids[-1]
+        return patient_ids
+
+    def chunk(self, n):
+        """
+        Return dict name -> (values, empty mask) of a chunk of n patients
+        """
+        columns = {}
+        # dates first, so their companion columns can use their empty mask
+        for name, spec in sorted(
+            self.specs.items(), key=lambda item: item[1]["type"] != "date"
+        ):
+            expectations = spec["expectations"]
+            if spec["funcname"] == "fixed_value":
+                values = np.full(n, spec["value"], dtype=object)
+                empty = np.zeros(n, dtype=bool)
+            elif spec["type"] == "date":
+                values = self.dates(n, expectations)
+                empty = self.empty_mask(n, expectations.get("incidence", 1))
+                if expectations.get("rate") == "universal":
+                    empty[:] = False
+                # only dates in the period of the variable
+                min_date, max_date = (
+                    map(static_date, spec["between"]) if spec["between"]
+                    else (None, None)
+                )
+                if min_date is not None:
+                    empty |= values < min_date
+                if max_date is not None:
+                    empty |= values > max_date
+            else:
+                values = self.values(n, spec["type"], expectations)
+                if spec["match_incidence"] is not None:
+                    empty = columns[spec["match_incidence"]][1].copy()
+                elif expectations.get("rate") == "universal":
+                    empty = np.zeros(n, dtype=bool)
+                else:
+                    empty = self.empty_mask(n, expectations["incidence"])
+            columns[name] = (values, empty)
+        return columns
+
+
+# --- OUTPUT ---
+def to_arrow(values, empty, spec):
+    """
+    Arrow array of a column as written by cohortextractor: empty dates and
+    categories are '', empty flags and numbers are 0
+    """
+    if spec["type"] == "date":
+        date_format = spec["date_format"] or "YYYY"
+        if date_format == "YYYY-MM-DD":
+            days = (values - EPOCH).astype(np.int32)
+            return pa.array(days, type=pa.int32(), mask=empty).cast(pa.date32())
+        # dates with a precision of a month or a year have few distinct
+        # values: format the distinct values only
+        unit = "M" if date_format == "YYYY-MM" else "Y"
+        distinct, codes = np.unique(values.astype(f"datetime64[{unit}]"),
+                                    return_inverse=True)
+        values = pd.Categorical.from_codes(codes, categories=distinct.astype(str))
+    if isinstance(values, pd.Categorical):
+        return pa.DictionaryArray.from_arrays(
+            pa.array(values.codes, mask=empty | (values.codes == -1)),
+            values.categories.to_numpy(str),
+        )
+    if spec["funcname"] == "fixed_value":
+        return pa.array(values.astype(str), type=pa.string(), mask=empty)
+    values = values.copy()
+    values[empty] = 0
+    return pa.array(values)
+
+
+def write_dummy_data(study, population_size, output_file, seed=None):
+    """
+    Generate population_size patients from the expectations of study and
+    write them to output_file (csv or csv.gz) chunk by chunk
+    """
+    specs = column_specs(study)
+    generator = ChunkGenerator(specs, seed)
+    names = ["patient_id", *specs]
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    if output_file.suffix == ".gz":
+        sink = gzip.open(output_file, "wb", compresslevel=GZIP_LEVEL)
+    else:
+        sink = open(output_file, "wb")
+    with sink:
+        sink.write((",".join(names) + "\n").encode())
+        writer = None
+        for start in range(0, population_size, CHUNK_SIZE):
+            n = min(CHUNK_SIZE, population_size - start)
+            columns = generator.chunk(n)
+            arrays = [pa.array(generator.patient_ids(n))] + [
+                to_arrow(*columns[name], spec) for name, spec in specs.items()
+            ]
+            table = pa.Table.from_arrays(arrays, names=names)
+            if writer is None:
+                writer = pv.CSVWriter(
+                    sink,
+                    table.schema,
+                    write_options=pv.WriteOptions(
+                        include_header=False, quoting_style="none"
+                    ),
+                )
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
+
+
+def output_file_name(study_definition):
+    """
+    Name of the extract of a study definition, e.g. study_definition_wave1 ->
+    output/dummy/input_wave1.csv.gz
+    """
+    name = re.sub(r"^study_definition", "input", study_definition)
+    return f"output/dummy/{name}.csv.gz"
+
+
+def load_study(study_definition, index_date=None):
+    study = importlib.import_module(study_definition).study
+    if index_date is not None:
+        date.fromisoformat(index_date)
+        study.set_index_date(index_date)
+    return study
+
+
+if __name__ == "__main__":
+    study_definition = sys.argv[1]
+    population_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    output_file = (
+        sys.argv[3] if len(sys.argv) > 3 else output_file_name(study_definition)
+    )
+    index_date = sys.argv[4] if len(sys.argv) > 4 else None
+    write_dummy_data(load_study(study_definition, index_date), population_size,
+                     output_file)
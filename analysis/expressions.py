@@ -0,0 +1,435 @@
+######################################
+
+# Evaluation of the expressions of categorised_as() and satisfying() on a
+# data frame with one column per variable, following the semantics of
+# cohortextractor:
+# - keywords AND, OR, NOT; comparisons =, !=, <, <=, >, >=; arithmetic
+#   +, -, *, /; numbers and quoted strings
+# - a column that is not compared is true if it is not 'empty' (0 for
+#   numbers, '' for strings and dates)
+# - missing values are the empty values: the database replaces NULL by them
+#   (ISNULL()) before the expressions are evaluated, so a missing date ('')
+#   is smaller than every date
+# - / of two integers is integer division (truncated), as in SQL Server
+# - categories are tested in order, the first matching category is used and
+#   'DEFAULT' is used if no category matches
+# Expressions are parsed once (parse_expression is cached). Categories that
+# are all numeric ranges of the same column (e.g. age groups: 'age >= 20 AND
+# age < 25') are compiled into sorted bin edges and evaluated in one pass over
+# the column with np.searchsorted(), instead of one pass per category.
+
+######################################
+
+# IMPORT STATEMENTS ----
+import re
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+TOKEN_REGEX = re.compile(
+    r"""\s*(?:
+    (?P<number>\d+(?:\.\d+)?)|
+    (?P<string>'[^']*'|"[^"]*")|
+    (?P<comparison>!=|<=|>=|=|<|>)|
+    (?P<operator>[+\-*/])|
+    (?P<paren>[()])|
+    (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    )""",
+    re.VERBOSE,
+)
+KEYWORDS = ("AND", "OR", "NOT")
+
+
+class InvalidExpressionError(ValueError):
+    pass
+
+
+# --- PARSING ---
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_REGEX.match(expression, position)
+        if not match or match.end() == position:
+            raise InvalidExpressionError(
+                f"Invalid expression at position {position}: {expression}"
+            )
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value in KEYWORDS:
+            kind = "keyword"
+        tokens.append((kind, value))
+        position = match.end()
+        # skip trailing whitespace
+        while position < len(expression) and expression[position].isspace():
+            position += 1
+    return tokens
+
+
+class Parser:
+    """
+    Recursive descent parser; returns a tree of tuples:
+    ('or', a, b), ('and', a, b), ('not', a), ('compare', op, a, b),
+    ('arith', op, a, b), ('name', name), ('value', value)
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def error(self, message):
+        return InvalidExpressionError(f"{message} in expression: {self.expression}")
+
+    def parse(self):
+        tree = self.parse_or()
+        if self.position != len(self.tokens):
+            raise self.error(f"Unexpected token '{self.peek()[1]}'")
+        return tree
+
+    def parse_or(self):
+        tree = self.parse_and()
+        while self.peek() == ("keyword", "OR"):
+            self.take()
+            tree = ("or", tree, self.parse_and())
+        return tree
+
+    def parse_and(self):
+        tree = self.parse_not()
+        while self.peek() == ("keyword", "AND"):
+            self.take()
+            tree = ("and", tree, self.parse_not())
+        return tree
+
+    def parse_not(self):
+        if self.peek() == ("keyword", "NOT"):
+            self.take()
+            return ("not", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        tree = self.parse_additive()
+        if self.peek()[0] == "comparison":
+            operator = self.take()[1]
+            tree = ("compare", operator, tree, self.parse_additive())
+        return tree
+
+    def parse_additive(self):
+        tree = self.parse_multiplicative()
+        while self.peek() in (("operator", "+"), ("operator", "-")):
+            operator = self.take()[1]
+            tree = ("arith", operator, tree, self.parse_multiplicative())
+        return tree
+
+    def parse_multiplicative(self):
+        tree = self.parse_atom()
+        while self.peek() in (("operator", "*"), ("operator", "/")):
+            operator = self.take()[1]
+            tree = ("arith", operator, tree, self.parse_atom())
+        return tree
+
+    def parse_atom(self):
+        kind, value = self.take()
+        if kind == "number":
+            return ("value", float(value) if "." in value else int(value))
+        if kind == "string":
+            return ("value", value[1:-1])
+        if kind == "name":
+            return ("name", value)
+        if (kind, value) == ("operator", "-"):
+            return ("arith", "-", ("value", 0), self.parse_atom())
+        if (kind, value) == ("paren", "("):
+            tree = self.parse_or()
+            if self.take() != ("paren", ")"):
+                raise self.error("Missing ')'")
+            return tree
+        raise self.error(f"Unexpected token '{value}'")
+
+
+@lru_cache(maxsize=None)
+def parse_expression(expression):
+    return fold_constants(Parser(expression).parse())
+
+
+def fold_constants(tree):
+    """
+    Replace arithmetic on constants (e.g. 32800*1/5) by its value
+    """
+    if tree[0] in ("name", "value"):
+        return tree
+    if tree[0] == "not":
+        return ("not", fold_constants(tree[1]))
+    if tree[0] in ("or", "and"):
+        return (tree[0], fold_constants(tree[1]), fold_constants(tree[2]))
+    kind, operator, left, right = tree
+    left, right = fold_constants(left), fold_constants(right)
+    if kind == "arith" and left[0] == right[0] == "value":
+        return ("value", ARITHMETIC[operator](left[1], right[1]))
+    return (kind, operator, left, right)
+
+
+# --- EVALUATION ---
+COMPARISONS = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+
+def is_integer(value):
+    if isinstance(value, pd.Series):
+        return pd.api.types.is_integer_dtype(value) or pd.api.types.is_bool_dtype(
+            value
+        )
+    return isinstance(value, (int, np.integer))
+
+
+def divide(a, b):
+    """
+    Division as in the database: integer division (truncated towards zero)
+    if both operands are integers
+    """
+    if is_integer(a) and is_integer(b):
+        quotient = np.trunc(np.true_divide(a, b))
+        if isinstance(quotient, pd.Series):
+            return quotient.astype("int64")
+        return int(quotient)
+    return a / b
+
+
+ARITHMETIC = {
+    "+": lambda a, b: a + b,
+    "-": lambda a, b: a - b,
+    "*": lambda a, b: a * b,
+    "/": divide,
+}
+
+
+def is_empty(values):
+    """
+    Boolean array, True where values are 'empty' (0, '' or missing)
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+        return (values.fillna(0) == 0).to_numpy()
+    return (values.fillna("").astype(str) == "").to_numpy()
+
+
+def coerce_like(column, value):
+    """
+    Compare numeric columns with numbers and other columns with strings
+    """
+    if isinstance(value, str) and pd.api.types.is_numeric_dtype(column):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    if not isinstance(value, str) and not pd.api.types.is_numeric_dtype(column):
+        return str(value)
+    return value
+
+
+def evaluate_value(tree, data):
+    kind = tree[0]
+    if kind == "value":
+        return tree[1]
+    if kind == "name":
+        return data[tree[1]]
+    if kind == "arith":
+        return ARITHMETIC[tree[1]](
+            evaluate_value(tree[2], data), evaluate_value(tree[3], data)
+        )
+    return evaluate_condition(tree, data)
+
+
+def evaluate_condition(tree, data):
+    """
+    Evaluate tree to a boolean numpy array (one value per row of data)
+    """
+    kind = tree[0]
+    if kind == "or":
+        return evaluate_condition(tree[1], data) | evaluate_condition(tree[2], data)
+    if kind == "and":
+        return evaluate_condition(tree[1], data) & evaluate_condition(tree[2], data)
+    if kind == "not":
+        return ~evaluate_condition(tree[1], data)
+    if kind == "compare":
+        left = evaluate_value(tree[2], data)
+        right = evaluate_value(tree[3], data)
+        if isinstance(left, pd.Series) and not isinstance(right, pd.Series):
+            right = coerce_like(left, right)
+        elif isinstance(right, pd.Series) and not isinstance(left, pd.Series):
+            left = coerce_like(right, left)
+        return np.broadcast_to(
+            np.asarray(COMPARISONS[tree[1]](left, right), dtype=bool), (len(data),)
+        ).copy()
+    if kind == "name":
+        return ~is_empty(data[tree[1]])
+    if kind == "value":
+        return np.full(len(data), bool(tree[1]))
+    raise InvalidExpressionError(f"Expression is not a condition: {tree}")
+
+
+def evaluate_expression(expression, data):
+    return evaluate_condition(parse_expression(expression), data)
+
+
+# --- COMPILED CATEGORIES ---
+# comparison of a column with a number -> bound of a range, as
+# (is lower bound, is closed)
+BOUNDS = {
+    ">=": (True, True),
+    ">": (True, False),
+    "<=": (False, True),
+    "<": (False, False),
+}
+REVERSED = {">=": "<=", ">": "<", "<=": ">=", "<": ">"}
+
+
+def range_of(tree):
+    """
+    Return (column, lower, lower closed, upper, upper closed) if tree is a
+    numeric range of one column (comparisons with numbers combined with AND),
+    otherwise None
+    """
+    if tree[0] == "and":
+        left, right = range_of(tree[1]), range_of(tree[2])
+        if left is None or right is None or left[0] != right[0]:
+            return None
+        lower = max(left[1:3], right[1:3], key=lambda b: (b[0], not b[1]))
+        upper = min(left[3:5], right[3:5], key=lambda b: (b[0], b[1]))
+        return (left[0], *lower, *upper)
+    if tree[0] != "compare" or tree[1] not in BOUNDS:
+        return None
+    operator, left, right = tree[1:]
+    if left[0] == "value" and right[0] == "name":
+        operator, left, right = REVERSED[operator], right, left
+    if left[0] != "name" or right[0] != "value" or isinstance(right[1], str):
+        return None
+    is_lower, closed = BOUNDS[operator]
+    if is_lower:
+        return (left[1], right[1], closed, np.inf, False)
+    return (left[1], -np.inf, False, right[1], closed)
+
+
+class CompiledCategories:
+    """
+    Category definitions parsed once; numeric ranges of one column are
+    evaluated as bins (see compile_categories())
+    """
+
+    def __init__(self, categories, default):
+        # list of (category, tree), in order
+        self.categories = categories
+        self.default = default
+        # column, bin edges and category per bin if the categories are
+        # ranges of one column
+        self.column = None
+        self.edges = None
+        self.labels = None
+
+    def evaluate(self, data):
+        if self.column is not None and pd.api.types.is_numeric_dtype(
+            data[self.column]
+        ):
+            return self.evaluate_bins(data[self.column].to_numpy(dtype=float))
+        result = np.full(len(data), None, dtype=object)
+        unassigned = np.ones(len(data), dtype=bool)
+        for category, tree in self.categories:
+            matches = evaluate_condition(tree, data) & unassigned
+            result[matches] = category
+            unassigned &= ~matches
+        result[unassigned] = self.default
+        return result
+
+    def evaluate_bins(self, values):
+        result = self.labels[np.searchsorted(self.edges, values, side="right")]
+        # missing values are in no range
+        result[np.isnan(values)] = self.default
+        return result
+
+
+def bins(ranges, default):
+    """
+    Return (edges, labels) of ranges [(category, lower, upper)]; labels[i] is
+    the category of the values between edges[i - 1] and edges[i] (the first
+    range, in order, that contains them)
+    """
+    edges = sorted(
+        {bound for _, lower, upper in ranges for bound in (lower, upper)}
+        - {-np.inf, np.inf}
+    )
+    bounds = [-np.inf, *edges, np.inf]
+    labels = np.full(len(edges) + 1, default, dtype=object)
+    for index in range(len(labels)):
+        for category, lower, upper in ranges:
+            if lower <= bounds[index] and bounds[index + 1] <= upper:
+                labels[index] = category
+                break
+    return np.array(edges, dtype=float), labels
+
+
+def half_open(lower, lower_closed, upper, upper_closed):
+    """
+    Return the range as [lower, upper): for floats, x > a is x >= the next
+    float after a, and x <= b is x < the next float after b
+    """
+    if not lower_closed and lower != -np.inf:
+        lower = np.nextafter(lower, np.inf)
+    if upper_closed and upper != np.inf:
+        upper = np.nextafter(upper, np.inf)
+    return float(lower), float(upper)
+
+
+@lru_cache(maxsize=None)
+def _compile_categories(category_definitions):
+    default = ""
+    categories = []
+    for category, expression in category_definitions:
+        if expression.strip() == "DEFAULT":
+            default = category
+        else:
+            categories.append((category, parse_expression(expression)))
+    compiled = CompiledCategories(categories, default)
+    ranges = [range_of(tree) for _, tree in categories]
+    if not ranges or None in ranges or len({r[0] for r in ranges}) != 1:
+        return compiled
+    compiled.column = ranges[0][0]
+    compiled.edges, compiled.labels = bins(
+        [
+            (category, *half_open(*r[1:]))
+            for (category, _), r in zip(categories, ranges)
+        ],
+        default,
+    )
+    return compiled
+
+
+def compile_categories(category_definitions):
+    """
+    Return the CompiledCategories of category_definitions (dict category ->
+    expression); compiled once per definition
+    """
+    return _compile_categories(tuple(category_definitions.items()))
+
+
+def evaluate_categories(category_definitions, data):
+    """
+    Return the category of every row of data as a numpy object array
+    """
+    return compile_categories(category_definitions).evaluate(data)
@@ -0,0 +1,189 @@
+######################################
+
+# Columnar (Parquet) versions of the extracts, with the schema of the columns
+# derived from the variable definitions of the study definitions:
+# - binary flags (and satisfying()) -> boolean
+# - dates -> date32 (dates in format YYYY-MM or YYYY are stored as the first
+#   day of the month/year)
+# - categories (and categorised_as(), and other text) -> dictionary encoded
+#   strings
+# - numeric values -> float64, integers -> int64
+# Missing values (empty strings in the csv) are nulls.
+# The schemas are stored in analysis/extract_schemas.json, so the conversion
+# does not need cohortextractor. After changing a study definition, run
+# 'python analysis/extract_schema.py --write-schemas'; the conversion fails if
+# the columns of an extract are not in the schema.
+# usage:
+# python analysis/extract_schema.py --write-schemas
+# python analysis/extract_schema.py <input glob> <study definition> [...]
+# e.g. python analysis/extract_schema.py "output/joined/input_wave*.csv.gz"
+#   study_definition_wave1 study_definition_ethnicity
+
+######################################
+
+# IMPORT STATEMENTS ----
+import glob
+import importlib
+import json
+import sys
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+SCHEMAS_FILE = Path(__file__).parent / "extract_schemas.json"
+# study definitions of which the schema is stored in SCHEMAS_FILE
+STUDY_DEFINITIONS = (
+    "study_definition",
+    "study_definition_ethnicity",
+    "study_definition_wave1",
+    "study_definition_wave2",
+    "study_definition_wave3",
+    "study_definition_wave4",
+    "study_definition_wave5",
+)
+ARROW_TYPES = {
+    "bool": pa.bool_(),
+    "int": pa.int64(),
+    "float": pa.float64(),
+    "date": pa.date32(),
+    "category": pa.dictionary(pa.int32(), pa.string()),
+}
+# suffix completing a (partial) date to YYYY-MM-DD
+DATE_SUFFIXES = {"YYYY-MM-DD": "", "YYYY-MM": "-01", "YYYY": "-01-01"}
+BLOCK_SIZE = 64 << 20
+
+
+# --- SCHEMA ---
+def column_schema(query_type, query_args):
+    """
+    Return (type, date_format) of a column from its processed definition
+    """
+    column_type = query_args["column_type"]
+    if column_type == "str":
+        return "category", None
+    if column_type == "date":
+        return "date", query_args.get("date_format") or "YYYY-MM-DD"
+    return column_type, None
+
+
+def study_schema(study):
+    """
+    Return the schema of the extract of a StudyDefinition as a list of
+    [name, type, date_format]
+    """
+    schema = [["patient_id", "int", None]]
+    for name, (query_type, query_args) in study.covariate_definitions.items():
+        if query_args.get("hidden") or name == "population":
+            continue
+        schema.append([name, *column_schema(query_type, query_args)])
+    return schema
+
+
+def write_schemas(schemas_file=SCHEMAS_FILE):
+    """
+    Write the schemas of STUDY_DEFINITIONS (needs cohortextractor)
+    """
+    schemas = {
+        name: study_schema(importlib.import_module(name).study)
+        for name in STUDY_DEFINITIONS
+    }
+    # (one line per column)
+    lines = [
+        f"  {json.dumps(name)}: [\n"
+        + ",\n".join(f"    {json.dumps(column)}" for column in schema)
+        + "\n  ]"
+        for name, schema in schemas.items()
+    ]
+    with open(schemas_file, "w") as f:
+        f.write("{\n" + ",\n".join(lines) + "\n}\n")
+
+
+def load_schema(study_definitions, schemas_file=SCHEMAS_FILE):
+    """
+    Return dict name -> (type, date_format) for the columns of the extracts
+    of study_definitions (e.g. the extract of a wave joined with ethnicity)
+    """
+    with open(schemas_file, "r") as f:
+        schemas = json.load(f)
+    schema = {}
+    for study_definition in study_definitions:
+        for name, column_type, date_format in schemas[study_definition]:
+            schema[name] = (column_type, date_format)
+    return schema
+
+
+# --- CONVERSION ---
+def convert_column(values, column_type, date_format):
+    """
+    Convert a column of strings (as written by cohortextractor) to its type
+    """
+    missing = pc.equal(values, "")
+    if column_type == "bool":
+        return pc.if_else(missing, None, pc.equal(values, "1"))
+    if column_type == "category":
+        return pc.if_else(missing, None, values).dictionary_encode()
+    values = pc.if_else(missing, None, values)
+    if column_type == "date":
+        suffix = DATE_SUFFIXES[date_format]
+        if suffix:
+            values = pc.binary_join_element_wise(values, suffix, "")
+        return pc.cast(
+            pc.strptime(values, format="%Y-%m-%d", unit="s"), pa.date32()
+        )
+    return pc.cast(values, ARROW_TYPES[column_type])
+
+
+def convert_extract(input_file, output_file, schema):
+    """
+    Stream a csv(.gz) extract into a Parquet file with the types in schema
+    """
+    reader = pv.open_csv(
+        input_file,
+        read_options=pv.ReadOptions(block_size=BLOCK_SIZE),
+        convert_options=pv.ConvertOptions(
+            column_types=pa.schema(
+                [(name, pa.string()) for name in schema]
+            ),
+            strings_can_be_null=False,
+            quoted_strings_can_be_null=False,
+        ),
+    )
+    names = reader.schema.names
+    unknown = [name for name in names if name not in schema]
+    if unknown:
+        raise ValueError(
+            f"Columns {unknown} of {input_file} are not in the schema, run "
+            f"'python analysis/extract_schema.py --write-schemas'"
+        )
+    arrow_schema = pa.schema(
+        [(name, ARROW_TYPES[schema[name][0]]) for name in names]
+    )
+    with pq.ParquetWriter(output_file, arrow_schema, compression="zstd") as writer:
+        for batch in reader:
+            columns = [
+                convert_column(batch.column(name), *schema[name])
+                for name in names
+            ]
+            writer.write_table(
+                pa.Table.from_arrays(columns, schema=arrow_schema)
+            )
+
+
+def parquet_file_name(input_file):
+    name = Path(input_file).name
+    for suffix in (".csv.gz", ".csv"):
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+    return Path(input_file).with_name(f"{name}.parquet")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--write-schemas"]:
+        write_schemas()
+    else:
+        schema = load_schema(sys.argv[2:])
+        for input_file in sorted(glob.glob(sys.argv[1])):
+            convert_extract(input_file, parquet_file_name(input_file), schema)
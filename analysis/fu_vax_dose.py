@@ -0,0 +1,296 @@
+######################################
+
+# This script splits the follow-up of the patients in a wave by vaccine dose
+# (the python version of calc_fu_vax_dose() in analysis/utils/calc_fu_vax_dose.R,
+# with the same rules):
+# - follow-up (fu) starts at the start date of the wave and ends at the date of
+#   death (covid or other cause) or at the end date of the wave
+# - dose k protects from 14 days after covid_vax_date_k; fu_vax_k is the
+#   number of days of follow-up between the start of dose k and the start of
+#   dose k + 1 (fu_vax_0: before the start of the first dose)
+# All patients are split at once: the dates are arrays of days since the start
+# of the wave and every rule is one array operation per dose, so the time is
+# linear in the number of patients. The extract is read in chunks; as in
+# extract_data() in analysis/utils/extract_data.R, only the patients with
+# has_follow_up true are split.
+# Optionally the follow-up is written as an episode-split (long) table for
+# time-varying models: one row per patient and dose with follow-up, with
+# tstart and tstop in days since the start of the wave and the status (see
+# process_data.R: 1 covid death, 2 other death, 0 alive) on the last episode
+# of a patient (0 on the other episodes). A patient without follow-up (died
+# on the start date of the wave) has one episode of length 0 (tstart ==
+# tstop == 0) at the dose protecting on that date, so the death is kept;
+# models that need tstop > tstart have to drop or shift these episodes.
+# Output: output/processed/fu_vax_<wave>.parquet (patient_id, status, fu,
+#   fu_vax_0 ... fu_vax_6) and output/processed/episodes_vax_<wave>.parquet
+#   (patient_id, dose, tstart, tstop, status) with --episodes
+# usage: python analysis/fu_vax_dose.py [--episodes] [wave ...]
+#   (default: all waves in config.json, reading
+#   output/joined/input_<wave>.parquet)
+
+######################################
+
+# IMPORT STATEMENTS ----
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import load_config
+
+INPUT_DIR = Path("output/joined")
+OUTPUT_DIR = Path("output/processed")
+DOSES = 6
+# days between a vaccination and the start of its protection
+TIME_LAG = 14
+CHUNK_SIZE = 1_000_000
+VAX_COLUMNS = [f"covid_vax_date_{dose}" for dose in range(1, DOSES + 1)]
+INPUT_COLUMNS = [
+    "patient_id", *VAX_COLUMNS, "died_ons_covid_any_date", "died_any_date",
+]
+FOLLOW_UP_COLUMN = "has_follow_up"
+# values read as TRUE by col_logical() in R (csv extracts)
+TRUE_VALUES = ("1", "T", "TRUE", "True", "true")
+
+
+# --- DATES ---
+def days_since(dates, start_date):
+    """
+    Return float array days between start_date and dates (NaN if missing)
+    """
+    dates = pd.to_datetime(pd.Series(dates), errors="coerce").to_numpy(
+        "datetime64[D]"
+    )
+    days = (dates - np.datetime64(start_date, "D")).astype(np.float64)
+    days[np.isnat(dates)] = np.nan
+    return days
+
+
+# --- FOLLOW-UP ---
+def follow_up(died_ons_covid, died_any, end):
+    """
+    Return (status, fu): status 1 (covid death), 2 (other death) or 0 and
+    the follow-up in days; died_ons_covid and died_any in days since the
+    start of the wave, end the end of the wave in days since its start
+    """
+    status = np.where(
+        ~np.isnan(died_ons_covid), 1, np.where(~np.isnan(died_any), 2, 0)
+    ).astype(np.int8)
+    fu = np.where(
+        status == 1, died_ons_covid, np.where(status == 2, died_any, end)
+    )
+    return status, fu
+
+
+def dose_indicators(starts, fu):
+    """
+    Return boolean array (patients x doses): has dose k follow-up in the
+    wave; starts is the start of protection of dose 1 ... DOSES in days since
+    the start of the wave (NaN if not given)
+    """
+    given = ~np.isnan(starts)
+    with np.errstate(invalid="ignore"):
+        started = starts <= fu[:, None]
+        # (the next dose starts after the start of the wave, or is not given)
+        next_after_start = np.ones_like(given)
+        next_after_start[:, :-1] = ~given[:, 1:] | (starts[:, 1:] > 0)
+    return given & started & next_after_start
+
+
+def dose_at_end(starts, fu):
+    """
+    Return int array: the dose protecting at the end of the follow-up (0 if
+    none)
+    """
+    indicators = dose_indicators(starts, fu)
+    last = DOSES - np.argmax(indicators[:, ::-1], axis=1)
+    return np.where(indicators.any(axis=1), last, 0)
+
+
+def split_follow_up(starts, fu):
+    """
+    Return float array (patients x doses + 1): fu_vax_0 ... fu_vax_DOSES
+    """
+    indicators = dose_indicators(starts, fu)
+    n_patients = len(fu)
+    fu_vax = np.zeros((n_patients, DOSES + 1))
+    with np.errstate(invalid="ignore"):
+        # before the first dose
+        fu_vax[:, 0] = np.where(
+            ~indicators.any(axis=1),
+            fu,
+            np.where(indicators[:, 0] & (starts[:, 0] > 0), starts[:, 0], 0),
+        )
+        done = fu_vax[:, 0].copy()
+        for dose in range(1, DOSES + 1):
+            indicator = indicators[:, dose - 1]
+            period_start = np.fmax(starts[:, dose - 1], 0)
+            if dose < DOSES:
+                # followed by the next dose, or the rest of the follow-up
+                until_next = np.where(
+                    indicators[:, dose],
+                    starts[:, dose] - period_start,
+                    fu - done,
+                )
+            else:
+                until_next = fu - period_start
+            fu_vax[:, dose] = np.where(indicator, until_next, 0)
+            done += fu_vax[:, dose]
+    return fu_vax
+
+
+def dose_starts(data, start_date):
+    """
+    Return float array (patients x doses): start of protection of dose 1 ...
+    DOSES in days since start_date (NaN if not given)
+    """
+    return np.column_stack(
+        [days_since(data[column], start_date) + TIME_LAG for column in VAX_COLUMNS]
+    )
+
+
+def fu_vax_dose(data, start_date, end_date):
+    """
+    Return data frame patient_id, status, fu, fu_vax_0 ... fu_vax_DOSES of
+    the patients in data (columns INPUT_COLUMNS) in the wave start_date -
+    end_date
+    """
+    status, fu = follow_up(
+        days_since(data["died_ons_covid_any_date"], start_date),
+        days_since(data["died_any_date"], start_date),
+        days_since([end_date], start_date)[0],
+    )
+    fu_vax = split_follow_up(dose_starts(data, start_date), fu)
+    result = pd.DataFrame(
+        {
+            "patient_id": data["patient_id"].to_numpy(np.int64),
+            "status": status,
+            "fu": fu,
+        }
+    )
+    for dose in range(DOSES + 1):
+        result[f"fu_vax_{dose}"] = fu_vax[:, dose]
+    return result
+
+
+# --- EPISODES ---
+def episodes(follow_up, end_dose):
+    """
+    Return the episode-split (long) table of follow_up (output of
+    fu_vax_dose()): one row per patient and dose with follow-up; end_dose is
+    the dose at the end of the follow-up of every patient (dose_at_end()),
+    the episode of the patients without follow-up
+    """
+    fu_vax = follow_up[[f"fu_vax_{dose}" for dose in range(DOSES + 1)]].to_numpy()
+    tstop = np.cumsum(fu_vax, axis=1)
+    tstart = tstop - fu_vax
+    has_fu = fu_vax > 0
+    # (an episode of length 0, that keeps the status of the patient)
+    no_fu = ~has_fu.any(axis=1)
+    has_fu[no_fu, np.asarray(end_dose)[no_fu]] = True
+    # (row major: the episodes of a patient are consecutive, by dose)
+    patient, dose = np.nonzero(has_fu)
+    last_dose = DOSES - np.argmax(has_fu[:, ::-1], axis=1)
+    is_last = dose == last_dose[patient]
+    return pd.DataFrame(
+        {
+            "patient_id": follow_up["patient_id"].to_numpy()[patient],
+            "dose": dose.astype(np.int8),
+            "tstart": tstart[patient, dose],
+            "tstop": tstop[patient, dose],
+            "status": np.where(
+                is_last, follow_up["status"].to_numpy()[patient], 0
+            ).astype(np.int8),
+        }
+    )
+
+
+# --- FILES ---
+def has_follow_up(values):
+    """
+    Return boolean array: is has_follow_up true (missing is false, as in
+    filter(has_follow_up == TRUE))
+    """
+    if pd.api.types.is_bool_dtype(values.dtype):
+        return values.fillna(False).to_numpy(bool)
+    return values.astype(str).isin(TRUE_VALUES).to_numpy()
+
+
+def read_chunks(input_file, chunk_size=CHUNK_SIZE):
+    """
+    Yield the columns INPUT_COLUMNS of the patients with follow-up in
+    input_file (parquet or csv) in chunks
+    """
+    input_file = Path(input_file)
+    columns = [*INPUT_COLUMNS, FOLLOW_UP_COLUMN]
+    if input_file.suffix == ".parquet":
+        parquet_file = pq.ParquetFile(input_file)
+        chunks = (
+            batch.to_pandas()
+            for batch in parquet_file.iter_batches(
+                batch_size=chunk_size, columns=columns
+            )
+        )
+    else:
+        chunks = pd.read_csv(
+            input_file,
+            usecols=columns,
+            dtype={column: str for column in columns[1:]},
+            chunksize=chunk_size,
+        )
+    for chunk in chunks:
+        yield chunk[has_follow_up(chunk[FOLLOW_UP_COLUMN])][INPUT_COLUMNS]
+
+
+def split_wave(input_file, start_date, end_date, output_file,
+               episodes_file=None):
+    """
+    Split the follow-up of the patients in input_file and write it to
+    output_file (and the episodes to episodes_file)
+    """
+    writers = {}
+
+    def write(chunk):
+        tables = {output_file: fu_vax_dose(chunk, start_date, end_date)}
+        if episodes_file is not None:
+            end_dose = dose_at_end(
+                dose_starts(chunk, start_date), tables[output_file]["fu"].to_numpy()
+            )
+            tables[episodes_file] = episodes(tables[output_file], end_dose)
+        for file_name, table in tables.items():
+            table = pa.Table.from_pandas(table, preserve_index=False)
+            if file_name not in writers:
+                writers[file_name] = pq.ParquetWriter(file_name, table.schema)
+            writers[file_name].write_table(table)
+
+    try:
+        for chunk in read_chunks(input_file):
+            write(chunk)
+        if not writers:
+            # (an empty extract gives files without rows)
+            empty = {column: pd.Series(dtype=str) for column in INPUT_COLUMNS}
+            empty["patient_id"] = pd.Series(dtype=np.int64)
+            write(pd.DataFrame(empty))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    with_episodes = "--episodes" in arguments
+    config = load_config()
+    waves = [a for a in arguments if a != "--episodes"] or list(config.waves)
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    for wave in waves:
+        start_date, end_date = config.wave_dates(wave)
+        split_wave(
+            INPUT_DIR / f"input_{wave}.parquet",
+            start_date,
+            end_date,
+            OUTPUT_DIR / f"fu_vax_{wave}.parquet",
+            OUTPUT_DIR / f"episodes_vax_{wave}.parquet" if with_episodes else None,
+        )
@@ -0,0 +1,434 @@
+######################################
+
+# Incremental month-over-month extraction of study_definition.py.
+# Instead of extracting all variables at every monthly index date, the
+# variables are extracted in full once (at the first index date, action
+# generate_study_population_incremental_base) and for every later index date
+# only the events in the window (previous index date, index date] are
+# extracted (action generate_study_population_incremental_delta). This script
+# carries the per patient state forward month by month:
+# - constant: does not depend on the index date (e.g. sex); taken from the
+#   first extract
+# - any: binary flag of an event on or before the index date (e.g. ever
+#   diagnosed comorbidities); previous flag OR flag in window
+# - first / last: date of first / last event on or before the index date
+# - latest: last recorded value on or before the index date (e.g. most recent
+#   smoking code, blood pressure); replaced if there is a value in the window
+# - nth: chain of dates of the first, second, ... event (vaccine doses);
+#   previous dates merged with the dates in the window
+# - recomputed: variables with a lookback window or a value 'as of' the index
+#   date (e.g. age, bmi, hba1c, stp); extracted again at every index date
+# - derived: categorised_as() and satisfying() variables (incl. population);
+#   evaluated here after the roll forward (see expressions.py)
+# Both extractions use a population of all patients registered at any of the
+# monthly index dates, the population of study_definition.py is applied
+# here. The result is written as output/incremental/input_<index date>.csv.gz
+# with the same columns as the extracts of study_definition.py.
+# The classification of the variables is stored in
+# analysis/incremental_plan.json, so the roll forward does not need
+# cohortextractor. After changing study_definition.py, run
+# 'python analysis/incremental_extraction.py --write-plan'; the incremental
+# study definitions fail if the plan is out of date.
+# usage: python analysis/incremental_extraction.py [--write-plan]
+
+######################################
+
+# IMPORT STATEMENTS ----
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from definition_utils import (
+    companion_base,
+    flatten_definitions,
+    index_date_dependent_columns,
+    is_iso_date,
+    parse_date_expression,
+    referenced_columns,
+)
+from expressions import evaluate_categories, is_empty
+
+PLAN_FILE = Path(__file__).parent / "incremental_plan.json"
+OUTPUT_DIR = Path("output/incremental")
+BASE_FILE = OUTPUT_DIR / "input_incremental_base.csv.gz"
+DELTA_PATTERN = "input_incremental_delta_{index_date}.csv.gz"
+OUTPUT_PATTERN = "input_{index_date}.csv.gz"
+# window of the delta extracts: (previous index date, index date]; the
+# previous index date itself is included, which is harmless as every roll
+# forward operation is idempotent
+DELTA_WINDOW = ["index_date - 1 month", "index_date"]
+CUMULATIVE_PERIOD = (None, "index_date")
+
+# kinds of variables
+CONSTANT = "constant"
+ANY = "any"
+FIRST = "first"
+LAST = "last"
+LATEST = "latest"
+NTH = "nth"
+RECOMPUTED = "recomputed"
+DERIVED = "derived"
+# kinds of variables extracted in the delta extracts
+DELTA_KINDS = (ANY, FIRST, LAST, LATEST, NTH, RECOMPUTED)
+
+
+# --- CLASSIFICATION ---
+def is_cumulative(query_args):
+    """
+    Is the period of a definition 'on or before the index date'?
+    """
+    between = query_args.get("between")
+    return between is not None and tuple(between) == CUMULATIVE_PERIOD
+
+
+def chain_start(query_args, kinds):
+    """
+    Return the start of the period of a definition that is part of a chain
+    of 'nth' dates (an ISO date for the first date of the chain, the name of
+    the previous date otherwise); None if the definition is not part of a
+    chain
+    """
+    between = query_args.get("between")
+    if (
+        query_args.get("returning") != "date"
+        or not query_args.get("find_first_match_in_period")
+        or between is None
+        or len(between) != 2
+        or between[1] != "index_date"
+    ):
+        return None
+    if is_iso_date(between[0]):
+        return between[0]
+    parts = parse_date_expression(between[0])
+    if (
+        parts
+        and kinds.get(parts["name"]) == NTH
+        and (parts["operator"], parts["quantity"], parts["units"])
+        == ("+", "1", "day")
+    ):
+        return parts["name"]
+    return None
+
+
+def classify_variable(name, query_type, query_args, dependent, kinds):
+    if query_type == "categorised_as":
+        return DERIVED
+    if name not in dependent:
+        return CONSTANT
+    if chain_start(query_args, kinds) is not None:
+        return NTH
+    if is_cumulative(query_args):
+        returning = query_args.get("returning")
+        if returning == "binary_flag":
+            return ANY
+        if returning == "date" and query_args.get("find_first_match_in_period"):
+            return FIRST
+        if returning == "date" and query_args.get("find_last_match_in_period"):
+            return LAST
+        if returning in ("category", "numeric_value") and query_args.get(
+            "find_last_match_in_period"
+        ):
+            return LATEST
+        if query_args.get("on_most_recent_day_of_measurement"):
+            return LATEST
+    return RECOMPUTED
+
+
+def classify_variables(variables):
+    """
+    Return dict name -> kind for the (flattened) variables of a study
+    definition
+    """
+    flattened = flatten_definitions(variables)
+    dependent = index_date_dependent_columns(variables)
+    kinds = {}
+    for name, (query_type, query_args, hidden) in flattened.items():
+        kinds[name] = classify_variable(
+            name, query_type, query_args, dependent, kinds
+        )
+    # recomputed variables are extracted from scratch at every index date,
+    # so may only refer to columns that are extracted in the delta too
+    for name, kind in kinds.items():
+        if kind != RECOMPUTED:
+            continue
+        query_type, query_args, hidden = flattened[name]
+        for column in referenced_columns(query_type, query_args):
+            base = column if column in kinds else companion_base(column)[0]
+            if kinds.get(base) != RECOMPUTED:
+                raise ValueError(
+                    f"Variable '{name}' refers to '{column}' and cannot be "
+                    f"extracted incrementally"
+                )
+    return kinds
+
+
+# --- PLAN ---
+def build_plan(variables, covariate_definitions, index_dates):
+    """
+    Return the plan of the roll forward (json serialisable) for the variables
+    of a study definition; covariate_definitions are the processed
+    definitions of the study definition (study.covariate_definitions), these
+    hold the column type of every column incl. companion columns
+    """
+    kinds = classify_variables(variables)
+    flattened = flatten_definitions(variables)
+    columns = {}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if name in kinds:
+            column = {"kind": kinds[name]}
+        else:
+            # companion column (e.g. '<name>_date' of include_date_of_match)
+            source = query_args["source"]
+            kind = kinds[source]
+            if kind == ANY:
+                source_args = flattened[source][1]
+                kind = FIRST if source_args.get("find_first_match_in_period") else LAST
+            column = {"kind": kind, "source": source}
+        column["type"] = query_args["column_type"]
+        column["hidden"] = bool(query_args.get("hidden"))
+        if column["kind"] == NTH:
+            column["start"] = chain_start(flattened[name][1], kinds)
+        if column["kind"] == DERIVED:
+            column["categories"] = [
+                [category, expression]
+                for category, expression in query_args[
+                    "category_definitions"
+                ].items()
+            ]
+        columns[name] = column
+    return {
+        "index_dates": [index_date.isoformat() for index_date in index_dates],
+        "columns": columns,
+        "output_columns": [
+            name
+            for name, column in columns.items()
+            if not column["hidden"] and name != "population"
+        ],
+    }
+
+
+def load_plan(plan_file=PLAN_FILE):
+    with open(plan_file, "r") as f:
+        return json.load(f)
+
+
+def check_plan(plan, plan_file=PLAN_FILE):
+    """
+    Raise if the stored plan is not the plan of the current study definition
+    """
+    # (round trip through json, categories are stored as lists)
+    if json.loads(json.dumps(plan)) != load_plan(plan_file):
+        raise ValueError(
+            f"{plan_file} is out of date, run "
+            f"'python analysis/incremental_extraction.py --write-plan'"
+        )
+
+
+def write_plan(plan_file=PLAN_FILE):
+    """
+    Write the plan of study_definition.py (needs cohortextractor)
+    """
+    import study_definition
+    plan = build_plan(
+        study_definition.variables,
+        study_definition.study.covariate_definitions,
+        study_definition.config.month_index_dates,
+    )
+    with open(plan_file, "w") as f:
+        json.dump(plan, f, indent=2)
+        f.write("\n")
+
+
+# --- STUDY DEFINITIONS ---
+def universe_population(index_dates):
+    """
+    Population of the incremental extracts: registered at any index date
+    """
+    from cohortextractor import patients
+    registered = {
+        f"registered_{index_date:%Y%m%d}": patients.registered_as_of(
+            index_date.isoformat()
+        )
+        for index_date in index_dates
+    }
+    return patients.satisfying(" OR ".join(registered), **registered)
+
+
+def incremental_variables(variables, delta):
+    """
+    Variables of the first (delta=False) or the delta (delta=True) extracts:
+    all variables (incl. hidden) that are not derived as visible columns;
+    in the delta extracts only the variables that change, with the period of
+    cumulative variables restricted to DELTA_WINDOW
+    """
+    kinds = classify_variables(variables)
+    result = {}
+    for name, (query_type, query_args, hidden) in flatten_definitions(
+        variables
+    ).items():
+        kind = kinds[name]
+        if kind == DERIVED or (delta and kind not in DELTA_KINDS):
+            continue
+        if delta and (kind in (ANY, FIRST, LAST, LATEST) or (
+            kind == NTH and is_iso_date(chain_start(query_args, kinds))
+        )):
+            query_args = dict(query_args, between=list(DELTA_WINDOW))
+        result[name] = (query_type, query_args)
+    return result
+
+
+# --- ROLL FORWARD ---
+def read_extract(path, columns):
+    """
+    Read an extract with the column types of the plan: bool and int columns
+    as integers, float columns as floats and other columns as strings ('' if
+    missing)
+    """
+    data = pd.read_csv(path, dtype=str, keep_default_na=False)
+    data = data.set_index("patient_id")
+    for name in data.columns:
+        column_type = columns.get(name, {}).get("type")
+        if column_type in ("bool", "int"):
+            data[name] = pd.to_numeric(data[name].replace("", "0")).astype("int64")
+        elif column_type == "float":
+            data[name] = pd.to_numeric(data[name].replace("", "0")).astype("float64")
+    return data
+
+
+def companions(columns, name):
+    return [
+        companion
+        for companion, column in columns.items()
+        if column.get("source") == name
+    ]
+
+
+def merge_chain(state, delta, chain, start):
+    """
+    Merge the dates of a chain ('nth' dates, in order) in state with the dates
+    in delta: the distinct dates on or after start, sorted, first
+    len(chain) of them
+    """
+    dates = np.concatenate(
+        [state[chain].to_numpy(dtype=object), delta[chain].to_numpy(dtype=object)],
+        axis=1,
+    ).astype(str)
+    dates = np.where((dates == "") | (dates < start), "~", dates)
+    dates.sort(axis=1)
+    # blank out repeated dates and sort again
+    repeated = np.zeros(dates.shape, dtype=bool)
+    repeated[:, 1:] = dates[:, 1:] == dates[:, :-1]
+    dates[repeated] = "~"
+    dates.sort(axis=1)
+    dates = dates[:, : len(chain)]
+    dates[dates == "~"] = ""
+    return pd.DataFrame(dates, index=state.index, columns=chain)
+
+
+def roll_forward(state, delta, columns):
+    """
+    Return the state at the next index date from the state at the previous
+    index date and the delta extract of the next index date
+    """
+    state = state.copy()
+    delta = delta.reindex(state.index)
+    for name, column in columns.items():
+        kind = column["kind"]
+        if "source" in column or kind in (CONSTANT, DERIVED, NTH):
+            continue
+        if kind == RECOMPUTED:
+            state[name] = delta[name]
+            for companion in companions(columns, name):
+                state[companion] = delta[companion]
+        elif kind == ANY:
+            new = ~is_empty(delta[name])
+            for companion in companions(columns, name):
+                if columns[companion]["kind"] == FIRST:
+                    replace = new & is_empty(state[name])
+                else:
+                    replace = new
+                state.loc[replace, companion] = delta.loc[replace, companion]
+            state[name] = np.where(new, 1, state[name])
+        elif kind in (FIRST, LAST, LATEST):
+            # a value is present if its (first) companion date is not empty
+            present_in = (companions(columns, name) or [name])[0]
+            replace = ~is_empty(delta[present_in])
+            if kind == FIRST:
+                replace &= is_empty(state[name])
+            for replaced in [name] + companions(columns, name):
+                state.loc[replace, replaced] = delta.loc[replace, replaced]
+    for chain in group_chains(columns):
+        start = columns[chain[0]]["start"]
+        state[chain] = merge_chain(state, delta, chain, start)
+    return state
+
+
+def group_chains(columns):
+    """
+    Return the chains of nth dates as lists of names (in order)
+    """
+    chains = []
+    for name, column in columns.items():
+        if column["kind"] != NTH:
+            continue
+        if column["start"] in columns:
+            for chain in chains:
+                if chain[-1] == column["start"]:
+                    chain.append(name)
+        else:
+            chains.append([name])
+    return chains
+
+
+def evaluate_derived(state, columns):
+    """
+    Add the derived variables to (a copy of) state, in order of the plan
+    """
+    data = state.copy()
+    for name, column in columns.items():
+        if column["kind"] != DERIVED:
+            continue
+        categories = dict(column["categories"])
+        values = evaluate_categories(categories, data)
+        if column["type"] in ("bool", "int"):
+            data[name] = values.astype("int64")
+        else:
+            data[name] = values.astype(str)
+    return data
+
+
+def write_output(state, plan, index_date, output_dir=OUTPUT_DIR):
+    data = evaluate_derived(state, plan["columns"])
+    data = data.loc[data["population"] == 1, plan["output_columns"]]
+    data.to_csv(
+        Path(output_dir) / OUTPUT_PATTERN.format(index_date=index_date),
+        compression={"method": "gzip"},
+    )
+
+
+def run(plan, base_file=BASE_FILE, output_dir=OUTPUT_DIR):
+    """
+    Roll the first extract forward over all index dates of the plan and
+    write one extract per index date
+    """
+    columns = plan["columns"]
+    index_dates = plan["index_dates"]
+    state = read_extract(base_file, columns)
+    write_output(state, plan, index_dates[0], output_dir)
+    for index_date in index_dates[1:]:
+        delta = read_extract(
+            Path(output_dir) / DELTA_PATTERN.format(index_date=index_date),
+            columns,
+        )
+        state = roll_forward(state, delta, columns)
+        write_output(state, plan, index_date, output_dir)
+
+
+if __name__ == "__main__":
+    if "--write-plan" in sys.argv[1:]:
+        write_plan()
+    else:
+        run(load_plan())
@@ -0,0 +1,146 @@
+######################################
+
+# This script joins the columns of one extract (rhs, e.g. ethnicity) to
+# several other extracts (lhs, e.g. the monthly extracts) on patient_id, as
+# cohort-joiner does (left join, missing values are empty):
+# - the rhs is read once into a lookup table sorted by patient_id: one row per
+#   patient of the rhs with its patient_id and, per rhs column, the code of
+#   its value. The table is a memory-mapped .npy file, the values of the codes
+#   are kept in memory
+# - every lhs extract is streamed in chunks; the rhs columns of a chunk are
+#   looked up with a binary search of the patient_ids of the chunk in the
+#   table (patients that are not in the rhs get empty values)
+# The output files have the name of the lhs files and are written to
+# output_dir.
+# usage: python analysis/join_cohorts.py <lhs glob> [rhs] [output_dir]
+# e.g. python analysis/join_cohorts.py "output/input_202*.csv.gz"
+#   output/input_ethnicity.csv.gz output/joined
+
+######################################
+
+# IMPORT STATEMENTS ----
+import glob
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+CHUNK_SIZE = 500_000
+NOT_IN_RHS = -1
+
+
+# --- LOOKUP ---
+class Lookup:
+    """
+    Table of the rhs (memory-mapped): patient_ids (sorted) and codes of the
+    rhs columns
+    """
+
+    def __init__(self, table, columns, categories):
+        self.table = table
+        self.columns = columns
+        self.categories = categories
+
+    def values(self, patient_ids):
+        """
+        Return dict column -> values (object array, '' if not in the rhs) of
+        patient_ids
+        """
+        rhs_ids = self.table["patient_id"]
+        positions = np.searchsorted(rhs_ids, patient_ids)
+        in_rhs = positions < len(rhs_ids)
+        in_rhs[in_rhs] = rhs_ids[positions[in_rhs]] == patient_ids[in_rhs]
+        rows = np.full((len(patient_ids), len(self.columns)), NOT_IN_RHS,
+                       dtype=np.int16)
+        rows[in_rhs] = self.table["codes"][positions[in_rhs]]
+        result = {}
+        for index, column in enumerate(self.columns):
+            # categories extended with '' at position -1
+            categories = np.append(self.categories[index], "").astype(object)
+            result[column] = categories[rows[:, index]]
+        return result
+
+
+def read_rhs(rhs_file):
+    rhs = pd.read_csv(rhs_file, dtype=str, keep_default_na=False)
+    if rhs["patient_id"].duplicated().any():
+        raise ValueError(f"patient_id is not unique in {rhs_file}")
+    return rhs
+
+
+def build_lookup(rhs_file, lookup_file):
+    """
+    Read rhs_file once and write the lookup table to lookup_file
+    """
+    rhs = read_rhs(rhs_file)
+    patient_ids = rhs["patient_id"].astype(np.int64).to_numpy()
+    order = np.argsort(patient_ids, kind="stable")
+    columns = [column for column in rhs.columns if column != "patient_id"]
+    dtype = np.dtype(
+        [("patient_id", np.int64), ("codes", np.int16, (len(columns),))]
+    )
+    if len(rhs) == 0:
+        # (an empty file cannot be memory-mapped)
+        return Lookup(np.zeros(0, dtype=dtype), columns, [
+            np.array([], dtype=object) for _ in columns
+        ])
+    table = np.lib.format.open_memmap(
+        lookup_file, mode="w+", dtype=dtype, shape=(len(rhs),)
+    )
+    table["patient_id"] = patient_ids[order]
+    categories = []
+    for index, column in enumerate(columns):
+        column_codes, column_categories = pd.factorize(rhs[column])
+        if len(column_categories) > np.iinfo(np.int16).max:
+            raise ValueError(f"Too many values in column {column} of {rhs_file}")
+        table["codes"][:, index] = column_codes[order]
+        categories.append(np.asarray(column_categories, dtype=object))
+    table.flush()
+    del table
+    return Lookup(np.load(lookup_file, mmap_mode="r"), columns, categories)
+
+
+# --- JOIN ---
+def join_extract(lookup, lhs_file, output_file):
+    """
+    Stream lhs_file in chunks and write it with the rhs columns to
+    output_file
+    """
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    reader = pd.read_csv(lhs_file, chunksize=CHUNK_SIZE, dtype=str,
+                         keep_default_na=False)
+    for chunk_number, chunk in enumerate(reader):
+        patient_ids = chunk["patient_id"].astype(np.int64).to_numpy()
+        for column, values in lookup.values(patient_ids).items():
+            chunk[column] = values
+        chunk.to_csv(
+            output_file,
+            mode="w" if chunk_number == 0 else "a",
+            header=chunk_number == 0,
+            index=False,
+            compression={"method": "gzip"} if output_file.suffix == ".gz" else None,
+        )
+
+
+def join_cohorts(lhs_pattern, rhs_file, output_dir):
+    lhs_files = [
+        lhs_file for lhs_file in sorted(glob.glob(lhs_pattern))
+        if Path(lhs_file).resolve() != Path(rhs_file).resolve()
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        lookup = build_lookup(rhs_file, Path(tmp_dir) / "lookup.npy")
+        for lhs_file in lhs_files:
+            join_extract(lookup, lhs_file, Path(output_dir) / Path(lhs_file).name)
+        del lookup
+
+
+if __name__ == "__main__":
+    lhs_pattern = sys.argv[1]
+    rhs_file = (
+        sys.argv[2] if len(sys.argv) > 2 else "output/input_ethnicity.csv.gz"
+    )
+    output_dir = sys.argv[3] if len(sys.argv) > 3 else "output/joined"
+    join_cohorts(lhs_pattern, rhs_file, output_dir)
@@ -0,0 +1,272 @@
+######################################
+
+# This script estimates Kaplan-Meier curves of covid death (status 1; other
+# deaths and the end of the wave are censorings) from aggregated event-time
+# tables instead of the patient-level data (as survfit() in
+# analysis/waves_kaplan_meier.R):
+# - the processed data of a wave is streamed in batches and reduced to one
+#   event-time table per stratification: per stratum (combination of levels of
+#   the stratification columns) and day of follow-up the number of deaths
+#   (n_event), censorings (n_censor) and entries (n_enter, all patients enter
+#   at day 0 of the wave); the tables of all stratifications are filled in the
+#   same pass and memory is bounded by days x strata
+# - a table can be collapsed to a coarser stratification (e.g. sex from sex
+#   and agegroup) by summing over the other columns, see collapse()
+# - the counts are rounded before the curves are calculated: per stratum the
+#   number of patients and the cumulative numbers of deaths and censorings
+#   are rounded to the midpoint of a multiple of ROUNDING (1 - 6 -> 3, 7 - 12
+#   -> 9, 0 stays 0; roundmid_any() of the OpenSAFELY Kaplan-Meier action)
+#   and the counts per day are their differences, so no count, number at
+#   risk or step of a curve reveals a small number
+# - the curves are calculated from the (rounded) tables: number at risk,
+#   survival, standard error of the cumulative hazard (Greenwood) and a 95%
+#   confidence interval on the log scale (the defaults of survfit())
+# The stratifications are agegroup within sex (the curves of
+# waves_kaplan_meier.R) and every subgroup in config.json. Patients with a
+# missing stratum are left out of the curves of that stratification.
+# Input: output/processed/input_<wave>.parquet (written by data_process.R)
+# Output: output/kaplan_meier/events/<wave>_<stratification>.csv (event-time
+#   tables, not rounded) and output/kaplan_meier/<wave>_<stratification>.csv
+#   (curves of the rounded tables), stratification e.g. 'sex_agegroup'
+# usage: python analysis/kaplan_meier.py [wave ...]
+#   (default: all waves in config.json)
+
+######################################
+
+# IMPORT STATEMENTS ----
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from config import load_config
+
+INPUT_PATTERN = "output/processed/input_{wave}.parquet"
+OUTPUT_DIR = Path("output/kaplan_meier")
+EVENTS_DIR = OUTPUT_DIR / "events"
+TIME_COLUMN = "fu"
+STATUS_COLUMN = "status"
+COVID_DEATH = "1"
+COUNTS = ["n_event", "n_censor", "n_enter"]
+# 97.5% quantile of the standard normal distribution (95% CI)
+Z = 1.959963984540054
+BATCH_SIZE = 1_000_000
+ROUNDING = 6
+
+
+def stratifications(config):
+    """
+    Return list of lists of stratification columns
+    """
+    return [["sex", "agegroup"], *([subgroup] for subgroup in config.subgroups)]
+
+
+def stratification_name(strata):
+    return "_".join(strata)
+
+
+# --- EVENT-TIME TABLES ---
+def event_table(data, strata):
+    """
+    Return the event-time table (strata, time, n_event, n_censor, n_enter)
+    of the patients in data
+    """
+    data = data.dropna(subset=[*strata, TIME_COLUMN])
+    time = data[TIME_COLUMN].to_numpy(np.float64)
+    event = (data[STATUS_COLUMN].astype(str) == COVID_DEATH).to_numpy()
+    exits = pd.DataFrame(
+        {
+            **{column: data[column].astype(str).to_numpy() for column in strata},
+            "time": time,
+            "n_event": event.astype(np.int64),
+            "n_censor": (~event).astype(np.int64),
+            "n_enter": 0,
+        }
+    )
+    entries = exits[strata].assign(time=0.0, n_event=0, n_censor=0, n_enter=1)
+    return sum_table(pd.concat([exits, entries], ignore_index=True), strata)
+
+
+def sum_table(table, strata):
+    """
+    Sum the counts of table per stratum and time
+    """
+    return (
+        table.groupby([*strata, "time"], sort=False)[COUNTS]
+        .sum()
+        .reset_index()
+    )
+
+
+def event_tables(input_file, all_strata, batch_size=BATCH_SIZE):
+    """
+    Stream input_file in batches and return dict stratification name ->
+    event-time table; the strata are sorted by the order of the levels (as
+    factors in the processed data) and time
+    """
+    columns = list(dict.fromkeys(
+        [TIME_COLUMN, STATUS_COLUMN, *(c for strata in all_strata for c in strata)]
+    ))
+    tables = {stratification_name(strata): None for strata in all_strata}
+    # column -> levels in order of the factor (first batch they appear in)
+    levels = {}
+    parquet_file = pq.ParquetFile(input_file)
+    strata_columns = columns[2:]
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        data = batch.to_pandas()
+        for column in strata_columns:
+            if isinstance(data[column].dtype, pd.CategoricalDtype):
+                categories = data[column].cat.categories.astype(str)
+            else:
+                categories = np.sort(data[column].dropna().unique()).astype(str)
+            levels[column] = list(
+                dict.fromkeys([*levels.get(column, []), *categories])
+            )
+        for strata in all_strata:
+            name = stratification_name(strata)
+            table = event_table(data, strata)
+            if tables[name] is not None:
+                table = sum_table(pd.concat([tables[name], table]), strata)
+            tables[name] = table
+    for strata in all_strata:
+        name = stratification_name(strata)
+        if tables[name] is None:
+            tables[name] = pd.DataFrame(columns=[*strata, "time", *COUNTS])
+        tables[name] = sort_table(tables[name], strata, levels)
+    return tables
+
+
+def sort_table(table, strata, levels):
+    """
+    Sort table by the levels of the strata and time
+    """
+    order = [
+        table[column].map(
+            {level: i for i, level in enumerate(levels.get(column, []))}
+        )
+        for column in strata
+    ]
+    keys = pd.DataFrame({f"key{i}": key for i, key in enumerate(order)})
+    keys["time"] = table["time"].to_numpy()
+    index = keys.sort_values(list(keys.columns), kind="stable").index
+    return table.loc[index].reset_index(drop=True)
+
+
+def sort_by_time(table, strata):
+    """
+    Sort table by time within strata (strata in the order they appear in)
+    """
+    keys = pd.DataFrame({"time": table["time"].to_numpy()}, index=table.index)
+    keys.insert(
+        0, "stratum", table.groupby(strata, sort=False).ngroup() if strata else 0
+    )
+    index = keys.sort_values(["stratum", "time"], kind="stable").index
+    return table.loc[index].reset_index(drop=True)
+
+
+def collapse(table, strata):
+    """
+    Return the event-time table of the stratification strata (a subset of the
+    stratification of table)
+    """
+    return sort_by_time(sum_table(table, strata), strata)
+
+
+def cumsum_by(table, strata, values):
+    """
+    Cumulative sum of values (in the order of the rows of table) per stratum
+    """
+    values = pd.Series(np.asarray(values), index=table.index)
+    if strata:
+        values = values.groupby([table[column] for column in strata], sort=False)
+    return values.cumsum().to_numpy()
+
+
+# --- ROUNDING ---
+def round_mid(values, accuracy=ROUNDING):
+    """
+    Round up to a multiple of accuracy, minus half of accuracy (0 stays 0)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(
+        values > 0, np.ceil(values / accuracy) * accuracy - accuracy // 2, 0
+    ).astype(np.int64)
+
+
+def round_table(table, strata, accuracy=ROUNDING):
+    """
+    Return table with the cumulative counts per stratum rounded by
+    round_mid() and the counts per time their differences
+    """
+    table = sort_by_time(table, strata)
+    rounded = table.copy()
+    for column in COUNTS:
+        cumulative = round_mid(cumsum_by(table, strata, table[column]), accuracy)
+        previous = pd.Series(cumulative, index=table.index)
+        if strata:
+            previous = previous.groupby(
+                [table[c] for c in strata], sort=False
+            ).shift(1, fill_value=0)
+        else:
+            previous = previous.shift(1, fill_value=0)
+        rounded[column] = cumulative - previous.to_numpy()
+    return rounded
+
+
+# --- KAPLAN-MEIER ---
+def kaplan_meier(table, strata):
+    """
+    Return the Kaplan-Meier curves of the strata of table: one row per
+    stratum and time with an event or censoring (strata, time, n_risk,
+    n_event, n_censor, surv, std_err, lower, upper)
+    """
+    table = sort_by_time(table, strata)
+
+    def cumsum(values):
+        return cumsum_by(table, strata, values)
+
+    exits = (table["n_event"] + table["n_censor"]).to_numpy()
+    # at risk at time t: entered up to t, minus exits before t (rounded
+    # counts can exceed the rounded number of patients at the end of a
+    # curve: at risk is then 0 and survival 0)
+    n_risk = np.maximum(cumsum(table["n_enter"]) - (cumsum(exits) - exits), 0)
+    n_event = table["n_event"].to_numpy(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_surv = np.where(
+            n_event > 0, np.log1p(-np.minimum(n_event / n_risk, 1)), 0
+        )
+        greenwood = np.where(
+            n_event > 0, n_event / (n_risk * (n_risk - n_event)), 0
+        )
+    curves = table[[*strata, "time"]].assign(
+        n_risk=n_risk,
+        n_event=table["n_event"].to_numpy(),
+        n_censor=table["n_censor"].to_numpy(),
+    )
+    surv = np.exp(cumsum(log_surv))
+    std_err = np.sqrt(cumsum(greenwood))
+    with np.errstate(invalid="ignore"):
+        curves["surv"] = surv
+        curves["std_err"] = std_err
+        curves["lower"] = surv * np.exp(-Z * std_err)
+        curves["upper"] = np.minimum(surv * np.exp(Z * std_err), 1)
+    return curves[(curves["n_event"] > 0) | (curves["n_censor"] > 0)].reset_index(
+        drop=True
+    )
+
+
+if __name__ == "__main__":
+    config = load_config()
+    waves = sys.argv[1:] or list(config.waves)
+    all_strata = stratifications(config)
+    EVENTS_DIR.mkdir(parents=True, exist_ok=True)
+    for wave in waves:
+        tables = event_tables(INPUT_PATTERN.format(wave=wave), all_strata)
+        for strata in all_strata:
+            name = stratification_name(strata)
+            tables[name].to_csv(EVENTS_DIR / f"{wave}_{name}.csv", index=False)
+            kaplan_meier(round_table(tables[name], strata), strata).to_csv(
+                OUTPUT_DIR / f"{wave}_{name}.csv", index=False
+            )
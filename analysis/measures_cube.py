@@ -0,0 +1,167 @@
+######################################
+
+# This script calculates the mortality rates of the extracts of
+# study_definition.py (crude, age, sex and per demographic/comorbidity) in a
+# single pass over each monthly extract, instead of one group by per measure
+# (cohortextractor generate_measures with a Measure per rate):
+# - every monthly extract is read once (only the columns used by a measure)
+# - derived group by columns (ckd_rrt, see derived_variables.py) are added to
+#   the extract after reading it, from the columns they are calculated from;
+#   a missing value of a derived column is written as level NA (as write_csv()
+#   in R wrote it), a missing value of an extracted column as an empty level
+#   (as the measures framework)
+# - the group by columns are encoded as integer codes once; the number of
+#   deaths and the population size of all measures are then accumulated with
+#   np.bincount() on the combined codes
+# The output is the same as the output of the measures framework:
+# output/joined/measure_<id>.csv with columns group by columns (all
+# combinations of their levels), numerator, denominator, value and date.
+# usage: python analysis/measures_cube.py [input_dir] [output_dir]
+
+######################################
+
+# IMPORT STATEMENTS ----
+import re
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from config import load_config
+from derived_variables import (
+    DERIVED_VARIABLES,
+    add_derived_variables,
+    input_columns,
+)
+
+NUMERATOR = "died_ons_covid_flag_any"
+DENOMINATOR = "population"
+MISSING_DERIVED_LEVEL = "NA"
+INPUT_FILE_REGEX = re.compile(
+    r"^input_(?P<date>\d{4}-\d{2}-\d{2})\.(csv|csv\.gz|parquet)$"
+)
+
+
+# --- MEASURES ---
+def measure_group_bys(config):
+    """
+    Return list of (measure id, group by columns) of the mortality rates
+    """
+    group_bys = [
+        # crude mortality rate
+        ("crude_mortality_rate", [DENOMINATOR]),
+        # rates in age groups (for females and males seperately)
+        ("age_mortality_rate", ["sex", "agegroup"]),
+        # rates in females/males
+        ("sex_mortality_rate", ["agegroup_std", "sex"]),
+    ]
+    for subgroup in config.subgroups:
+        group_bys.append(
+            (f"{subgroup}_mortality_rate", ["agegroup_std", "sex", subgroup])
+        )
+    return group_bys
+
+
+# --- CALCULATION ---
+def read_extract(path, columns):
+    """
+    Read the columns of an extract needed for the measures (derived columns
+    are calculated from the columns they need); group by columns as
+    categoricals (levels sorted, as in the measures framework)
+    """
+    path = str(path)
+    extracted = input_columns(columns)
+    if path.endswith(".parquet"):
+        data = pd.read_parquet(path, columns=[NUMERATOR, *extracted])
+        data[NUMERATOR] = data[NUMERATOR].astype("float64").fillna(0)
+    else:
+        data = pd.read_csv(
+            path,
+            usecols=[NUMERATOR, *extracted],
+            dtype=str,
+            keep_default_na=False,
+        )
+        data[NUMERATOR] = pd.to_numeric(
+            data[NUMERATOR].replace("", "0")
+        ).astype("float64")
+    data = add_derived_variables(data, columns)
+    for column in columns:
+        missing = MISSING_DERIVED_LEVEL if column in DERIVED_VARIABLES else ""
+        data[column] = data[column].astype(object).fillna(missing).astype(str)
+        data[column] = data[column].astype("category")
+    return data
+
+
+def calculate_measures(data, group_bys):
+    """
+    Return dict measure id -> data frame with the numerator and denominator
+    for all combinations of the levels of the group by columns
+    """
+    numerator = data[NUMERATOR].to_numpy()
+    codes = {}
+    levels = {}
+    for column in {c for _, group_by in group_bys for c in group_by}:
+        if column == DENOMINATOR:
+            continue
+        codes[column] = data[column].cat.codes.to_numpy()
+        levels[column] = data[column].cat.categories
+    results = {}
+    for measure_id, group_by in group_bys:
+        if group_by == [DENOMINATOR]:
+            result = pd.DataFrame(
+                {NUMERATOR: [numerator.sum()], DENOMINATOR: [len(data)]}
+            )
+        else:
+            shape = tuple(len(levels[column]) for column in group_by)
+            key = np.ravel_multi_index([codes[column] for column in group_by], shape)
+            size = int(np.prod(shape))
+            result = pd.DataFrame(
+                {
+                    column: levels[column][index]
+                    for column, index in zip(
+                        group_by, np.unravel_index(np.arange(size), shape)
+                    )
+                }
+            )
+            result[NUMERATOR] = np.bincount(key, weights=numerator, minlength=size)
+            result[DENOMINATOR] = np.bincount(key, minlength=size)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result["value"] = result[NUMERATOR] / result[DENOMINATOR]
+        results[measure_id] = result
+    return results
+
+
+def input_files(input_dir):
+    """
+    Return list of (date, path) of the monthly extracts in input_dir
+    """
+    files = []
+    for path in Path(input_dir).iterdir():
+        match = INPUT_FILE_REGEX.match(path.name)
+        if match:
+            files.append((match.group("date"), path))
+    return sorted(files)
+
+
+def generate_measures(input_dir, output_dir, group_bys):
+    columns = sorted(
+        {c for _, group_by in group_bys for c in group_by} - {DENOMINATOR}
+    )
+    measures = {measure_id: [] for measure_id, _ in group_bys}
+    for date, path in input_files(input_dir):
+        data = read_extract(path, columns)
+        for measure_id, result in calculate_measures(data, group_bys).items():
+            result["date"] = date
+            measures[measure_id].append(result)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    for measure_id, results in measures.items():
+        pd.concat(results).to_csv(
+            Path(output_dir) / f"measure_{measure_id}.csv", index=False
+        )
+
+
+if __name__ == "__main__":
+    input_dir = sys.argv[1] if len(sys.argv) > 1 else "output/joined"
+    output_dir = sys.argv[2] if len(sys.argv) > 2 else input_dir
+    generate_measures(input_dir, output_dir, measure_group_bys(load_config()))
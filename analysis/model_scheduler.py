@@ -0,0 +1,268 @@
+######################################
+
+# This script fits the models of all (wave, subgroup) pairs on a pool of
+# processes, instead of one subgroup after the other per wave, and caches the
+# result of every fit:
+# - every (wave, subgroup) pair is a task; a task fits one model with one of
+#   the engines in ENGINES:
+#   - 'cox': the Cox model of analysis/utils/model_coxph.R (runs
+#     analysis/waves_model_survival.R for the subgroup in a new R process)
+#   - 'poisson': the Poisson rate model of analysis/poisson_rates.py
+# - the cache key of a task is a content hash of the processed data of the
+#   wave, the model formula, the source files of the engine and config.json
+#   (without the lists of subgroups, but with the list the subgroup is in:
+#   the R script reads both); the results
+#   of a task are stored in output/model_cache/<engine>/<key>/ (written to a
+#   temporary directory and renamed when complete), so a re-run only fits the
+#   tasks whose data, formula or code changed (e.g. a subgroup added to
+#   config.json only fits the models of that subgroup)
+# - the results of the subgroups of a wave are concatenated (in the order of
+#   the subgroups) into output/tables/<wave>_<result>.csv, the same files as
+#   written by waves_model_survival.R (cox) or one file per wave (poisson)
+# usage: python analysis/model_scheduler.py [engine] [workers] [wave ...]
+#   (default: cox, all cpus, all waves in config.json)
+
+######################################
+
+# IMPORT STATEMENTS ----
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Tuple
+
+from compress_patterns import model_subgroups
+from config import CONFIG_FILE, load_config
+
+ANALYSIS_DIR = Path(__file__).parent
+INPUT_DIR = Path("output/processed")
+CACHE_DIR = Path("output/model_cache")
+OUTPUT_DIR = Path("output/tables")
+HASH_CHUNK_SIZE = 1 << 20
+# lists of subgroups in config.json (a subgroup added to a list does not
+# change the cache keys of the other subgroups)
+SUBGROUP_LISTS = ("demographics", "comorbidities")
+
+
+# --- FORMULAS ---
+def cox_formula(subgroup):
+    """
+    Formula of the Cox model of subgroup (as in coxmodel() in
+    analysis/utils/model_coxph.R)
+    """
+    if subgroup == "agegroup":
+        covariates = "sex + strata(stp)"
+    elif subgroup == "sex":
+        covariates = "rcs(age, 4) + strata(stp)"
+    else:
+        covariates = "rcs(age, 4) + sex + strata(stp)"
+    return f"Surv(fu, status == '1') ~ {subgroup} + {covariates}"
+
+
+def poisson_formula(subgroup):
+    """
+    Formula of the Poisson model of subgroup (see poisson_rates.py)
+    """
+    from poisson_rates import adjustment_columns
+    return (
+        f"events ~ {' + '.join([subgroup, *adjustment_columns(subgroup)])} "
+        f"+ offset(log(time))"
+    )
+
+
+# --- ENGINES ---
+def fit_cox(wave, subgroup, output_dir, input_dir=INPUT_DIR):
+    """
+    Fit the Cox model of subgroup in wave and write its results to
+    output_dir (<wave>_effect_estimates.csv, _ph_tests.csv, _log_file.csv)
+    """
+    # (waves_model_survival.R reads output/processed/input_<wave>.rds)
+    if Path(input_dir) != INPUT_DIR:
+        raise ValueError(f"the cox engine reads {INPUT_DIR}, not {input_dir}")
+    subprocess.run(
+        ["Rscript", str(ANALYSIS_DIR / "waves_model_survival.R"), wave,
+         str(output_dir), subgroup],
+        check=True,
+        capture_output=True,
+    )
+
+
+def fit_poisson(wave, subgroup, output_dir, input_dir=INPUT_DIR):
+    """
+    Fit the Poisson model of subgroup in wave and write its rate ratios to
+    output_dir (<wave>_poisson_rate_ratios.csv)
+    """
+    from poisson_rates import fit_waves
+    input_pattern = str(Path(input_dir) / "input_{wave}.parquet")
+    fit_waves([wave], [subgroup], input_pattern).to_csv(
+        Path(output_dir) / f"{wave}_poisson_rate_ratios.csv", index=False
+    )
+
+
+@dataclass(frozen=True)
+class Engine:
+    # function (subgroup) -> formula
+    formula: Callable
+    # function (wave, subgroup, output_dir, input_dir) writing
+    # <wave>_<result>.csv
+    fit: Callable
+    results: Tuple[str, ...]
+    # extension of the processed data read by the engine
+    extension: str
+    # files of the model code (part of the cache key)
+    sources: Tuple[str, ...]
+
+
+ENGINES = {
+    "cox": Engine(
+        formula=cox_formula,
+        fit=fit_cox,
+        results=("effect_estimates", "ph_tests", "log_file"),
+        extension="rds",
+        sources=("waves_model_survival.R", "utils/model_coxph.R"),
+    ),
+    "poisson": Engine(
+        formula=poisson_formula,
+        fit=fit_poisson,
+        results=("poisson_rate_ratios",),
+        extension="parquet",
+        sources=("poisson_rates.py",),
+    ),
+}
+
+
+# --- CACHE ---
+def file_hash(path):
+    """
+    sha256 of the content of path
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def config_hash(config, subgroup):
+    """
+    sha256 of config (content of config.json) without the lists of
+    subgroups, with the lists subgroup is in
+    """
+    content = {
+        key: value for key, value in config.items() if key not in SUBGROUP_LISTS
+    }
+    content["subgroup_in"] = [
+        key for key in SUBGROUP_LISTS if subgroup in config.get(key, [])
+    ]
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def task_key(data_hash, formula, source_hash, config_hash):
+    return hashlib.sha256(
+        json.dumps([data_hash, formula, source_hash, config_hash]).encode()
+    ).hexdigest()
+
+
+def run_task(engine_name, wave, subgroup, task_dir, input_dir=INPUT_DIR):
+    """
+    Fit the model of subgroup in wave and store its results in task_dir;
+    runs in a worker process
+    """
+    task_dir = Path(task_dir)
+    tmp_dir = Path(tempfile.mkdtemp(prefix="tmp_", dir=task_dir.parent))
+    try:
+        ENGINES[engine_name].fit(wave, subgroup, tmp_dir, input_dir)
+        os.replace(tmp_dir, task_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return task_dir
+
+
+def concatenate_results(result_files, output_file):
+    """
+    Concatenate csv files with the same header into output_file (as text,
+    so the values are written as the engine wrote them)
+    """
+    with open(output_file, "w") as output:
+        for number, result_file in enumerate(result_files):
+            with open(result_file, "r") as result:
+                header = result.readline()
+                if number == 0:
+                    output.write(header)
+                shutil.copyfileobj(result, output)
+
+
+# --- RUN ---
+def run(engine_name, waves, subgroups, workers=None, cache_dir=CACHE_DIR,
+        output_dir=OUTPUT_DIR, input_dir=INPUT_DIR, config_file=CONFIG_FILE):
+    """
+    Fit the models of all (wave, subgroup) pairs that are not in the cache
+    over workers processes and write the results per wave; return the
+    number of models fitted
+    """
+    engine = ENGINES[engine_name]
+    cache_dir = Path(cache_dir) / engine_name
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    source_hash = hashlib.sha256(
+        "".join(file_hash(ANALYSIS_DIR / source) for source in engine.sources)
+        .encode()
+    ).hexdigest()
+    with open(config_file, "r") as f:
+        config = json.load(f)
+    task_dirs = {}
+    for wave in waves:
+        data_hash = file_hash(Path(input_dir) / f"input_{wave}.{engine.extension}")
+        for subgroup in subgroups:
+            key = task_key(
+                data_hash, engine.formula(subgroup), source_hash,
+                config_hash(config, subgroup),
+            )
+            task_dirs[wave, subgroup] = cache_dir / key
+    pending = {
+        task: task_dir
+        for task, task_dir in task_dirs.items()
+        if not task_dir.exists()
+    }
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                run_task, engine_name, wave, subgroup, task_dir, input_dir
+            )
+            for (wave, subgroup), task_dir in pending.items()
+        ]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            # (finished tasks are kept in the cache)
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    for wave in waves:
+        for result in engine.results:
+            concatenate_results(
+                [
+                    task_dirs[wave, subgroup] / f"{wave}_{result}.csv"
+                    for subgroup in subgroups
+                ],
+                Path(output_dir) / f"{wave}_{result}.csv",
+            )
+    return len(pending)
+
+
+if __name__ == "__main__":
+    engine_name = sys.argv[1] if len(sys.argv) > 1 else "cox"
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    config = load_config()
+    waves = sys.argv[3:] or list(config.waves)
+    fitted = run(engine_name, waves, model_subgroups(config), workers)
+    print(f"{fitted} models fitted, "
+          f"{len(waves) * len(model_subgroups(config)) - fitted} from the cache")
@@ -0,0 +1,215 @@
+######################################
+
+# This script runs the monthly extraction of a study definition (the
+# --index-date-range run of generate_study_population) on a pool of
+# processes instead of one index date after the other:
+# - every index date is a task; with shards > 1 the patients are split in
+#   shards too (patient_id modulo shards, using the patient ids of
+#   output/input_ethnicity.csv.gz, which has all patients) and every
+#   (index date, shard) is a task. A sharded task extracts the population of
+#   the study definition restricted to the patients in its shard file (see
+#   shard_population())
+# - every task writes its extract to a temporary file in the checkpoint
+#   directory (output/checkpoints/<study_definition>) and renames it when it
+#   is complete, so a checkpoint file is either complete or absent
+# - when all shards of an index date are done they are concatenated into
+#   output/input<suffix>_<index date>.csv.gz (the file name of
+#   cohortextractor) and the checkpoints are removed
+# An interrupted run is resumed by running it again: index dates with an
+# output file and shards with a checkpoint file are not extracted again.
+# The index dates are the monthly index dates in config.json. Without a
+# database (DATABASE_URL not set) cohortextractor generates dummy data.
+# usage: python analysis/parallel_extraction.py [study_definition] [shards]
+#   [workers]
+
+######################################
+
+# IMPORT STATEMENTS ----
+import gzip
+import multiprocessing
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+from config import load_config
+
+OUTPUT_DIR = Path("output")
+CHECKPOINT_DIR = Path("output/checkpoints")
+# all patients (population of study_definition_ethnicity.py)
+UNIVERSE_FILE = Path("output/input_ethnicity.csv.gz")
+# population size of the dummy data (expectations in project.yaml)
+EXPECTATIONS_POPULATION = 100_000
+SHARD_PARAM = "shard_file"
+
+
+# --- SHARDS ---
+def shard_population(population):
+    """
+    Return population restricted to the patients in the shard file if the
+    cohortextractor parameter 'shard_file' is set (by this script),
+    otherwise population itself; study_definition.py only calls it if the
+    parameter is set
+    """
+    from cohortextractor import params, patients
+    shard_file = params.get(SHARD_PARAM)
+    if not shard_file:
+        return population
+    return patients.satisfying(
+        "unsharded_population AND in_shard",
+        unsharded_population=population,
+        in_shard=patients.which_exist_in_file(shard_file),
+    )
+
+
+def write_shard_files(universe_file, shards, shard_dir):
+    """
+    Split the patient ids of universe_file in shards files (patient_id
+    modulo shards) and return their paths
+    """
+    shard_dir = Path(shard_dir)
+    shard_files = [shard_dir / f"shard_{shard}of{shards}.csv" for shard in range(shards)]
+    if all(shard_file.exists() for shard_file in shard_files):
+        return shard_files
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    patient_ids = pd.read_csv(universe_file, usecols=["patient_id"])["patient_id"]
+    for shard, shard_file in enumerate(shard_files):
+        tmp_file = shard_file.with_name(f"tmp_{shard_file.name}")
+        patient_ids[patient_ids % shards == shard].to_frame().to_csv(
+            tmp_file, index=False
+        )
+        os.replace(tmp_file, shard_file)
+    return shard_files
+
+
+# --- TASKS ---
+def output_file_name(study_definition, index_date, output_dir=OUTPUT_DIR):
+    """
+    File name of the extract of an index date (as cohortextractor names it)
+    """
+    suffix = study_definition[len("study_definition"):]
+    return Path(output_dir) / f"input{suffix}_{index_date}.csv.gz"
+
+
+def checkpoint_file_name(checkpoint_dir, index_date, shard, shards):
+    return Path(checkpoint_dir) / f"input_{index_date}_shard_{shard}of{shards}.csv.gz"
+
+
+def extract(study_definition, index_date, shard_file, output_file,
+            expectations_population=EXPECTATIONS_POPULATION):
+    """
+    Extract the study definition at index_date (restricted to shard_file)
+    to output_file; runs in a new worker process
+    """
+    from cohortextractor.cohortextractor import load_study_definition
+    params = {SHARD_PARAM: str(shard_file)} if shard_file else {}
+    study = load_study_definition(study_definition, params=params)
+    study.set_index_date(index_date)
+    output_file = Path(output_file)
+    # (the extension gives the output format)
+    tmp_file = output_file.with_name(f"tmp_{os.getpid()}_{output_file.name}")
+    study.to_file(
+        str(tmp_file),
+        expectations_population=expectations_population,
+        dummy_data_file=None,
+    )
+    os.replace(tmp_file, output_file)
+    return output_file
+
+
+def extract_task(task):
+    """
+    Run extract() for a task (index date, study definition, shard file,
+    output file) and return its index date
+    """
+    index_date, study_definition, shard_file, output_file = task
+    extract(study_definition, index_date, shard_file, output_file)
+    return index_date
+
+
+def merge_shards(shard_files, output_file):
+    """
+    Concatenate the extracts of the shards (csv.gz, same header) into
+    output_file
+    """
+    output_file = Path(output_file)
+    tmp_file = output_file.with_name(f"tmp_{output_file.name}")
+    with gzip.open(tmp_file, "wb") as output:
+        for number, shard_file in enumerate(shard_files):
+            with gzip.open(shard_file, "rb") as shard:
+                header = shard.readline()
+                if number == 0:
+                    output.write(header)
+                shutil.copyfileobj(shard, output)
+    os.replace(tmp_file, output_file)
+    for shard_file in shard_files:
+        os.remove(shard_file)
+
+
+# --- RUN ---
+def run(study_definition, index_dates, shards=1, workers=None,
+        output_dir=OUTPUT_DIR, checkpoint_dir=CHECKPOINT_DIR,
+        universe_file=UNIVERSE_FILE):
+    """
+    Extract study_definition at all index_dates that have no output file
+    yet, (index date, shard) tasks spread over workers processes
+    """
+    checkpoint_dir = Path(checkpoint_dir) / study_definition
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    if shards > 1:
+        shard_files = write_shard_files(
+            universe_file, shards, checkpoint_dir / "shards"
+        )
+    else:
+        shard_files = [None]
+    pending = {}
+    for index_date in index_dates:
+        output_file = output_file_name(study_definition, index_date, output_dir)
+        if output_file.exists():
+            continue
+        pending[index_date] = [
+            checkpoint_file_name(checkpoint_dir, index_date, shard, shards)
+            for shard in range(shards)
+        ]
+
+    def merge_if_complete(index_date):
+        checkpoint_files = pending[index_date]
+        if all(checkpoint_file.exists() for checkpoint_file in checkpoint_files):
+            merge_shards(
+                checkpoint_files,
+                output_file_name(study_definition, index_date, output_dir),
+            )
+
+    # (index dates of which all shards were done in an interrupted run)
+    for index_date in list(pending):
+        merge_if_complete(index_date)
+    tasks = [
+        (index_date, study_definition, shard_file, checkpoint_file)
+        for index_date, checkpoint_files in pending.items()
+        if not output_file_name(study_definition, index_date, output_dir).exists()
+        for shard_file, checkpoint_file in zip(shard_files, checkpoint_files)
+        if not checkpoint_file.exists()
+    ]
+    if not tasks:
+        return
+    # (a new process per task: the study definition is imported with the
+    # parameters of the task; maxtasksperchild works on the Python of the
+    # cohortextractor image, unlike max_tasks_per_child of
+    # ProcessPoolExecutor, Python >= 3.11)
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes=workers, maxtasksperchild=1) as pool:
+        # (on an error the pool is terminated, finished shards are kept as
+        # checkpoints)
+        for index_date in pool.imap_unordered(extract_task, tasks):
+            merge_if_complete(index_date)
+
+
+if __name__ == "__main__":
+    study_definition = sys.argv[1] if len(sys.argv) > 1 else "study_definition"
+    shards = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    index_dates = [date.isoformat() for date in load_config().month_index_dates]
+    run(study_definition, index_dates, shards, workers)
@@ -0,0 +1,249 @@
+######################################
+
+# This script compares the covid mortality rates of the levels of every
+# subgroup with Poisson regression models on aggregated person-time cells, a
+# fast alternative to the patient-level Cox models of
+# analysis/waves_model_survival.R:
+# - the processed data of a wave is aggregated into cells (subgroup level,
+#   agegroup_std, sex, stp) with the number of covid deaths (status 1) and
+#   the person-time (sum of fu, in days)
+# - per wave and subgroup a Poisson model with offset log(person-time) is
+#   fitted on the cells (iteratively reweighted least squares), adjusted for
+#   age group (5 year bands) and sex, with stp as fixed effect (the Cox models
+#   are stratified by stp); agegroup is not adjusted for age and sex not for
+#   sex
+# - exp(coefficient) of a level is its rate ratio compared to the reference
+#   level (the first level of the factor in the processed data that has
+#   person-time)
+# - a level without covid deaths has no rate ratio (NaN; its maximum
+#   likelihood estimate is 0) and its cells are left out of the model; if
+#   the reference level or the whole subgroup has no covid deaths, no model
+#   is fitted (all rate ratios NaN, converged false)
+# The number of cells does not depend on the number of patients, so the
+# models of all waves and subgroups are fitted in one run after a single
+# pass over the processed data of each wave. Patients with a missing value in
+# one of the columns of a model are left out of that model (as in coxph()).
+# Input: output/processed/input_<wave>.parquet (written by data_process.R)
+# Output: output/tables/poisson_rate_ratios.csv (wave, subgroup, level, RR,
+#   LowerCI, UpperCI, converged)
+# usage: python analysis/poisson_rates.py [output_file] [wave ...]
+#   (default: all waves in config.json)
+
+######################################
+
+# IMPORT STATEMENTS ----
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from compress_patterns import model_subgroups
+from config import load_config
+
+INPUT_PATTERN = "output/processed/input_{wave}.parquet"
+OUTPUT_FILE = Path("output/tables/poisson_rate_ratios.csv")
+STRATA_COLUMN = "stp"
+TIME_COLUMN = "fu"
+STATUS_COLUMN = "status"
+COVID_DEATH = "1"
+# 97.5% quantile of the standard normal distribution (95% CI)
+Z = 1.959963984540054
+MAX_ITERATIONS = 50
+TOLERANCE = 1e-8
+
+
+# --- CELLS ---
+def adjustment_columns(subgroup):
+    """
+    Return the columns a model of subgroup is adjusted for
+    """
+    if subgroup == "agegroup":
+        adjustments = ["sex"]
+    elif subgroup == "sex":
+        adjustments = ["agegroup_std"]
+    else:
+        adjustments = ["agegroup_std", "sex"]
+    return [*adjustments, STRATA_COLUMN]
+
+
+def as_categorical(column):
+    """
+    Column as categorical (factors keep their levels, other columns get
+    their sorted values as levels)
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column
+    return column.astype("category")
+
+
+def aggregate_cells(data, columns):
+    """
+    Return data frame with the unique combinations of the levels of columns
+    (with person-time) and their number of covid deaths ('events') and
+    person-time ('time'); rows with a missing value are left out
+    """
+    categoricals = [as_categorical(data[column]) for column in columns]
+    codes = [categorical.cat.codes.to_numpy() for categorical in categoricals]
+    shape = [max(len(categorical.cat.categories), 1) for categorical in categoricals]
+    complete = np.logical_and.reduce([code >= 0 for code in codes])
+    time = data[TIME_COLUMN].to_numpy(np.float64)
+    complete &= ~np.isnan(time)
+    events = (data[STATUS_COLUMN].astype(str) == COVID_DEATH).to_numpy()
+    key = np.ravel_multi_index([code[complete] for code in codes], shape)
+    cell_keys, cell_index = np.unique(key, return_inverse=True)
+    cells = pd.DataFrame(
+        {
+            column: pd.Categorical.from_codes(
+                cell_codes, categories=categorical.cat.categories
+            )
+            for column, categorical, cell_codes in zip(
+                columns, categoricals, np.unravel_index(cell_keys, shape)
+            )
+        }
+    )
+    cells["events"] = np.bincount(
+        cell_index, weights=events[complete], minlength=len(cell_keys)
+    )
+    cells["time"] = np.bincount(
+        cell_index, weights=time[complete], minlength=len(cell_keys)
+    )
+    cells = cells[cells["time"] > 0].reset_index(drop=True)
+    # (the first level with person-time is the reference)
+    for column in columns:
+        cells[column] = cells[column].cat.remove_unused_categories()
+    return cells
+
+
+# --- MODEL ---
+def design_matrix(cells, columns):
+    """
+    Return (X, names): intercept and one indicator per level of the columns
+    except their first level
+    """
+    blocks = [np.ones((len(cells), 1))]
+    names = [("(Intercept)", None)]
+    for column in columns:
+        codes = cells[column].cat.codes.to_numpy()
+        levels = cells[column].cat.categories
+        for code in range(1, len(levels)):
+            blocks.append((codes == code)[:, None].astype(np.float64))
+            names.append((column, levels[code]))
+    return np.hstack(blocks), names
+
+
+def fit_poisson(X, events, offset, max_iterations=MAX_ITERATIONS,
+                tolerance=TOLERANCE):
+    """
+    Fit log(E[events]) = offset + X beta by iteratively reweighted least
+    squares; return (beta, covariance of beta, converged)
+    """
+    beta = np.zeros(X.shape[1])
+    beta[0] = np.log(events.sum() / np.exp(offset).sum())
+    deviance = np.inf
+    converged = False
+    for _ in range(max_iterations):
+        eta = X @ beta + offset
+        mu = np.exp(eta)
+        working = eta - offset + (events - mu) / mu
+        sqrt_weights = np.sqrt(mu)
+        beta = np.linalg.lstsq(
+            X * sqrt_weights[:, None], working * sqrt_weights, rcond=None
+        )[0]
+        mu = np.exp(X @ beta + offset)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            terms = np.where(events > 0, events * np.log(events / mu), 0)
+        new_deviance = 2 * np.sum(terms - (events - mu))
+        if abs(new_deviance - deviance) < tolerance * (abs(new_deviance) + 0.1):
+            converged = True
+            break
+        deviance = new_deviance
+    covariance = np.linalg.pinv((X * mu[:, None]).T @ X)
+    return beta, covariance, converged
+
+
+def rate_ratios(cells, subgroup):
+    """
+    Return data frame subgroup, level, RR, LowerCI, UpperCI, converged with
+    one row per level of subgroup except the reference level
+    """
+    levels = cells[subgroup].cat.categories[1:]
+    result = pd.DataFrame(
+        {
+            "subgroup": subgroup,
+            "level": [str(level) for level in levels],
+            "RR": np.nan,
+            "LowerCI": np.nan,
+            "UpperCI": np.nan,
+            "converged": False,
+        }
+    )
+    level_events = cells.groupby(subgroup, observed=False)["events"].sum()
+    if level_events.iloc[0] == 0:
+        return result
+    # (levels without events are not estimable)
+    cells = cells[cells[subgroup].isin(level_events.index[level_events > 0])]
+    cells = cells.assign(
+        **{subgroup: cells[subgroup].cat.remove_unused_categories()}
+    )
+    X, names = design_matrix(cells, [subgroup, *adjustment_columns(subgroup)])
+    beta, covariance, converged = fit_poisson(
+        X, cells["events"].to_numpy(), np.log(cells["time"].to_numpy())
+    )
+    standard_errors = np.sqrt(np.diag(covariance))
+    result["converged"] = converged
+    for position, (column, level) in enumerate(names):
+        if column != subgroup:
+            continue
+        row = result["level"] == str(level)
+        result.loc[row, "RR"] = np.exp(beta[position])
+        result.loc[row, "LowerCI"] = np.exp(
+            beta[position] - Z * standard_errors[position]
+        )
+        result.loc[row, "UpperCI"] = np.exp(
+            beta[position] + Z * standard_errors[position]
+        )
+    return result
+
+
+def fit_wave(data, subgroups):
+    """
+    Return the rate ratios of all subgroups in the processed data of a wave
+    """
+    return pd.concat(
+        [
+            rate_ratios(
+                aggregate_cells(data, [subgroup, *adjustment_columns(subgroup)]),
+                subgroup,
+            )
+            for subgroup in subgroups
+        ],
+        ignore_index=True,
+    )
+
+
+def fit_waves(waves, subgroups, input_pattern=INPUT_PATTERN):
+    """
+    Return the rate ratios of all subgroups in all waves (column wave
+    first), reading only the columns of the models from the processed data
+    of every wave
+    """
+    columns = list(dict.fromkeys(
+        [TIME_COLUMN, STATUS_COLUMN]
+        + [c for s in subgroups for c in [s, *adjustment_columns(s)]]
+    ))
+    results = []
+    for wave in waves:
+        data = pd.read_parquet(input_pattern.format(wave=wave), columns=columns)
+        result = fit_wave(data, subgroups)
+        result.insert(0, "wave", wave)
+        results.append(result)
+    return pd.concat(results, ignore_index=True)
+
+
+if __name__ == "__main__":
+    output_file = Path(sys.argv[1]) if len(sys.argv) > 1 else OUTPUT_FILE
+    config = load_config()
+    waves = sys.argv[2:] or list(config.waves)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    fit_waves(waves, model_subgroups(config)).to_csv(output_file, index=False)
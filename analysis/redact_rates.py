@@ -0,0 +1,198 @@
+######################################
+
+# This script:
+# - Imports the mortality rates (outputted by the measures framework)
+# - Redacts low numbers:
+#   - crude rates and rates per age group (not standardised): a number of
+#     deaths <= 5 is set to 0 (and its rate too)
+#   - rates that are age standardised (sex and subgroups): if the number of
+#     deaths in a stratum (sex, date, subgroup) summed over all age groups is
+#     <= 5, the numbers of deaths (and rates) of the whole stratum are set
+#     to 0
+# - Optionally rounds the numbers of deaths and the population sizes to a
+#   multiple of rounding_accuracy (as redaction_accuracy in
+#   lib/functions/redaction.R; the rates are calculated again from the rounded
+#   numbers). The default of 1 does not round
+# - Writes the numbers of deaths, population sizes and rates as write_csv()
+#   in R wrote them (the R script read them as doubles): integral numbers
+#   without decimals ('1000', not '1000.0'), missing values as NA
+# The measure files are streamed in chunks. The rows of a date are one
+# window: all strata of a date are in its rows, so a window is redacted as
+# soon as the rows of the next date start and only one date is in memory at
+# a time. The measure files need to be sorted by date (as written by the
+# measures framework).
+# Output: output/rates/redacted/<crude/age/sex/subgroup>_redacted.csv
+# usage: python analysis/redact_rates.py [input_dir] [output_dir]
+#   [rounding_accuracy]
+
+######################################
+
+# IMPORT STATEMENTS ----
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from config import load_config
+from measures_cube import DENOMINATOR, NUMERATOR
+
+INPUT_DIR = "output/joined"
+OUTPUT_DIR = "output/rates/redacted"
+REDACTION_THRESHOLD = 5
+CHUNK_SIZE = 500_000
+REDACTED = "0"
+MISSING = "NA"
+NUMBER_COLUMNS = (NUMERATOR, DENOMINATOR, "value")
+
+
+# --- REDACTION ---
+def redact_crude_rates(rates, threshold=REDACTION_THRESHOLD):
+    """
+    Redact numbers of deaths <= threshold (and their rates)
+    """
+    deaths = pd.to_numeric(rates[NUMERATOR])
+    return redact(rates, deaths <= threshold)
+
+
+def redact_subgroup_rates(rates, subgroup, threshold=REDACTION_THRESHOLD):
+    """
+    Redact all numbers of deaths (and rates) of a stratum (sex, date,
+    subgroup) if the number of deaths in the stratum summed over age groups
+    is <= threshold
+    """
+    deaths = pd.to_numeric(rates[NUMERATOR])
+    stratum = list(dict.fromkeys(["sex", "date", subgroup]))
+    summed_over_age = deaths.groupby(
+        [rates[column] for column in stratum], sort=False
+    ).transform("sum")
+    return redact(rates, summed_over_age <= threshold)
+
+
+def redact(rates, redacted):
+    rates = rates.copy()
+    rates.loc[redacted, NUMERATOR] = REDACTED
+    rates.loc[redacted, "value"] = REDACTED
+    return rates
+
+
+def round_counts(rates, accuracy):
+    """
+    Round the number of deaths and the population size to a multiple of
+    accuracy (half to even, as round() in R) and calculate the rates again
+    """
+    if accuracy == 1:
+        return rates
+    rates = rates.copy()
+    counts = {}
+    for column in (NUMERATOR, DENOMINATOR):
+        # (missing counts stay missing)
+        counts[column] = np.round(pd.to_numeric(rates[column]) / accuracy) * accuracy
+        rates[column] = counts[column]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates["value"] = counts[NUMERATOR] / counts[DENOMINATOR]
+    return rates
+
+
+# --- OUTPUT ---
+def format_numbers(values):
+    """
+    Format numbers as write_csv() in R: integral numbers without decimals,
+    other numbers as their shortest representation and missing values as NA
+    """
+    numbers = pd.to_numeric(pd.Series(values).replace(MISSING, "")).to_numpy(
+        dtype=float
+    )
+    formatted = np.array([repr(number) for number in numbers.tolist()], dtype=object)
+    integral = np.isfinite(numbers) & (numbers == np.round(numbers))
+    formatted[integral] = [str(int(number)) for number in numbers[integral]]
+    formatted[np.isnan(numbers)] = MISSING
+    formatted[numbers == np.inf] = "Inf"
+    formatted[numbers == -np.inf] = "-Inf"
+    return formatted
+
+
+def format_rates(rates):
+    rates = rates.copy()
+    for column in NUMBER_COLUMNS:
+        if column in rates.columns:
+            rates[column] = format_numbers(rates[column])
+    return rates
+
+
+# --- STREAMING ---
+def date_windows(input_file, chunk_size=CHUNK_SIZE):
+    """
+    Yield the rows of input_file per date (all values as strings)
+    """
+    done = set()
+    rest = None
+    reader = pd.read_csv(
+        input_file, dtype=str, keep_default_na=False, chunksize=chunk_size
+    )
+    for chunk in reader:
+        if len(chunk) == 0:
+            continue
+        if rest is not None:
+            chunk = pd.concat([rest, chunk], ignore_index=True)
+        # the last date of a chunk can go on in the next chunk
+        last_date = chunk["date"].iloc[-1]
+        complete = chunk["date"] != last_date
+        for date, window in chunk[complete].groupby("date", sort=False):
+            if date in done:
+                raise ValueError(f"{input_file} is not sorted by date")
+            done.add(date)
+            yield window
+        rest = chunk[~complete]
+    if rest is not None and len(rest) > 0:
+        if rest["date"].iloc[0] in done:
+            raise ValueError(f"{input_file} is not sorted by date")
+        yield rest
+
+
+def redact_file(input_file, output_file, redaction, rounding_accuracy=1):
+    """
+    Stream input_file per date, apply redaction (function of the rows of a
+    date) and rounding and write the result to output_file
+    """
+    first = True
+    for window in date_windows(input_file):
+        window = format_rates(round_counts(redaction(window), rounding_accuracy))
+        window.to_csv(
+            output_file, mode="w" if first else "a", header=first, index=False
+        )
+        first = False
+    if first:
+        # no rows: header only
+        pd.read_csv(input_file, nrows=0).to_csv(output_file, index=False)
+
+
+def redact_rates(subgroups, input_dir=INPUT_DIR, output_dir=OUTPUT_DIR,
+                 rounding_accuracy=1):
+    input_dir = Path(input_dir)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # the crude rates and the rates per age group are not age standardised
+    redactions = {
+        "crude": redact_crude_rates,
+        "age": redact_crude_rates,
+    }
+    # sex is a subgroup too (rates are grouped by sex and sex)
+    for subgroup in ("sex",) + tuple(subgroups):
+        redactions[subgroup] = (
+            lambda rates, subgroup=subgroup: redact_subgroup_rates(rates, subgroup)
+        )
+    for name, redaction in redactions.items():
+        redact_file(
+            input_dir / f"measure_{name}_mortality_rate.csv",
+            output_dir / f"{name}_redacted.csv",
+            redaction,
+            rounding_accuracy,
+        )
+
+
+if __name__ == "__main__":
+    input_dir = sys.argv[1] if len(sys.argv) > 1 else INPUT_DIR
+    output_dir = sys.argv[2] if len(sys.argv) > 2 else OUTPUT_DIR
+    rounding_accuracy = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    redact_rates(load_config().subgroups, input_dir, output_dir, rounding_accuracy)
@@ -0,0 +1,103 @@
+######################################
+
+# This script splits the extract of study_definition_all_waves.py (all waves in
+# one extraction) in one file per wave, with the same columns as the extract
+# of the study definition of that wave (study_definition_wave<n>.py). The
+# flowchart extract (study_definition_flowchart.py) is split in the same way.
+# - only patients in the population of the wave are kept
+#   (column 'population_<wave>')
+# - columns '<name>_<wave>' (and their companion columns
+#   '<name>_<wave>_date', '<name>_<wave>_date_measured') are renamed to
+#   '<name>', wave independent columns are kept as they are
+# - the chain of vaccination dates (extracted once, up to the end of the last
+#   wave) is cut at the end date of the wave: dates after the end of the wave
+#   are removed
+# usage: python analysis/split_waves.py [input_file] [output_pattern]
+
+######################################
+
+# IMPORT STATEMENTS ----
+import re
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+from config import load_config
+
+WAVE_COLUMN_REGEX = re.compile(
+    r"^(?P<name>.+)_(?P<wave>wave\d+)(?P<suffix>_date_measured|_date)?$"
+)
+# chains of dates cut at the end of a wave (see event_date_chain() in
+# definition_utils.py)
+TRUNCATED_COLUMN_REGEX = re.compile(r"^covid_vax_date_\d+$")
+CHUNK_SIZE = 500_000
+
+
+def wave_columns(columns):
+    """
+    Return dict wave -> {column in extract: column in wave extract}; the
+    population column of a wave maps to None
+    """
+    waves = sorted(
+        {
+            match.group("wave")
+            for match in map(WAVE_COLUMN_REGEX.match, columns)
+            if match
+        }
+    )
+    shared = [column for column in columns if not WAVE_COLUMN_REGEX.match(column)]
+    mapping = {}
+    for wave in waves:
+        mapping[wave] = {column: column for column in shared}
+        for column in columns:
+            match = WAVE_COLUMN_REGEX.match(column)
+            if match and match.group("wave") == wave:
+                name = match.group("name") + (match.group("suffix") or "")
+                mapping[wave][column] = None if name == "population" else name
+    return mapping
+
+
+def split_waves(input_file, output_pattern, end_dates):
+    """
+    Stream input_file in chunks and append the rows of each wave to
+    output_pattern.format(wave=wave); end_dates is a dict wave -> end date
+    """
+    header = pd.read_csv(input_file, nrows=0).columns
+    mapping = wave_columns(list(header))
+    output_files = {
+        wave: Path(output_pattern.format(wave=wave)) for wave in mapping
+    }
+    for output_file in output_files.values():
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        if output_file.exists():
+            output_file.unlink()
+    reader = pd.read_csv(input_file, chunksize=CHUNK_SIZE, dtype=str,
+                         keep_default_na=False)
+    for chunk_number, chunk in enumerate(reader):
+        for wave, columns in mapping.items():
+            in_population = chunk[f"population_{wave}"] == "1"
+            selected = {
+                column: name for column, name in columns.items() if name is not None
+            }
+            data = chunk.loc[in_population, list(selected)].rename(columns=selected)
+            for column in filter(TRUNCATED_COLUMN_REGEX.match, data.columns):
+                # (ISO dates, missing dates are '')
+                data.loc[data[column] > end_dates[wave], column] = ""
+            data.to_csv(
+                output_files[wave],
+                mode="w" if chunk_number == 0 else "a",
+                header=chunk_number == 0,
+                index=False,
+                compression={"method": "gzip"} if output_files[wave].suffix == ".gz" else None,
+            )
+
+
+if __name__ == "__main__":
+    input_file = sys.argv[1] if len(sys.argv) > 1 else "output/input_all_waves.csv.gz"
+    output_pattern = (
+        sys.argv[2] if len(sys.argv) > 2 else "output/input_{wave}.csv.gz"
+    )
+    config = load_config()
+    end_dates = {wave: config.wave_dates(wave)[1] for wave in config.waves}
+    split_waves(input_file, output_pattern, end_dates)
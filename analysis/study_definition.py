@@ -9,10 +9,10 @@
 # Import code building blocks from cohort extractor package
 from cohortextractor import (
     StudyDefinition,
+    params,
     patients,
     filter_codes_by_category,
     combine_codelists,
-    Measure,
 )
 
 # Import codelists from codelist.py (which pulls them from the codelist folder)
@@ -49,34 +49,28 @@ from codelists import (
     covid_codelist,  # outcomes
 )
 
+# Import helper for chains of event dates
+from definition_utils import event_date_chain
+
 # Import config variables (dates, list of demographics and list of
 # comorbidities)
-# Import json module
-import json
-with open('analysis/config.json', 'r') as f:
-    config = json.load(f)
+from config import load_config
+config = load_config()
+
+start_date = config.dates.start_date.isoformat()
+end_date = config.dates.end_date.isoformat()
 
-dates = config["dates"]
-start_date = dates["start_date"]
-end_date = dates["end_date"]
-demographics_list = config["demographics"]
-# demographics_list and comorbidities_list is used in the measures framework,
-# the variable ckd_rrt is added to the data in an R script, and hence
-# discarded here
-comorbidities_list = config["comorbidities"]
-comorbidities_list.remove("ckd_rrt")
+# Configure the expectations framework
+default_expectations = {
+    "date": {"earliest": "1900-01-01", "latest": end_date},
+    "rate": "uniform",
+    "incidence": 0.5,
+}
 
 # DEFINE STUDY POPULATION ----
-# Define study population and variables
-study = StudyDefinition(
-    # Configure the expectations framework
-    default_expectations={
-        "date": {"earliest": "1900-01-01", "latest": end_date},
-        "rate": "uniform",
-        "incidence": 0.5,
-    },
-    # Set index date to start date
-    index_date=start_date,
+# Define study population and variables (the variable definitions are also
+# used by the incremental extraction, see incremental_extraction.py)
+variables = dict(
     # Define the study population
     # IN AND EXCLUSION CRITERIA
     # (= > 1 year follow up, aged > 18 and no missings in age and sex)
@@ -248,6 +242,12 @@ study = StudyDefinition(
             find_last_match_in_period=True,
             on_or_before="index_date",
             returning="category",
+            # (hidden here, but a column of the incremental extraction:
+            # the ratios of smoking_status)
+            return_expectations={
+                "category": {"ratios": {"S": 0.6, "E": 0.1, "N": 0.2}},
+                "incidence": 0.9,
+            },
         ),
         ever_smoked=patients.with_these_clinical_events(
             filter_codes_by_category(clear_smoking_codes, include=["S", "E"]),
@@ -275,6 +275,10 @@ study = StudyDefinition(
         msoa=patients.address_as_of(
          "index_date",
          returning="msoa",
+         return_expectations={
+             "category": {"ratios": {"E02000001": 0.5, "E02000002": 0.5}},
+             "incidence": 0.2,
+         },
         ),
         return_expectations={"incidence": 0.2}
     ),
@@ -429,6 +433,10 @@ study = StudyDefinition(
             pred_codes,  # imported from codelists.py
             between=["index_date - 1 year", "index_date"],
             returning="number_of_matches_in_period",
+            return_expectations={
+                "int": {"distribution": "poisson", "mean": 2},
+                "incidence": 0.2,
+            },
         ),
     ),
     # Blood pressure
@@ -801,47 +809,28 @@ study = StudyDefinition(
         on_or_before="index_date",
         find_last_match_in_period=True,
     ),
-    # Date of first COVID vaccination - source nhs-covid-vaccination-coverage
-    covid_vax_date_1=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        between=["2020-12-01", "index_date"],  # any dose recorded after 01/12/2020
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {"earliest": "2020-12-01", "latest": "index_date"},
-            "incidence": 0.8,
-        },
-    ),
-    # Date of second COVID vaccination - source nhs-covid-vaccination-coverage
-    covid_vax_date_2=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        between=["covid_vax_date_1 + 1 day", "index_date"],  # from day after previous dose
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {"earliest": "2020-12-01", "latest": "index_date"},
-            "incidence": 0.6,
-        },
-    ),
-    # Date of third COVID vaccination (primary or booster) -
-    # modified from nhs-covid-vaccination-coverage
+    # Dates of first, second and third COVID vaccination - source
+    # nhs-covid-vaccination-coverage: any dose recorded after 01/12/2020,
+    # every next dose from the day after the previous dose
+    # (third dose primary or booster - modified from
+    # nhs-covid-vaccination-coverage
     # 01 Sep 2021: 3rd dose (primary) at interval of >=8w recommended for
     # immunosuppressed
     # 14 Sep 2021: 3rd dose (booster) reommended for JCVI groups 1-9 at >=6m
     # 15 Nov 2021: 3rd dose (booster) recommended for 40–49y at >=6m
-    # 29 Nov 2021: 3rd dose (booster) recommended for 18–39y at >=3m
-    covid_vax_date_3=patients.with_tpp_vaccination_record(
+    # 29 Nov 2021: 3rd dose (booster) recommended for 18–39y at >=3m)
+    **event_date_chain(
+        patients.with_tpp_vaccination_record,
+        [f"covid_vax_date_{n}" for n in range(1, 4)],
+        between=["2020-12-01", "index_date"],
+        return_expectations=[
+            {
+                "date": {"earliest": "2020-12-01", "latest": "index_date"},
+                "incidence": incidence,
+            }
+            for incidence in (0.8, 0.6, 0.5)
+        ],
         target_disease_matches="SARS-2 CORONAVIRUS",
-        between=["covid_vax_date_2 + 1 day", "index_date"],  # from day after previous dose
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {"earliest": "2020-12-01", "latest": "index_date"},
-            "incidence": 0.5,
-        },
     ),
     # OUTCOMES
     # Patients with ONS-registered death
@@ -858,44 +847,22 @@ study = StudyDefinition(
     ),
 )
 
-measures = [
-    # calculate crude mortality rate
-    Measure(
-        id="crude_mortality_rate",
-        numerator="died_ons_covid_flag_any",
-        denominator="population",
-        group_by="population",
-    ),
-    # calculate rates in age groups (for females and males seperately)
-    Measure(
-        id="age_mortality_rate",
-        numerator="died_ons_covid_flag_any",
-        denominator="population",
-        group_by=["sex", "agegroup"],
-    ),
-    # calculate rates in females/males
-    Measure(
-        id="sex_mortality_rate",
-        numerator="died_ons_covid_flag_any",
-        denominator="population",
-        group_by=["agegroup_std", "sex"],
-    ),
-]
-
-for demographic in demographics_list:
-    m = Measure(
-        id=f"{demographic}_mortality_rate",
-        numerator="died_ons_covid_flag_any",
-        denominator="population",
-        group_by=["agegroup_std", "sex", f"{demographic}"],
+# Restrict the population to a shard of the patients if the parameter
+# shard_file is set (only by analysis/parallel_extraction.py)
+if params.get("shard_file"):
+    from parallel_extraction import shard_population
+    variables = dict(
+        variables, population=shard_population(variables["population"])
     )
-    measures.append(m),
 
-for comorbidity in comorbidities_list:
-    m = Measure(
-        id=f"{comorbidity}_mortality_rate",
-        numerator="died_ons_covid_flag_any",
-        denominator="population",
-        group_by=["agegroup_std", "sex", f"{comorbidity}"],
-    )
-    measures.append(m)
+study = StudyDefinition(
+    default_expectations=default_expectations,
+    # Set index date to start date
+    index_date=start_date,
+    **variables,
+)
+
+# Mortality rates (crude, in age groups, in females/males and per
+# demographic/comorbidity) are calculated from the extracts by
+# analysis/measures_cube.py (action calculate_measures), not by
+# cohortextractor generate_measures
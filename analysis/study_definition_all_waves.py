@@ -0,0 +1,18 @@
+######################################
+
+# This script provides the formal specification of the study data that will
+# be extracted from the OpenSAFELY database.
+# This data extract contains all UK pandemic waves in one extraction (see
+# config.json for start and end dates of the waves): variables that do not
+# depend on the dates of a wave are extracted once, the other variables
+# are extracted per wave with the wave as suffix.
+# analysis/split_waves.py splits the extract in one file per wave
+
+######################################
+
+# IMPORT STATEMENTS ----
+from wave_definitions import waves_study_definition
+
+# DEFINE STUDY POPULATION ----
+# Define study population and variables
+study = waves_study_definition()
@@ -16,14 +16,11 @@ from cohortextractor import (
 from codelists import ethnicity_codes
 
 # Import config variables (dates)
-# Import json module
-import json
-with open('analysis/config.json', 'r') as f:
-    config = json.load(f)
+from config import load_config
+config = load_config()
 
-dates = config["dates"]
-start_date = dates["start_date"]
-end_date = dates["end_date"]
+start_date = config.dates.start_date.isoformat()
+end_date = config.dates.end_date.isoformat()
 
 # DEFINE STUDY POPULATION ----
 # Define study population and variables
@@ -1,113 +0,0 @@
-######################################
-
-# This script provides the formal specification of the study data that will
-# be extracted from the OpenSAFELY database.
-# This data extract is the more broader data extract without applying some of
-# the study exclusion criteria to create a flowchart
-
-######################################
-
-# IMPORT STATEMENTS ----
-# Import code building blocks from cohort extractor package
-from cohortextractor import (
-    StudyDefinition,
-    patients
-)
-
-# Import config variables (start_date and end_date of wave1)
-# Import json module
-import json
-with open('analysis/config.json', 'r') as f:
-    config = json.load(f)
-
-wave2 = config["wave2"]
-start_date = wave2["start_date"]
-end_date = wave2["end_date"]
-
-# DEFINE STUDY POPULATION ----
-# Define study population and variables
-study = StudyDefinition(
-    # Configure the expectations framework
-    default_expectations={
-        "date": {"earliest": "1900-01-01", "latest": end_date},
-        "rate": "uniform",
-        "incidence": 0.95,
-    },
-    # Set index date to start date
-    index_date=start_date,
-    # Define the study population
-    # IN AND EXCLUSION CRITERIA
-    # (= > 1 year follow up, aged > 18 and no missings in age and sex)
-    # missings in age are the ones > 110
-    # missings in sex can be sex = U or sex = I (so filter on M and F)
-    population=patients.satisfying(
-        """
-        NOT died
-        """,
-        died=patients.died_from_any_cause(
-            on_or_before="index_date",
-            returning="binary_flag",
-            return_expectations={"incidence": 0.01},
-        ),
-    ),
-    # follow up
-    has_follow_up=patients.registered_with_one_practice_between(
-            "index_date - 3 months", "index_date"
-    ),
-    # age
-    age=patients.age_as_of(
-        "index_date",
-        return_expectations={
-            "rate": "universal",
-            "int": {"distribution": "population_ages"},
-        },
-    ),
-    # sex
-    sex=patients.sex(
-        return_expectations={
-            "rate": "universal",
-            "category": {"ratios": {"M": 0.49, "F": 0.51}},
-        }
-    ),
-    # stp https://github.com/ebmdatalab/tpp-sql-notebook/issues/54
-    stp=patients.registered_practice_as_of(
-        "index_date",
-        returning="stp_code",
-        return_expectations={
-            "rate": "universal",
-            "category": {
-                "ratios": {
-                    "STP1": 0.1,
-                    "STP2": 0.1,
-                    "STP3": 0.1,
-                    "STP4": 0.1,
-                    "STP5": 0.1,
-                    "STP6": 0.1,
-                    "STP7": 0.1,
-                    "STP8": 0.1,
-                    "STP9": 0.1,
-                    "STP10": 0.1,
-                }
-            },
-        },
-    ),
-    # imd (index of multiple deprivation) quintile
-    index_of_multiple_deprivation=patients.address_as_of(
-        date="index_date",
-        returning="index_of_multiple_deprivation",
-        round_to_nearest=100,
-        return_expectations={
-            "rate": "universal",
-            "category": {
-                "ratios": {
-                    "0": 0,
-                    "1": 0.2,
-                    "2": 0.2,
-                    "3": 0.2,
-                    "4": 0.2,
-                    "5": 0.2,
-                }
-            },
-        },
-    ),
-)
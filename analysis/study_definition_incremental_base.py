@@ -0,0 +1,37 @@
+######################################
+
+# First extract of the incremental extraction (see incremental_extraction.py):
+# all variables of study_definition.py at the first index date, for all
+# patients registered at any of the monthly index dates.
+
+######################################
+
+# IMPORT STATEMENTS ----
+# Import code building blocks from cohort extractor package
+from cohortextractor import StudyDefinition
+
+import study_definition
+
+from incremental_extraction import (
+    build_plan,
+    check_plan,
+    incremental_variables,
+    universe_population,
+)
+
+config = study_definition.config
+
+check_plan(
+    build_plan(
+        study_definition.variables,
+        study_definition.study.covariate_definitions,
+        config.month_index_dates,
+    )
+)
+
+study = StudyDefinition(
+    default_expectations=study_definition.default_expectations,
+    index_date=study_definition.start_date,
+    population=universe_population(config.month_index_dates),
+    **incremental_variables(study_definition.variables, delta=False),
+)
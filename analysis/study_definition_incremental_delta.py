@@ -0,0 +1,38 @@
+######################################
+
+# Delta extracts of the incremental extraction (see incremental_extraction.py):
+# the variables of study_definition.py that change between index dates, with
+# the period of cumulative variables restricted to the last month; run with
+# --index-date-range from the second index date on.
+
+######################################
+
+# IMPORT STATEMENTS ----
+# Import code building blocks from cohort extractor package
+from cohortextractor import StudyDefinition
+
+import study_definition
+
+from incremental_extraction import (
+    build_plan,
+    check_plan,
+    incremental_variables,
+    universe_population,
+)
+
+config = study_definition.config
+
+check_plan(
+    build_plan(
+        study_definition.variables,
+        study_definition.study.covariate_definitions,
+        config.month_index_dates,
+    )
+)
+
+study = StudyDefinition(
+    default_expectations=study_definition.default_expectations,
+    index_date=study_definition.start_date,
+    population=universe_population(config.month_index_dates),
+    **incremental_variables(study_definition.variables, delta=True),
+)
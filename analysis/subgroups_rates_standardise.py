@@ -0,0 +1,206 @@
+######################################
+
+# This script:
+# - Imports the subgroup specific mortality rates (redacted output of the
+#   measures framework, one file per subgroup)
+# - Standardises the rates to the European Standard Population (direct
+#   standardisation, see analysis/utils/dsr.R for the formulas)
+# - Standardises the rates to 30 days per month and per 100.000 individuals
+# All rates of all subgroups are standardised at once: the files are stacked
+# into one long table (date, sex, subgroup, level, age group) and dsr_i and
+# var_dsr_i are computed as arrays and summed over age with np.bincount().
+# Output:
+# - output/rates/standardised/<subgroup>_std.csv (date, sex, <subgroup>, dsr,
+#   var_dsr)
+# - output/rates/standardised/all_subgroups_standardised.csv: all subgroups in
+#   one table (subgroup, level, date, sex, dsr, var_dsr)
+# usage: python analysis/subgroups_rates_standardise.py [input_pattern]
+#   [output_dir] (input_pattern e.g.
+#   'output/joined/measure_{subgroup}_mortality_rate.csv' to standardise the
+#   unredacted rates)
+
+######################################
+
+# IMPORT STATEMENTS ----
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from config import load_config
+
+INPUT_PATTERN = "output/rates/redacted/{subgroup}_redacted.csv"
+OUTPUT_DIR = "output/rates/standardised"
+# (not named <subgroup>_std.csv, as the files of the subgroups)
+ALL_SUBGROUPS_FILE = "all_subgroups_standardised.csv"
+ESP_FILE = "input/european_standard_pop.csv"
+# age groups of the ESP that are not part of the study population (< 18 year
+# old)
+ESP_EXCLUDED_AGE_GROUPS = ("0-4 years", "5-9 years", "10-14 years")
+ESP_SEX = {"Male": "M", "Female": "F"}
+DENOMINATOR = "population"
+# levels read as NA by read_csv in R
+MISSING_LEVELS = ("", "NA")
+
+
+# --- DSR ---
+def calc_dsr_i(C, M_total, p, M):
+    """
+    Term of the direct standardised rate of an age group (summed over age
+    groups = DSR), see analysis/utils/dsr.R
+    """
+    return (C / M_total) * p * M
+
+
+def calc_var_dsr_i(C, M_total, p, M, N):
+    """
+    Term of the variance of the direct standardised rate of an age group,
+    see analysis/utils/dsr.R
+    """
+    return (C ** 2 / M_total ** 2) * (M ** 2 / N) * p * (1 - p)
+
+
+# --- DATA ---
+def read_esp(esp_file=ESP_FILE):
+    """
+    European Standard Population as dict (agegroup_std, sex) -> size
+    """
+    esp = pd.read_csv(esp_file, encoding="utf-8-sig")
+    esp = esp[~esp["AgeGroup"].isin(ESP_EXCLUDED_AGE_GROUPS)]
+    return {
+        (age_group, ESP_SEX.get(sex, sex)): population
+        for age_group, sex, population in zip(
+            esp["AgeGroup"], esp["Sex"], esp["EuropeanStandardPopulation"]
+        )
+    }
+
+
+def read_rates(subgroups, input_pattern=INPUT_PATTERN):
+    """
+    Stack the rates of all subgroups in one long table with columns
+    subgroup, level, date, sex, agegroup_std, population and value
+    """
+    rates = []
+    for subgroup in subgroups:
+        data = pd.read_csv(
+            input_pattern.format(subgroup=subgroup),
+            dtype=str,
+            keep_default_na=False,
+        )
+        rates.append(
+            pd.DataFrame(
+                {
+                    "subgroup": subgroup,
+                    # (sex is grouped by sex twice)
+                    "level": data[subgroup],
+                    "date": data["date"],
+                    "sex": data["sex"],
+                    "agegroup_std": data["agegroup_std"],
+                    DENOMINATOR: pd.to_numeric(data[DENOMINATOR], errors="coerce"),
+                    "value": pd.to_numeric(data["value"], errors="coerce"),
+                }
+            )
+        )
+    return pd.concat(rates, ignore_index=True)
+
+
+def days_in_month(dates):
+    """
+    Number of days in the month of dates (strings YYYY-MM-DD)
+    """
+    dates = pd.to_datetime(dates)
+    return dates.dt.days_in_month.to_numpy()
+
+
+# --- STANDARDISATION ---
+def standardise(rates, esp):
+    """
+    Return the DSR and its variance of every (subgroup, level, date, sex)
+    """
+    M = np.array(
+        [
+            esp.get(key, np.nan)
+            for key in zip(rates["agegroup_std"], rates["sex"])
+        ],
+        dtype=float,
+    )
+    group_columns = ["subgroup", "level", "date", "sex"]
+    group_index, group_keys = pd.MultiIndex.from_frame(
+        rates[group_columns]
+    ).factorize()
+    n_groups = len(group_keys)
+    # total of the ESP in a group (NaN if an age group or sex is not in the
+    # ESP, like the sum in R)
+    M_total = np.bincount(group_index, weights=np.nan_to_num(M), minlength=n_groups)
+    missing = np.bincount(group_index, weights=np.isnan(M), minlength=n_groups)
+    M_total[missing > 0] = np.nan
+    M_total = M_total[group_index]
+    C = 100000 * 30 / days_in_month(rates["date"])
+    p = rates["value"].to_numpy(dtype=float)
+    N = rates[DENOMINATOR].to_numpy(dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dsr_i = calc_dsr_i(C, M_total, p, M)
+        var_dsr_i = calc_var_dsr_i(C, M_total, p, M, N)
+    # sum over age, ignoring missing terms (na.rm = TRUE)
+    dsr = np.bincount(
+        group_index, weights=np.where(np.isnan(dsr_i), 0, dsr_i), minlength=n_groups
+    )
+    var_dsr = np.bincount(
+        group_index,
+        weights=np.where(np.isnan(var_dsr_i), 0, var_dsr_i),
+        minlength=n_groups,
+    )
+    result = pd.DataFrame(list(group_keys), columns=group_columns)
+    result["dsr"] = dsr
+    result["var_dsr"] = var_dsr
+    return sort_groups(result)
+
+
+def level_sort_key(levels):
+    """
+    Sort levels as numbers if all levels that are not missing are numbers (as
+    read by read_csv in R), otherwise as strings; missing levels ('' or 'NA',
+    NA in R) sort last, as in group_by() in R
+    """
+    levels = levels.where(~levels.isin(MISSING_LEVELS), None)
+    numbers = pd.to_numeric(levels, errors="coerce")
+    if numbers.notna().sum() == levels.notna().sum():
+        return numbers
+    return levels
+
+
+def sort_groups(result):
+    parts = []
+    for subgroup, data in result.groupby("subgroup", sort=False):
+        data = data.assign(_level=level_sort_key(data["level"]))
+        parts.append(
+            data.sort_values(
+                ["date", "sex", "_level"], kind="stable", na_position="last"
+            ).drop(columns="_level")
+        )
+    return pd.concat(parts, ignore_index=True)
+
+
+def write_output(result, output_dir=OUTPUT_DIR):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    result.to_csv(output_dir / ALL_SUBGROUPS_FILE, index=False)
+    for subgroup, data in result.groupby("subgroup", sort=False):
+        if subgroup == "sex":
+            data = data[["date", "sex", "dsr", "var_dsr"]]
+        else:
+            data = data.rename(columns={"level": subgroup})[
+                ["date", "sex", subgroup, "dsr", "var_dsr"]
+            ]
+        data.to_csv(output_dir / f"{subgroup}_std.csv", index=False)
+
+
+if __name__ == "__main__":
+    input_pattern = sys.argv[1] if len(sys.argv) > 1 else INPUT_PATTERN
+    output_dir = sys.argv[2] if len(sys.argv) > 2 else OUTPUT_DIR
+    config = load_config()
+    # sex is a subgroup too (rates are grouped by sex and sex)
+    subgroups = ("sex",) + config.subgroups
+    rates = read_rates(subgroups, input_pattern)
+    write_output(standardise(rates, read_esp()), output_dir)
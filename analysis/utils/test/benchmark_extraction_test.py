@@ -0,0 +1,54 @@
+# Test for benchmark_extraction.py (the generated SQL only: there is no TPP
+# database outside the secure environment)
+# usage: python -m pytest analysis/utils/test/benchmark_extraction_test.py
+from benchmark_extraction import (
+    STUDY_MEASURES,
+    benchmark,
+    compare,
+    load_baselines,
+    new_variables,
+)
+
+
+def test_baseline_of_the_generated_sql():
+    result = benchmark("study_definition_ethnicity")
+    baseline = load_baselines()["study_definition_ethnicity"]
+    assert result == baseline
+    # (database measures only with a database)
+    assert not {"database_seconds", "wall_seconds", "peak_rss_mb",
+                "patients"} & set(result)
+    assert compare([result], load_baselines()) == []
+
+
+def test_regressions():
+    baseline = {
+        "study_definition": "sd",
+        "variables": {"age": {"queries": 2, "sql_chars": 100,
+                              "database_seconds": 0.01}},
+        "queries": 3,
+        "sql_chars": 150,
+        "peak_rss_mb": 100.0,
+    }
+    result = {
+        "study_definition": "sd",
+        "variables": {
+            # (timings below MIN_SECONDS are noise)
+            "age": {"queries": 2, "sql_chars": 200, "database_seconds": 0.04},
+            "bmi": {"queries": 4, "sql_chars": 300},
+        },
+        "queries": 7,
+        "sql_chars": 550,
+        "peak_rss_mb": 120.0,
+        "wall_seconds": 10.0,
+    }
+    assert "peak_rss_mb" in STUDY_MEASURES
+    assert compare([result], {"sd": baseline}) == [
+        "sd: queries 7 (baseline 3)",
+        "sd: sql_chars 550 (baseline 150)",
+        "sd: age: sql_chars 200 (baseline 100)",
+    ]
+    assert new_variables([result], {"sd": baseline}) == [
+        "sd: new variable bmi queries 4, sql_chars 300"
+    ]
+    # study definitions without a baseline are not compared
+    assert compare([result], {}) == []
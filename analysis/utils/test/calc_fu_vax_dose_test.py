@@ -0,0 +1,150 @@
+# Test for fu_vax_dose.py (the cases of calc_fu_vax_dose_test.R)
+# usage: python -m pytest analysis/utils/test/calc_fu_vax_dose_test.py
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from fu_vax_dose import (
+    DOSES,
+    TIME_LAG,
+    dose_at_end,
+    dose_starts,
+    episodes,
+    fu_vax_dose,
+    split_follow_up,
+    split_wave,
+)
+
+# (start of the wave, days of the doses since the start, days of death)
+# all doses during the wave, died after the fourth dose
+DOSES_IN_WAVE = (date(2020, 9, 1), (42, 84, 126, 168, 210, 252), 200)
+# all doses before the wave, the sixth protects from day 4 of the wave
+DOSES_BEFORE_WAVE = (date(2021, 6, 1), (-200, -150, -100, -50, -30, -10), 100)
+# fu_vax_0 ... fu_vax_6 (calc_fu_vax_dose() in analysis/utils/calc_fu_vax_dose.R)
+EXPECTED = {
+    DOSES_IN_WAVE: [56, 42, 42, 42, 18, 0, 0],
+    DOSES_BEFORE_WAVE: [0, 0, 0, 0, 0, 4, 96],
+}
+
+
+def extract(start_date, dose_days, died_day, has_follow_up="1"):
+    """
+    Extract (csv columns as strings) of one patient who died of another
+    cause than covid
+    """
+    row = {"patient_id": 1}
+    for dose, days in enumerate(dose_days, start=1):
+        row[f"covid_vax_date_{dose}"] = str(start_date + timedelta(days))
+    row["died_ons_covid_any_date"] = None
+    row["died_any_date"] = str(start_date + timedelta(died_day))
+    row["has_follow_up"] = has_follow_up
+    return pd.DataFrame([row])
+
+
+def test_split_follow_up():
+    for case, expected in EXPECTED.items():
+        _, dose_days, died_day = case
+        starts = np.array([dose_days], dtype=np.float64) + TIME_LAG
+        fu_vax = split_follow_up(starts, np.array([died_day], dtype=np.float64))
+        np.testing.assert_array_equal(fu_vax, [expected])
+
+
+def test_split_follow_up_without_doses():
+    starts = np.full((1, DOSES), np.nan)
+    fu_vax = split_follow_up(starts, np.array([150.0]))
+    np.testing.assert_array_equal(fu_vax, [[150, 0, 0, 0, 0, 0, 0]])
+
+
+def test_fu_vax_dose():
+    for case, expected in EXPECTED.items():
+        start_date, _, died_day = case
+        end_date = start_date + timedelta(365)
+        result = fu_vax_dose(extract(*case), str(start_date), str(end_date))
+        assert result["status"].tolist() == [2]
+        assert result["fu"].tolist() == [died_day]
+        np.testing.assert_array_equal(
+            result[[f"fu_vax_{dose}" for dose in range(DOSES + 1)]], [expected]
+        )
+
+
+def test_split_wave_drops_patients_without_follow_up(tmp_path):
+    start_date, dose_days, died_day = DOSES_IN_WAVE
+    data = pd.concat(
+        [
+            extract(start_date, dose_days, died_day, has_follow_up)
+            for has_follow_up in ["1", "0", None]
+        ],
+        ignore_index=True,
+    )
+    data["patient_id"] = [1, 2, 3]
+    data.to_csv(tmp_path / "input.csv", index=False)
+    data["has_follow_up"] = data["has_follow_up"].map({"1": True, "0": False})
+    data.to_parquet(tmp_path / "input.parquet", index=False)
+    for input_file in ["input.csv", "input.parquet"]:
+        split_wave(
+            tmp_path / input_file,
+            str(start_date),
+            str(start_date + timedelta(365)),
+            tmp_path / "fu_vax.parquet",
+        )
+        result = pq.read_table(tmp_path / "fu_vax.parquet").to_pandas()
+        assert result["patient_id"].tolist() == [1]
+
+
+def episodes_of(cases):
+    data = pd.concat([extract(*case) for case in cases], ignore_index=True)
+    data["patient_id"] = range(1, len(cases) + 1)
+    start_date = str(cases[0][0])
+    end_date = str(cases[0][0] + timedelta(365))
+    follow_up = fu_vax_dose(data, start_date, end_date)
+    end_dose = dose_at_end(dose_starts(data, start_date), follow_up["fu"].to_numpy())
+    return episodes(follow_up, end_dose)
+
+
+def test_episodes():
+    result = episodes_of([DOSES_IN_WAVE])
+    # fu_vax 56, 42, 42, 42, 18: one episode per dose with follow-up, the
+    # status on the last one
+    assert result["dose"].tolist() == [0, 1, 2, 3, 4]
+    assert result["tstart"].tolist() == [0, 56, 98, 140, 182]
+    assert result["tstop"].tolist() == [56, 98, 140, 182, 200]
+    assert result["status"].tolist() == [0, 0, 0, 0, 2]
+
+
+def test_episodes_death_at_day_0():
+    start_date = DOSES_BEFORE_WAVE[0]
+    cases = [
+        # no doses, died on the start date of the wave
+        (start_date, (), 0),
+        # the fifth dose protects from day -16, the sixth from day 4
+        (start_date, DOSES_BEFORE_WAVE[1], 0),
+        DOSES_BEFORE_WAVE,
+    ]
+    result = episodes_of(cases)
+    # the deaths at day 0 are kept, in an episode of length 0
+    assert result["patient_id"].tolist() == [1, 2, 3, 3]
+    assert result["dose"].tolist() == [0, 5, 5, 6]
+    assert result["tstart"].tolist() == [0, 0, 0, 4]
+    assert result["tstop"].tolist() == [0, 0, 4, 100]
+    assert result["status"].tolist() == [2, 2, 0, 2]
+
+
+def test_split_wave_episodes(tmp_path):
+    start_date = DOSES_BEFORE_WAVE[0]
+    data = pd.concat(
+        [extract(*DOSES_BEFORE_WAVE), extract(start_date, (), 0)], ignore_index=True
+    )
+    data["patient_id"] = [1, 2]
+    data.to_csv(tmp_path / "input.csv", index=False)
+    split_wave(
+        tmp_path / "input.csv",
+        str(start_date),
+        str(start_date + timedelta(365)),
+        tmp_path / "fu_vax.parquet",
+        tmp_path / "episodes.parquet",
+    )
+    result = pq.read_table(tmp_path / "episodes.parquet").to_pandas()
+    assert result["patient_id"].tolist() == [1, 1, 2]
+    assert result.groupby("patient_id")["status"].max().tolist() == [2, 2]
@@ -0,0 +1,74 @@
+# Test for codelist_cache.py
+# usage: python -m pytest analysis/utils/test/codelist_cache_test.py
+import os
+
+from cohortextractor import codelist_from_csv
+
+from codelist_cache import CODELISTS_DIR, REPO_DIR, CodelistBundle
+
+
+def write_csv(path, rows):
+    with open(path, "w") as f:
+        f.write("code,category\n")
+        for code, category in rows:
+            f.write(f"{code},{category}\n")
+    # (a new modification time, also on file systems with a coarse clock)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_same_codes_as_codelist_from_csv(tmp_path):
+    bundle = CodelistBundle(cache_file=tmp_path / "codelists.pickle")
+    for filename, column, category_column in [
+        ("codelists/opensafely-ethnicity.csv", "Code", "Grouping_6"),
+        ("codelists/opensafely-asthma-diagnosis.csv", "CTV3ID", None),
+    ]:
+        compiled = bundle.get(filename, column, category_column)
+        expected = codelist_from_csv(
+            str(REPO_DIR / filename),
+            system="ctv3",
+            column=column,
+            category_column=category_column,
+        )
+        assert compiled.to_codes() == list(expected)
+
+
+def test_relative_file_names_from_another_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bundle = CodelistBundle(cache_file=tmp_path / "codelists.pickle")
+    assert bundle.codelists_json == CODELISTS_DIR / "codelists.json"
+    # (the sha of the csv is part of the cache key)
+    assert bundle.shas["opensafely-ethnicity.csv"] is not None
+    compiled = bundle.get("codelists/opensafely-ethnicity.csv", "Code")
+    assert len(compiled) > 0
+
+
+def test_bundle_is_reused(tmp_path):
+    cache_file = tmp_path / "codelists.pickle"
+    csv_file = tmp_path / "codes.csv"
+    write_csv(csv_file, [("A1", "1"), ("B2", "2")])
+    bundle = CodelistBundle(cache_file=cache_file)
+    bundle.get(csv_file, category_column="category")
+    assert bundle.dirty
+    bundle.save()
+    bundle = CodelistBundle(cache_file=cache_file)
+    compiled = bundle.get(csv_file, category_column="category")
+    assert not bundle.dirty
+    assert compiled.to_codes() == [("A1", "1"), ("B2", "2")]
+
+
+def test_changed_csv_does_not_grow_the_tables(tmp_path):
+    cache_file = tmp_path / "codelists.pickle"
+    csv_file = tmp_path / "codes.csv"
+    for number in range(3):
+        write_csv(csv_file, [(f"A{number}", f"{number}"), ("B", "b")])
+        bundle = CodelistBundle(cache_file=cache_file)
+        compiled = bundle.get(csv_file, category_column="category")
+        assert compiled.to_codes() == [(f"A{number}", f"{number}"), ("B", "b")]
+        bundle.save()
+    bundle = CodelistBundle(cache_file=cache_file)
+    assert sorted(bundle.codes) == ["A2", "B"]
+    assert sorted(bundle.categories) == ["2", "b"]
+    assert bundle.get(csv_file, category_column="category").to_codes() == [
+        ("A2", "2"), ("B", "b")
+    ]
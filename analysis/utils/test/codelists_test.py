@@ -0,0 +1,56 @@
+# Test for the lazy loading of the codelists in codelists.py
+# usage: python -m pytest analysis/utils/test/codelists_test.py
+import pytest
+from cohortextractor import codelist_from_csv
+
+import codelists
+from codelist_cache import REPO_DIR
+
+
+@pytest.fixture
+def unloaded(monkeypatch):
+    """
+    codelists without memoised csv codelists, recording the csv reads
+    """
+    for name in codelists.csv_codelists:
+        monkeypatch.delitem(vars(codelists), name, raising=False)
+    reads = []
+    read = codelists.codelist_from_cache
+
+    def recorded(**arguments):
+        reads.append(arguments["filename"])
+        return read(**arguments)
+
+    monkeypatch.setattr(codelists, "codelist_from_cache", recorded)
+    return reads
+
+
+def test_csv_read_on_first_use_only(unloaded):
+    assert unloaded == []
+    first = codelists.ethnicity_codes
+    assert unloaded == ["codelists/opensafely-ethnicity.csv"]
+    assert codelists.ethnicity_codes is first
+    assert unloaded == ["codelists/opensafely-ethnicity.csv"]
+
+
+def test_from_import(unloaded):
+    from codelists import asthma_codes  # noqa: F401
+
+    assert unloaded == ["codelists/opensafely-asthma-diagnosis.csv"]
+
+
+def test_same_codelists_as_codelist_from_csv(unloaded):
+    for name, arguments in codelists.csv_codelists.items():
+        expected = codelist_from_csv(
+            **dict(arguments, filename=str(REPO_DIR / arguments["filename"]))
+        )
+        loaded = getattr(codelists, name)
+        assert list(loaded) == list(expected), name
+        assert loaded.system == expected.system
+        assert loaded.has_categories == expected.has_categories
+
+
+def test_unknown_codelist():
+    with pytest.raises(AttributeError):
+        codelists.no_such_codes
+    assert "ethnicity_codes" in dir(codelists)
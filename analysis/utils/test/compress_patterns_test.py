@@ -0,0 +1,130 @@
+# Test for compress_patterns.py: the patterns with their frequency weights
+# have the counts and the (Breslow) Cox partial likelihood of the patients
+# usage: python -m pytest analysis/utils/test/compress_patterns_test.py
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+
+from compress_patterns import (
+    WEIGHT_COLUMN,
+    PatternEncoder,
+    compress_wave,
+    compression_report,
+    model_columns,
+)
+
+
+def processed_data(n=5000, seed=1):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "agegroup": pd.Categorical(
+                rng.choice(["18-39", "40-49", "50-59"], n),
+                categories=["50-59", "18-39", "40-49"],
+            ),
+            "sex": pd.Categorical(rng.choice(["F", "M"], n)),
+            "bmi": pd.Categorical(
+                rng.choice(["Not obese", "Obese I", None], n, p=[0.6, 0.3, 0.1]),
+                categories=["Not obese", "Obese I"],
+            ),
+            "age": rng.integers(18, 30, n),
+            "stp": rng.choice(["STP1", "STP2", "STP3"], n),
+            "fu": rng.integers(1, 20, n).astype(float),
+            "status": pd.Categorical(rng.choice(["0", "1", "2"], n, p=[0.8, 0.1, 0.1])),
+        }
+    )
+
+
+def test_model_columns():
+    assert model_columns("agegroup") == ["agegroup", "sex", "stp", "fu", "status"]
+    assert model_columns("sex") == ["sex", "age", "stp", "fu", "status"]
+    assert model_columns("bmi") == ["bmi", "age", "sex", "stp", "fu", "status"]
+
+
+def test_patterns_are_the_counts():
+    data = processed_data()
+    columns = model_columns("bmi")
+    patterns = PatternEncoder(data).patterns(columns)
+    expected = (
+        data.groupby(columns, dropna=False, observed=True)
+        .size()
+        .rename(WEIGHT_COLUMN)
+        .reset_index()
+    )
+    # one row per combination (missing values are a level), weights sum to
+    # the number of patients
+    assert patterns[WEIGHT_COLUMN].sum() == len(data)
+    assert not patterns[columns].duplicated().any()
+    assert patterns["bmi"].isna().any()
+    sort = lambda frame: frame.sort_values(columns).reset_index(drop=True)
+    pdt.assert_frame_equal(
+        sort(patterns), sort(expected), check_dtype=False, check_categorical=False
+    )
+    # (factors keep their levels: the reference levels of the models)
+    assert list(patterns["bmi"].cat.categories) == ["Not obese", "Obese I"]
+    patterns = PatternEncoder(data).patterns(model_columns("agegroup"))
+    assert list(patterns["agegroup"].cat.categories) == ["50-59", "18-39", "40-49"]
+
+
+def breslow_log_likelihood(fu, event, x, beta, weights):
+    """
+    Cox partial log likelihood with the Breslow approximation of ties and
+    frequency weights
+    """
+    eta = x @ beta
+    log_likelihood = 0.0
+    for time in np.unique(fu[event]):
+        at_time = event & (fu == time)
+        deaths = weights[at_time].sum()
+        risk = weights[fu >= time] @ np.exp(eta[fu >= time])
+        log_likelihood += weights[at_time] @ eta[at_time] - deaths * np.log(risk)
+    return log_likelihood
+
+
+def design(frame):
+    return np.column_stack(
+        [
+            (frame["agegroup"] == "18-39").to_numpy(float),
+            (frame["agegroup"] == "40-49").to_numpy(float),
+            (frame["sex"] == "M").to_numpy(float),
+        ]
+    )
+
+
+def log_likelihood_of(frame, weights, beta):
+    event = (frame["status"] == "1").to_numpy()
+    return breslow_log_likelihood(
+        frame["fu"].to_numpy(), event, design(frame), beta, weights
+    )
+
+
+def test_same_partial_likelihood():
+    data = processed_data()
+    patterns = PatternEncoder(data).patterns(model_columns("agegroup"))
+    assert len(patterns) < len(data)
+    beta = np.array([0.3, -0.2, 0.5])
+    assert np.isclose(
+        log_likelihood_of(patterns, patterns[WEIGHT_COLUMN].to_numpy(float), beta),
+        log_likelihood_of(data, np.ones(len(data)), beta),
+    )
+
+
+def test_compress_wave(tmp_path):
+    data = processed_data()
+    data.to_parquet(tmp_path / "input_wave1.parquet", index=False)
+    subgroups = ["agegroup", "sex", "bmi"]
+    n_patients, n_patterns = compress_wave(
+        tmp_path / "input_wave1.parquet", subgroups, tmp_path, "wave1"
+    )
+    assert n_patients == len(data)
+    for subgroup in subgroups:
+        patterns = pd.read_parquet(tmp_path / f"wave1_{subgroup}.parquet")
+        assert list(patterns) == [*model_columns(subgroup), WEIGHT_COLUMN]
+        assert patterns[WEIGHT_COLUMN].sum() == len(data)
+        assert n_patterns[subgroup] == len(patterns)
+    report = compression_report({"wave1": (n_patients, n_patterns)})
+    assert report["subgroup"].tolist() == subgroups
+    assert (report["patients"] == len(data)).all()
+    assert report["reduction"].tolist() == [
+        len(data) / n_patterns[subgroup] for subgroup in subgroups
+    ]
@@ -0,0 +1,81 @@
+# Test for config.py
+# usage: python -m pytest analysis/utils/test/config_test.py
+import datetime
+import json
+
+import pytest
+
+from config import CONFIG_FILE, load_config, parse_config
+
+
+def config_data(**changes):
+    data = {
+        "dates": {"start_date": "2020-03-15", "end_date": "2020-12-31"},
+        "wave1": {"start_date": "2020-03-23", "end_date": "2020-05-30"},
+        "wave2": {"start_date": "2020-09-07", "end_date": "2021-04-24"},
+        "demographics": ["ethnicity", "region"],
+        "comorbidities": ["asthma"],
+    }
+    data.update(changes)
+    return data
+
+
+def test_repo_config():
+    with open(CONFIG_FILE, "r") as f:
+        data = json.load(f)
+    config = load_config()
+    assert config is load_config()
+    assert list(config.waves) == [key for key in data if key.startswith("wave")]
+    assert config.wave_dates("wave1") == (
+        data["wave1"]["start_date"], data["wave1"]["end_date"]
+    )
+    assert config.subgroups == tuple(data["demographics"] + data["comorbidities"])
+
+
+def test_month_index_dates():
+    config = parse_config(config_data())
+    # (first of the month on or after the start date)
+    assert config.month_index_dates[0] == datetime.date(2020, 4, 1)
+    assert config.month_index_dates[-1] == datetime.date(2020, 12, 1)
+    assert len(config.month_index_dates) == 9
+    assert config.index_date_range == "2020-04-01 to 2020-12-01 by month"
+
+
+def test_waves_in_order_of_the_file():
+    data = config_data()
+    data = {"wave2": data.pop("wave2"), **data}
+    assert list(parse_config(data).waves) == ["wave2", "wave1"]
+
+
+@pytest.mark.parametrize(
+    "changes",
+    [
+        {"dates": {"start_date": "2020-03-15"}},
+        {"wave1": {"start_date": "2020-06-01", "end_date": "2020-05-30"}},
+        {"wave1": {"start_date": "23/03/2020", "end_date": "2020-05-30"}},
+        {"demographics": "ethnicity"},
+        {"comorbidities": ["asthma", "asthma"]},
+    ],
+)
+def test_invalid_config(changes):
+    with pytest.raises(ValueError):
+        parse_config(config_data(**changes))
+
+
+def test_missing_keys():
+    data = config_data()
+    del data["comorbidities"]
+    with pytest.raises(ValueError):
+        parse_config(data)
+    data = config_data()
+    del data["wave1"], data["wave2"]
+    with pytest.raises(ValueError):
+        parse_config(data)
+
+
+def test_config_is_immutable():
+    config = parse_config(config_data())
+    with pytest.raises(AttributeError):
+        config.demographics = ()
+    with pytest.raises(TypeError):
+        config.waves["wave3"] = config.waves["wave1"]
@@ -0,0 +1,6 @@
+# The python tests import the modules in analysis/ (as the scripts do when
+# run from the repo root as python analysis/<script>.py)
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
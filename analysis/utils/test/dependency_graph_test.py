@@ -0,0 +1,77 @@
+# Test for dependency_graph.py
+# usage: python -m pytest analysis/utils/test/dependency_graph_test.py
+import json
+
+from cohortextractor import patients
+
+from dependency_graph import DependencyGraph, load_costs, report
+
+DEFINITIONS = dict(
+    population=patients.satisfying(
+        "registered AND age >= 18",
+        registered=patients.registered_as_of("index_date"),
+        unused=patients.registered_as_of("index_date - 1 year"),
+    ),
+    age=patients.age_as_of("index_date"),
+    died=patients.died_from_any_cause(
+        on_or_after="index_date", returning="date_of_death"
+    ),
+    died_after=patients.died_from_any_cause(
+        on_or_after="died + 1 day", returning="binary_flag"
+    ),
+)
+
+
+def write_results(path, variables):
+    # (format of output/benchmarks/extraction.json, see benchmark_extraction.py)
+    results = {
+        "study_definition": {
+            "study_definition": "study_definition",
+            "variables": variables,
+            "queries": 10,
+            "sql_chars": 1000,
+        }
+    }
+    path.write_text(json.dumps(results))
+
+
+def test_graph():
+    graph = DependencyGraph(DEFINITIONS)
+    assert graph.dependencies["population"] == {"registered", "age"}
+    assert graph.dependencies["died_after"] == {"died"}
+    assert graph.dead_variables() == ["unused"]
+    assert graph.levels()[0] == ["registered", "unused", "age", "died"]
+    # (a tie: registered or age, then population)
+    cost, path = graph.critical_path()
+    assert cost == 2
+    assert path in (["registered", "population"], ["age", "population"])
+
+
+def test_load_costs(tmp_path):
+    results_file = tmp_path / "extraction.json"
+    write_results(
+        results_file,
+        {
+            "registered": {"queries": 2, "sql_chars": 100,
+                           "database_seconds": 0.5},
+            "age": {"queries": 2, "sql_chars": 100, "database_seconds": 2.0},
+            "died": {"queries": 2, "sql_chars": 100, "database_seconds": 1.0},
+            "died_after": {"queries": 2, "sql_chars": 100,
+                           "database_seconds": 1.5},
+        },
+    )
+    costs = load_costs("study_definition", results_file)
+    assert costs == {"registered": 0.5, "age": 2.0, "died": 1.0, "died_after": 1.5}
+    result = report(DependencyGraph(DEFINITIONS), costs)
+    assert result["critical_path"] == {
+        "cost": 2.5, "variables": ["died", "died_after"]
+    }
+
+
+def test_no_costs(tmp_path):
+    results_file = tmp_path / "extraction.json"
+    assert load_costs("study_definition", results_file) is None
+    # benchmarked without a database: no timings
+    write_results(results_file, {"age": {"queries": 2, "sql_chars": 100}})
+    assert load_costs("study_definition", results_file) is None
+    assert load_costs("study_definition_wave1", results_file) is None
@@ -0,0 +1,160 @@
+# Test for dummy_data.py
+# usage: python -m pytest analysis/utils/test/dummy_data_test.py
+import pandas as pd
+import pytest
+from cohortextractor import StudyDefinition, codelist, patients
+
+import dummy_data
+from dummy_data import load_study, merge, write_dummy_data
+
+N = 2500
+# (several chunks, the last one smaller)
+CHUNK_SIZE = 1000
+CHUNKS = (1000, 1000, 500)
+
+
+@pytest.fixture(scope="module")
+def study():
+    return StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "1900-01-01", "latest": "2021-12-31"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        index_date="2021-03-01",
+        population=patients.registered_as_of("index_date"),
+        age=patients.age_as_of(
+            "index_date",
+            return_expectations={
+                "rate": "universal",
+                "int": {"distribution": "population_ages"},
+            },
+        ),
+        sex=patients.sex(
+            return_expectations={
+                "rate": "universal",
+                "category": {"ratios": {"M": 0.49, "F": 0.51}},
+            }
+        ),
+        asthma=patients.with_these_clinical_events(
+            codelist(["X"], system="ctv3"),
+            on_or_before="index_date",
+            include_date_of_match=True,
+            date_format="YYYY-MM",
+            return_expectations={"incidence": 0.3},
+        ),
+        died=patients.died_from_any_cause(
+            between=["2021-01-01", "2021-06-30"],
+            returning="date_of_death",
+            date_format="YYYY-MM-DD",
+            return_expectations={
+                "date": {"earliest": "2020-01-01", "latest": "2021-12-31"},
+                "incidence": 0.2,
+            },
+        ),
+        bmi=patients.with_these_clinical_events(
+            codelist(["Y"], system="ctv3"),
+            returning="numeric_value",
+            find_last_match_in_period=True,
+            on_or_before="index_date",
+            return_expectations={
+                "float": {"distribution": "normal", "mean": 28, "stddev": 8},
+                "incidence": 0.8,
+            },
+        ),
+    )
+
+
+def read(path):
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+@pytest.fixture(scope="module")
+def data(study, tmp_path_factory):
+    path = tmp_path_factory.mktemp("dummy") / "input.csv.gz"
+    chunk_size = dummy_data.CHUNK_SIZE
+    dummy_data.CHUNK_SIZE = CHUNK_SIZE
+    try:
+        write_dummy_data(study, N, path, seed=1)
+    finally:
+        dummy_data.CHUNK_SIZE = chunk_size
+    return read(path)
+
+
+def test_columns(study, data):
+    args = study.get_pandas_csv_args(study.covariate_definitions)
+    assert list(data.columns) == ["patient_id", *args["args"]]
+    assert len(data) == N
+
+
+def test_patient_ids(data):
+    patient_ids = data["patient_id"].astype(int)
+    assert patient_ids.is_unique
+    assert patient_ids.is_monotonic_increasing
+
+
+def n_empty(incidence):
+    # exactly int((1 - incidence) * n) empty values per chunk of n patients
+    return sum(int((1 - incidence) * n) for n in CHUNKS)
+
+
+def test_incidence(data):
+    assert (data["asthma"] == "0").sum() == n_empty(0.3)
+    assert (data["asthma"] == "0").sum() + (data["asthma"] == "1").sum() == N
+    # universal: never empty
+    assert (data["sex"] != "").all()
+    assert (data["age"] != "").all()
+
+
+def test_companion_dates(data):
+    # the date of a match is empty where there is no match
+    assert ((data["asthma"] == "1") == (data["asthma_date"] != "")).all()
+    assert data["asthma_date"].str.fullmatch(r"(\d{4}-\d{2})?").all()
+
+
+def test_dates_in_period(data):
+    died = data.loc[data["died"] != "", "died"]
+    assert died.str.fullmatch(r"\d{4}-\d{2}-\d{2}").all()
+    # dates outside the period of the variable are empty
+    assert died.between("2021-01-01", "2021-06-30").all()
+    assert 0 < len(died) < 0.2 * N
+
+
+def test_values(data):
+    assert set(data["sex"]) == {"M", "F"}
+    ages = data["age"].astype(int)
+    assert ages.between(0, 109).all()
+    bmi = pd.to_numeric(data["bmi"])
+    assert (bmi == 0).sum() == n_empty(0.8)
+    assert abs(bmi[bmi != 0].mean() - 28) < 1
+
+
+def test_seed(study, tmp_path):
+    write_dummy_data(study, 100, tmp_path / "a.csv", seed=2)
+    write_dummy_data(study, 100, tmp_path / "b.csv", seed=2)
+    write_dummy_data(study, 100, tmp_path / "c.csv", seed=3)
+    assert read(tmp_path / "a.csv").equals(read(tmp_path / "b.csv"))
+    assert not read(tmp_path / "a.csv").equals(read(tmp_path / "c.csv"))
+
+
+def test_merge():
+    default = {"date": {"earliest": "1900-01-01", "latest": "2021-12-31"},
+               "incidence": 0.5}
+    merged = merge(default, {"date": {"earliest": "2020-01-01"}, "rate": "universal"})
+    assert merged == {
+        "date": {"earliest": "2020-01-01", "latest": "2021-12-31"},
+        "incidence": 0.5,
+        "rate": "universal",
+    }
+    # (the default is not changed)
+    assert default["date"]["earliest"] == "1900-01-01"
+
+
+def test_study_definition_index_date(tmp_path):
+    study = load_study("study_definition", "2021-02-01")
+    write_dummy_data(study, 500, tmp_path / "input.csv", seed=1)
+    data = read(tmp_path / "input.csv")
+    assert len(data) == 500
+    assert "population" not in data.columns
+    with pytest.raises(ValueError):
+        load_study("study_definition", "01/02/2021")
@@ -0,0 +1,260 @@
+# Test for expressions.py against the SQL of categorised_as(): the CASE
+# expression that cohortextractor's TPP backend builds from the category
+# definitions (format_expression(), columns replaced by ISNULL(column, empty
+# value)), evaluated by sqlite on the same data
+# usage: python -m pytest analysis/utils/test/expressions_test.py
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+from cohortextractor.expressions import format_expression
+
+from expressions import (
+    CompiledCategories,
+    compile_categories,
+    evaluate_categories,
+    tokenize,
+)
+
+PLAN_FILE = "analysis/incremental_plan.json"
+EMPTY_VALUES = {"int": 0, "bool": 0, "float": 0.0, "str": "", "date": ""}
+DATES = ["", "2020-01-01", "2020-06-30", "2021-02-15"]
+
+
+def empty_value(name, column_type):
+    # (the TPP backend uses -1 for a missing IMD, 0 is an IMD)
+    if name == "index_of_multiple_deprivation":
+        return -1
+    return EMPTY_VALUES[column_type]
+
+
+def names(category_definitions):
+    return sorted(
+        {
+            value
+            for expression in category_definitions.values()
+            if expression != "DEFAULT"
+            for kind, value in tokenize(expression)
+            if kind == "name"
+        }
+    )
+
+
+def case_sql(category_definitions, types):
+    """
+    The CASE expression of get_case_expression() in cohortextractor's TPP
+    backend
+    """
+    name_map = {name: name for name in names(category_definitions)}
+    empty_value_map = {
+        name: empty_value(name, types[name]) for name in name_map
+    }
+    clauses = []
+    default = None
+    for category, expression in category_definitions.items():
+        if expression == "DEFAULT":
+            default = category
+            continue
+        sql, _ = format_expression(expression, name_map, empty_value_map)
+        clauses.append(f"WHEN ({sql}) THEN '{category}'")
+    return f"CASE {' '.join(clauses)} ELSE '{default}' END"
+
+
+def evaluate_sql(category_definitions, data, types):
+    connection = sqlite3.connect(":memory:")
+    data.to_sql("data", connection, index=False)
+    sql = case_sql(category_definitions, types)
+    rows = connection.execute(f"SELECT {sql} FROM data ORDER BY rowid").fetchall()
+    connection.close()
+    return np.array([row[0] for row in rows], dtype=object)
+
+
+def evaluate(category_definitions, data):
+    return np.array(
+        [str(value) for value in evaluate_categories(category_definitions, data)],
+        dtype=object,
+    )
+
+
+def numbers(category_definitions):
+    """
+    The constants of the expressions and the bin edges of compiled ranges
+    (e.g. 32800*1/5)
+    """
+    constants = {
+        float(value)
+        for expression in category_definitions.values()
+        if expression != "DEFAULT"
+        for kind, value in tokenize(expression)
+        if kind == "number"
+    }
+    edges = compile_categories(category_definitions).edges
+    return sorted(constants | set(edges if edges is not None else []))
+
+
+def values_of(name, column_type, constants):
+    """
+    Values of a column around the constants it is compared with, and its
+    empty value
+    """
+    empty = empty_value(name, column_type)
+    if column_type == "bool":
+        return [0, 1]
+    if column_type == "date":
+        return DATES
+    if column_type == "int":
+        return sorted({empty, *(int(c) + d for c in constants for d in (-1, 0, 1))})
+    if column_type == "float":
+        return sorted(
+            {
+                empty,
+                *constants,
+                *(np.nextafter(c, -np.inf) for c in constants),
+                *(np.nextafter(c, np.inf) for c in constants),
+                *(c + 0.05 for c in constants),
+            }
+        )
+    return None
+
+
+def random_data(category_definitions, types, rng, n=2000):
+    constants = numbers(category_definitions)
+    strings = sorted(
+        {
+            value[1:-1]
+            for expression in category_definitions.values()
+            for kind, value in (tokenize(expression) if expression != "DEFAULT" else [])
+            if kind == "string"
+        }
+        | {"", "X"}
+    )
+    data = {}
+    for name in names(category_definitions):
+        values = values_of(name, types[name], constants)
+        if values is None:
+            values = strings
+        data[name] = rng.choice(np.array(values, dtype=object), n)
+    return pd.DataFrame(data).infer_objects()
+
+
+@pytest.fixture(scope="module")
+def plan():
+    with open(PLAN_FILE) as f:
+        return json.load(f)["columns"]
+
+
+def derived(plan):
+    return {
+        name: {str(category): expression for category, expression in column["categories"]}
+        for name, column in plan.items()
+        if column["kind"] == "derived"
+    }
+
+
+def test_same_as_sql_derived_variables(plan):
+    types = {name: column["type"] for name, column in plan.items()}
+    rng = np.random.default_rng(1)
+    tested = 0
+    for name, category_definitions in derived(plan).items():
+        data = random_data(category_definitions, types, rng)
+        expected = evaluate_sql(category_definitions, data, types)
+        result = evaluate(category_definitions, data)
+        mismatch = np.flatnonzero(result != expected)
+        assert not len(mismatch), (name, data.iloc[mismatch[:5]], result[mismatch[:5]])
+        # (not only the DEFAULT)
+        assert len(set(expected)) > 1, name
+        tested += 1
+    assert tested == len(derived(plan))
+
+
+def test_ranges_are_compiled(plan):
+    # the ranges of one column are evaluated as bins (the path compared with
+    # the SQL above)
+    for name in ["agegroup", "agegroup_std", "bmi", "imd"]:
+        assert compile_categories(derived(plan)[name]).column is not None, name
+
+
+CATEGORIES = {
+    "low": "x > 5 AND x <= 10",
+    "high": "x > 10 AND x < 20.5",
+    # (overlaps low and high: the first matching category is used)
+    "overlap": "x >= 8 AND x < 30",
+    "none": "DEFAULT",
+}
+
+
+@pytest.mark.parametrize("column_type", ["int", "float"])
+def test_half_open_bounds(column_type):
+    if column_type == "int":
+        x = [0, 5, 6, 10, 11, 20, 21, 29, 30, -1]
+    else:
+        x = [
+            0.0, 5.0, np.nextafter(5.0, np.inf), 10.0, np.nextafter(10.0, np.inf),
+            20.5, np.nextafter(20.5, -np.inf), np.nextafter(30.0, -np.inf), 30.0,
+            -1.0,
+        ]
+    data = pd.DataFrame({"x": np.array(x, dtype=column_type)})
+    assert compile_categories(CATEGORIES).column == "x"
+    expected = evaluate_sql(CATEGORIES, data, {"x": column_type})
+    assert evaluate(CATEGORIES, data).tolist() == expected.tolist()
+    if column_type == "float":
+        assert expected.tolist() == [
+            "none", "none", "low", "low", "high", "overlap", "high", "overlap",
+            "none", "none",
+        ]
+
+
+def test_default_branch():
+    # DEFAULT is used if no category matches, wherever it is in the
+    # definitions
+    category_definitions = {"0": "DEFAULT", "1": "x >= 1 AND x < 2", "2": "x >= 2"}
+    data = pd.DataFrame({"x": [0, 1, 2, 3, -5]})
+    expected = evaluate_sql(category_definitions, data, {"x": "int"})
+    assert expected.tolist() == ["0", "1", "2", "2", "0"]
+    assert evaluate(category_definitions, data).tolist() == expected.tolist()
+
+
+def test_empty_values():
+    # missing values are the empty values of the database (ISNULL()): a
+    # column that is not compared is false, a missing date is smaller than
+    # every date
+    category_definitions = {
+        "flag": "flag AND code",
+        "before": "a < b",
+        "after": "a > b",
+        "same": "a = b",
+        "none": "DEFAULT",
+    }
+    data = pd.DataFrame(
+        {
+            "flag": [1, 0, 1, 1, 1, 1],
+            "code": ["A", "A", "", "", "", ""],
+            "a": ["", "", "", "2021-01-01", "2021-02-01", ""],
+            "b": ["", "", "2021-01-01", "", "2021-02-01", ""],
+        }
+    )
+    types = {"flag": "bool", "code": "str", "a": "date", "b": "date"}
+    expected = evaluate_sql(category_definitions, data, types)
+    assert expected.tolist() == ["flag", "same", "before", "after", "same", "same"]
+    assert evaluate(category_definitions, data).tolist() == expected.tolist()
+
+
+def test_integer_division():
+    # 7/2 is 3 in the database (both integers), 7.0/2 is 3.5
+    category_definitions = {"1": "x < 7/2", "2": "x < 7.0/2", "0": "DEFAULT"}
+    data = pd.DataFrame({"x": [2, 3, 4]})
+    expected = evaluate_sql(category_definitions, data, {"x": "int"})
+    assert expected.tolist() == ["1", "2", "0"]
+    assert evaluate(category_definitions, data).tolist() == expected.tolist()
+
+
+def test_missing_numbers_in_no_range():
+    # (NaN is not in an extract, the database returns the empty value; a NaN
+    # is in no range, compiled or not)
+    data = pd.DataFrame({"x": [np.nan, 6.0]})
+    compiled = compile_categories(CATEGORIES)
+    uncompiled = CompiledCategories(compiled.categories, compiled.default)
+    assert compiled.evaluate(data).tolist() == ["none", "low"]
+    assert uncompiled.evaluate(data).tolist() == ["none", "low"]
@@ -0,0 +1,100 @@
+# Test for extract_schema.py
+# usage: python -m pytest analysis/utils/test/extract_schema_test.py
+import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import dummy_data
+from extract_schema import (
+    SCHEMAS_FILE,
+    convert_extract,
+    load_schema,
+    parquet_file_name,
+    write_schemas,
+)
+
+SCHEMA = {
+    "patient_id": ("int", None),
+    "flag": ("bool", None),
+    "count": ("int", None),
+    "value": ("float", None),
+    "day": ("date", "YYYY-MM-DD"),
+    "month": ("date", "YYYY-MM"),
+    "year": ("date", "YYYY"),
+    "group": ("category", None),
+}
+CSV = """patient_id,flag,count,value,day,month,year,group
+1,1,3,27.5,2021-02-03,2021-02,2021,A
+2,0,0,0,,,,
+3,,,,2020-12-31,2020-12,2020,B
+"""
+
+
+def test_schemas_file_is_up_to_date(tmp_path):
+    schemas_file = tmp_path / "extract_schemas.json"
+    write_schemas(schemas_file)
+    assert schemas_file.read_text() == SCHEMAS_FILE.read_text()
+
+
+def test_load_schema_joins_study_definitions():
+    schema = load_schema(["study_definition_wave1", "study_definition_ethnicity"])
+    assert schema["patient_id"] == ("int", None)
+    assert schema["ethnicity"] == ("category", None)
+    assert schema["hypertension"] == ("bool", None)
+    assert schema["bp_sys_date_measured"] == ("date", "YYYY-MM")
+
+
+def test_convert_extract(tmp_path):
+    input_file = tmp_path / "input.csv"
+    input_file.write_text(CSV)
+    output_file = parquet_file_name(input_file)
+    convert_extract(input_file, output_file, SCHEMA)
+    table = pq.read_table(output_file)
+    assert table.schema.field("flag").type == pa.bool_()
+    assert table.schema.field("count").type == pa.int64()
+    assert table.schema.field("value").type == pa.float64()
+    assert table.schema.field("day").type == pa.date32()
+    assert pa.types.is_dictionary(table.schema.field("group").type)
+    data = table.to_pydict()
+    # missing values ('') are nulls, a 0 is not missing
+    assert data["flag"] == [True, False, None]
+    assert data["count"] == [3, 0, None]
+    assert data["value"] == [27.5, 0.0, None]
+    assert data["group"] == ["A", None, "B"]
+    # partial dates are the first day of the month/year
+    assert data["day"] == [datetime.date(2021, 2, 3), None,
+                           datetime.date(2020, 12, 31)]
+    assert data["month"] == [datetime.date(2021, 2, 1), None,
+                             datetime.date(2020, 12, 1)]
+    assert data["year"] == [datetime.date(2021, 1, 1), None,
+                            datetime.date(2020, 1, 1)]
+
+
+def test_unknown_column(tmp_path):
+    input_file = tmp_path / "input.csv"
+    input_file.write_text(CSV)
+    schema = {name: SCHEMA[name] for name in SCHEMA if name != "group"}
+    with pytest.raises(ValueError, match="group"):
+        convert_extract(input_file, tmp_path / "input.parquet", schema)
+
+
+def test_convert_dummy_extract(tmp_path):
+    # the dummy data of study_definition.py as a compressed csv, as the csv
+    # written by cohortextractor
+    input_file = tmp_path / "input_2020-03-01.csv.gz"
+    dummy_data.write_dummy_data(
+        dummy_data.load_study("study_definition"), 2000, input_file, seed=1
+    )
+    output_file = parquet_file_name(input_file)
+    assert output_file == tmp_path / "input_2020-03-01.parquet"
+    schema = load_schema(["study_definition"])
+    convert_extract(input_file, output_file, schema)
+    csv = pd.read_csv(input_file, dtype=str, keep_default_na=False)
+    table = pq.read_table(output_file)
+    assert table.column_names == list(csv.columns)
+    assert table.num_rows == len(csv)
+    for name in csv.columns:
+        assert table.column(name).null_count == (csv[name] == "").sum(), name
@@ -0,0 +1,94 @@
+# Test for join_cohorts.py: a left join on patient_id, missing values are
+# empty (as cohort-joiner)
+# usage: python -m pytest analysis/utils/test/join_cohorts_test.py
+import gzip
+
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+import join_cohorts
+from join_cohorts import build_lookup, join_cohorts as join
+
+LHS = """patient_id,age,sex
+7,40,F
+1000000000,50,M
+3,60,
+12,70,F
+"""
+RHS = """patient_id,ethnicity,ethnicity_6
+12,2,4
+7,,1
+5,3,3
+1000000000,1,1
+"""
+
+
+def read(path):
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+@pytest.fixture
+def files(tmp_path):
+    (tmp_path / "input").mkdir()
+    with gzip.open(tmp_path / "input" / "input_2020-03-01.csv.gz", "wt") as f:
+        f.write(LHS)
+    (tmp_path / "input" / "input_2020-04-01.csv").write_text(
+        "patient_id,age,sex\n5,30,M\n"
+    )
+    rhs_file = tmp_path / "input" / "input_ethnicity.csv"
+    rhs_file.write_text(RHS)
+    return tmp_path, rhs_file
+
+
+def test_left_join(files):
+    tmp_path, rhs_file = files
+    join(str(tmp_path / "input" / "input_*"), rhs_file, tmp_path / "joined")
+    # (the rhs is not joined with itself)
+    assert sorted(path.name for path in (tmp_path / "joined").iterdir()) == [
+        "input_2020-03-01.csv.gz", "input_2020-04-01.csv"
+    ]
+    joined = read(tmp_path / "joined" / "input_2020-03-01.csv.gz")
+    expected = read(tmp_path / "input" / "input_2020-03-01.csv.gz").merge(
+        read(rhs_file), on="patient_id", how="left"
+    ).fillna("")
+    pdt.assert_frame_equal(joined, expected)
+    # rows and order of the lhs; a patient that is not in the rhs and a
+    # missing value in the rhs are both empty
+    assert joined["patient_id"].tolist() == ["7", "1000000000", "3", "12"]
+    assert joined["ethnicity"].tolist() == ["", "1", "", "2"]
+    assert joined["ethnicity_6"].tolist() == ["1", "1", "", "4"]
+    joined = read(tmp_path / "joined" / "input_2020-04-01.csv")
+    assert joined.values.tolist() == [["5", "30", "M", "3", "3"]]
+
+
+def test_chunks(files, monkeypatch):
+    tmp_path, rhs_file = files
+    monkeypatch.setattr(join_cohorts, "CHUNK_SIZE", 1)
+    join(str(tmp_path / "input" / "input_2020-03-01*"), rhs_file, tmp_path / "joined")
+    joined = read(tmp_path / "joined" / "input_2020-03-01.csv.gz")
+    assert joined["ethnicity"].tolist() == ["", "1", "", "2"]
+
+
+def test_empty_rhs(files):
+    tmp_path, rhs_file = files
+    rhs_file.write_text("patient_id,ethnicity\n")
+    join(str(tmp_path / "input" / "input_2020-03-01*"), rhs_file, tmp_path / "joined")
+    joined = read(tmp_path / "joined" / "input_2020-03-01.csv.gz")
+    assert list(joined.columns) == ["patient_id", "age", "sex", "ethnicity"]
+    assert joined["ethnicity"].tolist() == ["", "", "", ""]
+
+
+def test_lookup_is_sized_by_the_rhs(files):
+    tmp_path, rhs_file = files
+    lookup = build_lookup(rhs_file, tmp_path / "lookup.npy")
+    # one row per patient of the rhs, not per patient_id up to the largest
+    assert len(lookup.table) == 4
+    assert (tmp_path / "lookup.npy").stat().st_size < 1000
+
+
+def test_duplicate_patient_id(files):
+    tmp_path, rhs_file = files
+    rhs_file.write_text(RHS + "7,1,1\n")
+    with pytest.raises(ValueError):
+        build_lookup(rhs_file, tmp_path / "lookup.npy")
@@ -0,0 +1,113 @@
+# Test for kaplan_meier.py: the curves against a Kaplan-Meier estimate and
+# Greenwood standard error computed by hand, collapsed tables and the
+# rounding of the counts
+# usage: python -m pytest analysis/utils/test/kaplan_meier_test.py
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+
+from kaplan_meier import (
+    Z,
+    collapse,
+    event_table,
+    event_tables,
+    kaplan_meier,
+    round_mid,
+    round_table,
+)
+
+
+def patients(n=2000, seed=1):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "sex": pd.Categorical(rng.choice(["F", "M"], n)),
+            "agegroup": pd.Categorical(rng.choice(["18-39", "40-49", "50-59"], n)),
+            "fu": rng.integers(0, 30, n).astype(float),
+            "status": pd.Categorical(rng.choice(["0", "1", "2"], n, p=[0.7, 0.2, 0.1])),
+        }
+    )
+
+
+def test_greenwood():
+    # 6 patients: a death at 1, censored at 2, two deaths at 3, a death and
+    # a censoring at 5
+    data = pd.DataFrame(
+        {
+            "fu": [1.0, 2.0, 3.0, 3.0, 5.0, 5.0],
+            "status": ["1", "0", "1", "1", "1", "2"],
+        }
+    )
+    curves = kaplan_meier(event_table(data, []), [])
+    assert curves["time"].tolist() == [1.0, 2.0, 3.0, 5.0]
+    assert curves["n_risk"].tolist() == [6, 5, 4, 2]
+    assert curves["n_event"].tolist() == [1, 0, 2, 1]
+    assert curves["n_censor"].tolist() == [0, 1, 0, 1]
+    # surv: 5/6, 5/6 * 2/4, 5/12 * 1/2; Greenwood: d / (n (n - d)) summed
+    surv = np.array([5 / 6, 5 / 6, 5 / 12, 5 / 24])
+    std_err = np.sqrt(np.cumsum([1 / 30, 0, 1 / 4, 1 / 2]))
+    np.testing.assert_allclose(curves["surv"], surv)
+    np.testing.assert_allclose(curves["std_err"], std_err)
+    np.testing.assert_allclose(curves["lower"], surv * np.exp(-Z * std_err))
+    np.testing.assert_allclose(
+        curves["upper"], np.minimum(surv * np.exp(Z * std_err), 1)
+    )
+
+
+def test_collapse():
+    data = patients()
+    table = event_table(data, ["sex", "agegroup"])
+    pdt.assert_frame_equal(
+        collapse(table, ["sex"]).sort_values(["sex", "time"]).reset_index(drop=True),
+        event_table(data, ["sex"]).sort_values(["sex", "time"]).reset_index(drop=True),
+    )
+    pdt.assert_frame_equal(
+        kaplan_meier(collapse(table, []), []), kaplan_meier(event_table(data, []), [])
+    )
+
+
+def test_event_tables_in_batches(tmp_path):
+    data = patients()
+    data.to_parquet(tmp_path / "input_wave1.parquet", index=False)
+    all_strata = [["sex"], ["sex", "agegroup"]]
+    tables = event_tables(tmp_path / "input_wave1.parquet", all_strata)
+    batched = event_tables(tmp_path / "input_wave1.parquet", all_strata, batch_size=300)
+    for name in ["sex", "sex_agegroup"]:
+        pdt.assert_frame_equal(tables[name], batched[name])
+    assert tables["sex"]["n_enter"].sum() == len(data)
+
+
+def test_round_mid():
+    assert round_mid([0, 1, 6, 7, 12, 13]).tolist() == [0, 3, 3, 9, 9, 15]
+
+
+def test_round_table():
+    data = patients()
+    strata = ["sex", "agegroup"]
+    table = event_table(data, strata)
+    rounded = round_table(table, strata)
+    # (cumulative counts at midpoints: no count of a stratum reveals a small
+    # number, the totals are rounded)
+    for _, stratum in rounded.groupby(strata, observed=True):
+        for column in ["n_event", "n_censor", "n_enter"]:
+            assert (stratum[column] >= 0).all()
+            cumulative = stratum[column].cumsum()
+            assert ((cumulative == 0) | (cumulative % 6 == 3)).all()
+    totals = table.groupby(strata)["n_enter"].sum()
+    assert (rounded.groupby(strata)["n_enter"].sum() == round_mid(totals)).all()
+    curves = kaplan_meier(rounded, strata)
+    assert ((curves["n_risk"] % 6 == 3) | (curves["n_risk"] == 0)).all()
+    for _, curve in curves.groupby(strata):
+        assert (curve["surv"].diff().dropna() <= 0).all()
+
+
+def test_round_table_end_of_curve():
+    # 7 patients: 9 after rounding; 4 deaths and 3 censorings: 3 and 3
+    data = pd.DataFrame(
+        {"fu": [1.0] * 4 + [2.0] * 3, "status": ["1"] * 4 + ["0"] * 3}
+    )
+    curves = kaplan_meier(round_table(event_table(data, []), []), [])
+    assert curves["n_risk"].tolist() == [9, 6]
+    assert curves["n_event"].tolist() == [3, 0]
+    assert curves["n_censor"].tolist() == [0, 3]
+    np.testing.assert_allclose(curves["surv"], [2 / 3, 2 / 3])
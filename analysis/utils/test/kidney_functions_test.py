@@ -0,0 +1,112 @@
+# Test for egfr() and ckd_rrt() in derived_variables.py (the cases of
+# kidney_functions_test.R)
+# usage: python -m pytest analysis/utils/test/kidney_functions_test.py
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from derived_variables import add_derived_variables, ckd_rrt, egfr
+
+
+def test_egfr_usable_creatinine():
+    # all combinations of creatinine, operator, age at measurement and sex
+    data = pd.DataFrame(
+        itertools.product(
+            [10, 4000, 20, 3000, 60, None],
+            ["=", "~", "<", "<=", ">", ">=", None],
+            [50, None],
+            ["F", "M", None],
+        ),
+        columns=["creatinine", "creatinine_operator", "creatinine_age", "sex"],
+    )
+    # egfr is only calculated if creatinine is not missing and between 20
+    # and 3000, the operator is missing or "=" and the age is not missing
+    usable = (
+        data["creatinine"].between(20, 3000)
+        & (data["creatinine_operator"].isna() | (data["creatinine_operator"] == "="))
+        & data["creatinine_age"].notna()
+    )
+    assert (egfr(data).notna() == usable).all()
+
+
+def test_egfr_ckd_epi():
+    data = pd.DataFrame(
+        {
+            "creatinine": [60, 60, 60, 150],
+            "creatinine_operator": [None, "=", None, None],
+            "creatinine_age": [50, 50, 70, 40],
+            "sex": ["M", "F", None, "F"],
+        }
+    )
+    # creatinine umol/l -> mg/dl
+    scr = data["creatinine"] / 88.4
+    # (equation for males if sex is missing)
+    k = np.where(data["sex"] == "F", 0.7, 0.9)
+    alpha = np.where(data["sex"] == "F", -0.329, -0.411)
+    expected = (
+        np.minimum(scr / k, 1) ** alpha
+        * np.maximum(scr / k, 1) ** -1.209
+        * 141
+        * 0.993 ** data["creatinine_age"]
+        * np.where(data["sex"] == "F", 1.018, 1)
+    )
+    np.testing.assert_allclose(egfr(data), expected)
+
+
+def test_ckd_rrt():
+    # for rrt_cat: 0 no rrt, 1 rrt (dialysis), 2 rrt (kidney transplant)
+    data = pd.DataFrame(
+        {
+            "rrt_cat": ["0"] * 11 + ["1"] * 2 + ["2"] * 2,
+            "egfr": [
+                0, 7.5, 15, 22.5, 30, 37.5, 45, 52.5, 60, 65, None,
+                10, None,
+                0, None,
+            ],
+        }
+    )
+    expected = (
+        ["Stage 5"] * 2
+        + ["Stage 4"] * 2
+        + ["Stage 3b"] * 2
+        + ["Stage 3a"] * 2
+        + ["No CKD or RRT"] * 3
+        + ["RRT (dialysis)"] * 2
+        + ["RRT (transplant)"] * 2
+    )
+    assert ckd_rrt(data).tolist() == expected
+
+
+def test_ckd_rrt_from_extract():
+    # RRT takes precedence over the egfr of the creatinine level
+    data = pd.DataFrame(
+        {
+            "creatinine": [60, 1000, 1000, None],
+            "creatinine_operator": [None] * 4,
+            "creatinine_age": [50] * 4,
+            "sex": ["M"] * 4,
+            "rrt_cat": ["0", "0", "1", None],
+        }
+    )
+    data = add_derived_variables(data, ["ckd_rrt"])
+    assert data["ckd_rrt"].tolist()[:3] == [
+        "No CKD or RRT", "Stage 5", "RRT (dialysis)"
+    ]
+    assert pd.isna(data["ckd_rrt"][3])
+
+
+def test_ckd_rrt_negative_egfr():
+    # a negative egfr is in no stage: missing, also if rrt_cat is "0" (only a
+    # missing egfr is No CKD or RRT), unless rrt_cat is RRT
+    data = pd.DataFrame(
+        {
+            "rrt_cat": ["0", "0", "1", "2", None, None],
+            "egfr": [-1.0, None, -1.0, -0.5, -1.0, None],
+        }
+    )
+    result = ckd_rrt(data)
+    assert pd.isna(result[0])
+    assert result[1] == "No CKD or RRT"
+    assert result[2:4].tolist() == ["RRT (dialysis)", "RRT (transplant)"]
+    assert result[4:].isna().all()
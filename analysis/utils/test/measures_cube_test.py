@@ -0,0 +1,91 @@
+# Test for measures_cube.py: the mortality rates are the rates of
+# cohortextractor's Measure (generate_measures) on the same extract
+# usage: python -m pytest analysis/utils/test/measures_cube_test.py
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+from cohortextractor import Measure
+from cohortextractor.cohortextractor import _load_dataframe_for_measures
+
+import dummy_data
+from config import load_config
+from derived_variables import DERIVED_VARIABLES
+from measures_cube import (
+    DENOMINATOR,
+    NUMERATOR,
+    calculate_measures,
+    measure_group_bys,
+    read_extract,
+)
+
+
+@pytest.fixture(scope="module")
+def extract(tmp_path_factory):
+    path = tmp_path_factory.mktemp("joined") / "input_2020-03-01.csv.gz"
+    dummy_data.write_dummy_data(
+        dummy_data.load_study("study_definition"), 5000, path, seed=1
+    )
+    # (the joined extracts have the ethnicity of study_definition_ethnicity,
+    # with missing values)
+    data = pd.read_csv(path, dtype=str, keep_default_na=False)
+    rng = np.random.default_rng(1)
+    data["ethnicity"] = rng.choice(["1", "2", "3", "4", "5", ""], len(data))
+    data.to_csv(path, index=False)
+    return path
+
+
+def extracted_group_bys():
+    # (derived group by columns are not columns of the extract, there is no
+    # Measure of them)
+    return [
+        (measure_id, group_by)
+        for measure_id, group_by in measure_group_bys(load_config())
+        if not set(group_by) & set(DERIVED_VARIABLES)
+    ]
+
+
+def test_same_as_measure(extract):
+    group_bys = extracted_group_bys()
+    assert len(group_bys) > 3
+    columns = sorted({c for _, group_by in group_bys for c in group_by} - {DENOMINATOR})
+    results = calculate_measures(read_extract(extract, columns), group_bys)
+    measures = [
+        Measure(id=measure_id, numerator=NUMERATOR, denominator=DENOMINATOR,
+                group_by=group_by)
+        for measure_id, group_by in group_bys
+    ]
+    patients = _load_dataframe_for_measures(extract, measures)
+    for measure in measures:
+        expected = measure.calculate(patients, lambda message: None)
+        result = results[measure.id]
+        if measure.group_by == [DENOMINATOR]:
+            assert result[NUMERATOR].tolist() == expected[NUMERATOR].tolist()
+            assert result[DENOMINATOR].tolist() == expected[DENOMINATOR].tolist()
+            continue
+        # all combinations of the levels; combinations without patients are
+        # the combinations that Measure leaves out (observed levels only)
+        result = result.astype({c: str for c in measure.group_by})
+        expected = expected.astype({c: str for c in measure.group_by})
+        expected = expected[expected[DENOMINATOR] > 0]
+        assert (result.loc[result[DENOMINATOR] == 0, NUMERATOR] == 0).all()
+        result = result[result[DENOMINATOR] > 0]
+        pdt.assert_frame_equal(
+            result.sort_values(measure.group_by).reset_index(drop=True),
+            expected[result.columns]
+            .sort_values(measure.group_by)
+            .reset_index(drop=True),
+            check_dtype=False,
+            check_names=False,
+        )
+
+
+def test_missing_levels(extract):
+    results = calculate_measures(
+        read_extract(extract, ["agegroup_std", "ethnicity", "sex"]),
+        [("ethnicity_mortality_rate", ["agegroup_std", "sex", "ethnicity"])],
+    )
+    result = results["ethnicity_mortality_rate"]
+    # a missing value of an extracted column is an empty level
+    assert "" in set(result["ethnicity"])
+    assert result[DENOMINATOR].sum() == 5000
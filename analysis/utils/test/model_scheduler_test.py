@@ -0,0 +1,133 @@
+# Test for model_scheduler.py with the poisson engine: cache keys, cache hits
+# and the models fitted again after a change of data, config or subgroups
+# usage: python -m pytest analysis/utils/test/model_scheduler_test.py
+import json
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+from model_scheduler import config_hash, fit_cox, run, task_key
+from poisson_rates import fit_waves
+
+CONFIG = {
+    "dates": {"start_date": "2020-03-01", "end_date": "2022-02-28"},
+    "wave1": {"start_date": "2020-03-23", "end_date": "2020-05-30"},
+    "wave2": {"start_date": "2020-09-07", "end_date": "2021-04-24"},
+    "demographics": ["bmi"],
+    "comorbidities": [],
+}
+
+
+def processed_data(seed, n=20_000):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "bmi": pd.Categorical(rng.choice(["Not obese", "Obese I"], n)),
+            "asthma": pd.Categorical(rng.choice(["0", "1"], n)),
+            "agegroup_std": pd.Categorical(
+                rng.choice(["40-44 years", "80-84 years"], n)
+            ),
+            "sex": pd.Categorical(rng.choice(["F", "M"], n)),
+            "stp": rng.choice(["STP1", "STP2"], n),
+            "fu": rng.integers(1, 100, n).astype(float),
+            "status": pd.Categorical(rng.choice(["0", "1"], n, p=[0.95, 0.05])),
+        }
+    )
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    input_dir = tmp_path / "processed"
+    input_dir.mkdir()
+    for seed, wave in enumerate(["wave1", "wave2"]):
+        processed_data(seed).to_parquet(input_dir / f"input_{wave}.parquet",
+                                        index=False)
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps(CONFIG))
+    return {
+        "cache_dir": tmp_path / "cache",
+        "output_dir": tmp_path / "tables",
+        "input_dir": input_dir,
+        "config_file": config_file,
+    }
+
+
+def run_poisson(subgroups, dirs):
+    return run("poisson", ["wave1", "wave2"], subgroups, workers=2, **dirs)
+
+
+def read(path):
+    return pd.read_csv(path)
+
+
+def test_task_key():
+    key = task_key("data", "formula", "source", "config")
+    assert key == task_key("data", "formula", "source", "config")
+    for changed in [("DATA", "formula", "source", "config"),
+                    ("data", "FORMULA", "source", "config"),
+                    ("data", "formula", "SOURCE", "config"),
+                    ("data", "formula", "source", "CONFIG")]:
+        assert task_key(*changed) != key
+
+
+def test_config_hash():
+    added = dict(CONFIG, comorbidities=["asthma"])
+    # another subgroup in the lists does not change the hash of a subgroup,
+    # the lists the subgroup is in and the rest of the config do
+    assert config_hash(added, "bmi") == config_hash(CONFIG, "bmi")
+    assert config_hash(added, "asthma") != config_hash(CONFIG, "asthma")
+    moved = dict(CONFIG, demographics=[], comorbidities=["bmi"])
+    assert config_hash(moved, "bmi") != config_hash(CONFIG, "bmi")
+    dates = dict(CONFIG, wave1={"start_date": "2020-03-24",
+                                "end_date": "2020-05-30"})
+    assert config_hash(dates, "bmi") != config_hash(CONFIG, "bmi")
+
+
+def test_run_and_cache(dirs):
+    assert run_poisson(["sex", "bmi"], dirs) == 4
+    result = read(dirs["output_dir"] / "wave1_poisson_rate_ratios.csv")
+    expected = fit_waves(
+        ["wave1"], ["sex", "bmi"], str(dirs["input_dir"] / "input_{wave}.parquet")
+    )
+    # (the results of the subgroups in order, as fitted in one process)
+    pdt.assert_frame_equal(result, expected.astype({"level": object}),
+                           check_dtype=False)
+    # all models from the cache, same results
+    assert run_poisson(["sex", "bmi"], dirs) == 0
+    pdt.assert_frame_equal(
+        read(dirs["output_dir"] / "wave1_poisson_rate_ratios.csv"), result
+    )
+
+
+def test_new_subgroup_fits_only_its_models(dirs):
+    run_poisson(["sex", "bmi"], dirs)
+    dirs["config_file"].write_text(
+        json.dumps(dict(CONFIG, comorbidities=["asthma"]))
+    )
+    # one model per wave for the new subgroup
+    assert run_poisson(["sex", "bmi", "asthma"], dirs) == 2
+    result = read(dirs["output_dir"] / "wave2_poisson_rate_ratios.csv")
+    assert result["subgroup"].tolist() == ["sex", "bmi", "asthma"]
+    assert len(list((dirs["cache_dir"] / "poisson").iterdir())) == 6
+
+
+def test_changed_data_and_config(dirs):
+    run_poisson(["sex", "bmi"], dirs)
+    # new data of a wave: the models of that wave
+    processed_data(seed=5).to_parquet(
+        dirs["input_dir"] / "input_wave2.parquet", index=False
+    )
+    assert run_poisson(["sex", "bmi"], dirs) == 2
+    # new dates of the waves: all models
+    dirs["config_file"].write_text(json.dumps(
+        dict(CONFIG, wave1={"start_date": "2020-03-24", "end_date": "2020-05-30"})
+    ))
+    assert run_poisson(["sex", "bmi"], dirs) == 4
+
+
+def test_cox_reads_the_processed_data_only(dirs):
+    # (waves_model_survival.R reads output/processed, R is not started)
+    with pytest.raises(ValueError):
+        fit_cox("wave1", "bmi", dirs["output_dir"], dirs["input_dir"])
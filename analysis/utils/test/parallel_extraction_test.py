@@ -0,0 +1,93 @@
+# Test for parallel_extraction.py: the study definition is only sharded if
+# the parameter shard_file is set, shards and their merge
+# usage: python -m pytest analysis/utils/test/parallel_extraction_test.py
+import gzip
+import sys
+
+import cohortextractor
+import pandas as pd
+import pytest
+from cohortextractor.cohortextractor import load_study_definition
+
+from parallel_extraction import (
+    SHARD_PARAM,
+    checkpoint_file_name,
+    merge_shards,
+    output_file_name,
+    write_shard_files,
+)
+
+
+@pytest.fixture
+def fresh_study_definition():
+    # (the study definition is imported again with the parameters, as in a
+    # new worker process)
+    module = sys.modules.pop("study_definition", None)
+    yield
+    sys.modules.pop("study_definition", None)
+    if module is not None:
+        sys.modules["study_definition"] = module
+    cohortextractor.params.clear()
+
+
+def test_not_sharded_by_default(fresh_study_definition):
+    study = load_study_definition("study_definition")
+    assert "in_shard" not in study.covariate_definitions
+    assert "unsharded_population" not in study.covariate_definitions
+    _, population = study.covariate_definitions["population"]
+    assert "in_shard" not in str(population["category_definitions"])
+
+
+def test_sharded_with_shard_file(fresh_study_definition, tmp_path):
+    shard_file = tmp_path / "shard_0of2.csv"
+    shard_file.write_text("patient_id\n2\n4\n")
+    study = load_study_definition(
+        "study_definition", params={SHARD_PARAM: str(shard_file)}
+    )
+    _, population = study.covariate_definitions["population"]
+    assert population["category_definitions"] == {
+        1: "unsharded_population AND in_shard", 0: "DEFAULT"
+    }
+    assert {"unsharded_population", "in_shard"} <= set(study.covariate_definitions)
+
+
+def test_write_shard_files(tmp_path):
+    universe_file = tmp_path / "input_ethnicity.csv.gz"
+    pd.DataFrame({"patient_id": range(1, 11), "ethnicity": 1}).to_csv(
+        universe_file, index=False
+    )
+    shard_files = write_shard_files(universe_file, 3, tmp_path / "shards")
+    shards = [pd.read_csv(shard_file)["patient_id"].tolist() for shard_file in shard_files]
+    assert shards == [[3, 6, 9], [1, 4, 7, 10], [2, 5, 8]]
+    # (existing shard files are used again)
+    universe_file.unlink()
+    assert write_shard_files(universe_file, 3, tmp_path / "shards") == shard_files
+
+
+def write_gz(path, text):
+    with gzip.open(path, "wt") as f:
+        f.write(text)
+
+
+def test_merge_shards(tmp_path):
+    shard_files = [
+        checkpoint_file_name(tmp_path, "2020-03-01", shard, 3) for shard in range(3)
+    ]
+    write_gz(shard_files[0], "patient_id,age\n3,40\n6,50\n")
+    # (a shard without patients)
+    write_gz(shard_files[1], "patient_id,age\n")
+    write_gz(shard_files[2], "patient_id,age\n2,60\n")
+    output_file = output_file_name("study_definition", "2020-03-01", tmp_path)
+    merge_shards(shard_files, output_file)
+    assert output_file.name == "input_2020-03-01.csv.gz"
+    with gzip.open(output_file, "rt") as f:
+        # one header, the rows of the shards in order
+        assert f.read() == "patient_id,age\n3,40\n6,50\n2,60\n"
+    # the checkpoints are removed, no temporary file is left
+    assert sorted(path.name for path in tmp_path.iterdir()) == [output_file.name]
+
+
+def test_output_file_name(tmp_path):
+    assert output_file_name("study_definition_ethnicity", "2020-03-01", tmp_path) == (
+        tmp_path / "input_ethnicity_2020-03-01.csv.gz"
+    )
@@ -0,0 +1,145 @@
+# Test for poisson_rates.py: the models recover known rate ratios from
+# synthetic cells and patients, subgroups and levels without covid deaths
+# have no rate ratio
+# usage: python -m pytest analysis/utils/test/poisson_rates_test.py
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from poisson_rates import aggregate_cells, fit_wave, fit_waves, rate_ratios
+
+# rate ratios of the levels of bmi, compared to "Not obese"
+TRUE_RR = {"Not obese": 1.0, "Obese I": 2.0, "Obese II": 0.5}
+AGE_RR = {"40-44 years": 1.0, "60-64 years": 4.0, "80-84 years": 20.0}
+SEX_RR = {"F": 1.0, "M": 1.6}
+STP_RR = {"STP1": 1.0, "STP2": 0.8, "STP3": 1.3}
+# covid deaths per day in the reference cell
+BASELINE = 1e-4
+
+
+def categorical(values, levels):
+    return pd.Categorical(values, categories=list(levels))
+
+
+def expected_cells(rr=TRUE_RR, time=10000.0):
+    """
+    Cells with the expected number of covid deaths as events (no noise)
+    """
+    rows = [
+        (bmi, age, sex, stp,
+         BASELINE * time * rr[bmi] * AGE_RR[age] * SEX_RR[sex] * STP_RR[stp],
+         time)
+        for bmi in rr for age in AGE_RR for sex in SEX_RR for stp in STP_RR
+    ]
+    cells = pd.DataFrame(
+        rows, columns=["bmi", "agegroup_std", "sex", "stp", "events", "time"]
+    )
+    for column, levels in [("bmi", rr), ("agegroup_std", AGE_RR),
+                           ("sex", SEX_RR), ("stp", STP_RR)]:
+        cells[column] = categorical(cells[column], levels)
+    return cells
+
+
+def patients(n=200_000, seed=1):
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame(
+        {
+            "bmi": categorical(rng.choice(list(TRUE_RR), n), TRUE_RR),
+            "agegroup_std": categorical(rng.choice(list(AGE_RR), n), AGE_RR),
+            "sex": categorical(rng.choice(list(SEX_RR), n), SEX_RR),
+            "stp": rng.choice(list(STP_RR), n),
+        }
+    )
+    rate = BASELINE * np.prod(
+        [
+            data[column].map(rr).to_numpy(float)
+            for column, rr in [("bmi", TRUE_RR), ("agegroup_std", AGE_RR),
+                               ("sex", SEX_RR), ("stp", STP_RR)]
+        ],
+        axis=0,
+    )
+    # exponential times of death (constant rate), censored at the end of
+    # the follow-up
+    time_of_death = rng.exponential(1 / rate)
+    end = rng.integers(1, 200, n).astype(float)
+    died = time_of_death < end
+    data["fu"] = np.where(died, time_of_death, end)
+    data["status"] = categorical(np.where(died, "1", "0"), ["0", "1", "2"])
+    return data
+
+
+def test_recovers_rate_ratios_from_expected_cells():
+    result = rate_ratios(expected_cells(), "bmi")
+    assert result["level"].tolist() == ["Obese I", "Obese II"]
+    assert result["converged"].all()
+    np.testing.assert_allclose(result["RR"], [2.0, 0.5], rtol=1e-6)
+    assert (result["LowerCI"] < result["RR"]).all()
+    assert (result["RR"] < result["UpperCI"]).all()
+
+
+def test_recovers_rate_ratios_from_patients():
+    data = patients()
+    result = fit_wave(data, ["bmi"])
+    assert result["converged"].all()
+    for level, rr in [("Obese I", 2.0), ("Obese II", 0.5)]:
+        row = result[result["level"] == level].iloc[0]
+        assert row["LowerCI"] < rr < row["UpperCI"]
+        assert abs(np.log(row["RR"] / rr)) < 0.15
+
+
+def test_aggregate_cells():
+    data = patients(n=1000)
+    data.loc[data.index[:10], "bmi"] = np.nan
+    columns = ["bmi", "agegroup_std", "sex", "stp"]
+    cells = aggregate_cells(data, columns)
+    # (patients with a missing value are left out)
+    complete = data.iloc[10:]
+    assert np.isclose(cells["time"].sum(), complete["fu"].sum())
+    assert cells["events"].sum() == (complete["status"] == "1").sum()
+    assert not cells[columns].duplicated().any()
+
+
+def test_subgroup_without_events():
+    cells = expected_cells()
+    cells["events"] = 0.0
+    result = rate_ratios(cells, "bmi")
+    assert len(result) == 2
+    assert not result["converged"].any()
+    assert result[["RR", "LowerCI", "UpperCI"]].isna().all().all()
+
+
+def test_level_without_events():
+    cells = expected_cells(rr={"Not obese": 1.0, "Obese I": 2.0, "Obese II": 0.0})
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        result = rate_ratios(cells, "bmi")
+    assert result["level"].tolist() == ["Obese I", "Obese II"]
+    assert result["converged"].all()
+    assert np.isclose(result["RR"][0], 2.0)
+    assert result.loc[1, ["RR", "LowerCI", "UpperCI"]].isna().all()
+
+
+def test_reference_level_without_events():
+    cells = expected_cells(rr={"Not obese": 0.0, "Obese I": 2.0, "Obese II": 0.5})
+    result = rate_ratios(cells, "bmi")
+    assert not result["converged"].any()
+    assert result["RR"].isna().all()
+
+
+def test_fit_waves(tmp_path):
+    for seed, wave in enumerate(["wave1", "wave2"]):
+        patients(n=50_000, seed=seed).to_parquet(
+            tmp_path / f"input_{wave}.parquet", index=False
+        )
+    result = fit_waves(
+        ["wave1", "wave2"], ["bmi", "sex"], str(tmp_path / "input_{wave}.parquet")
+    )
+    assert list(result.columns) == [
+        "wave", "subgroup", "level", "RR", "LowerCI", "UpperCI", "converged"
+    ]
+    assert result[["wave", "subgroup", "level"]].values.tolist() == [
+        [wave, subgroup, level]
+        for wave in ["wave1", "wave2"]
+        for subgroup, level in [("bmi", "Obese I"), ("bmi", "Obese II"), ("sex", "M")]
+    ]
@@ -0,0 +1,170 @@
+# Test for redact_rates.py against the rules of the R script it replaced
+# (analysis/utils/redact_rates.R: deaths <= 5 redacted per row for the crude
+# and age rates, per (sex, date, subgroup) summed over age for the others;
+# numbers read as doubles and written by write_csv())
+# usage: python -m pytest analysis/utils/test/redact_rates_test.py
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+import redact_rates
+from measures_cube import DENOMINATOR, NUMERATOR
+from redact_rates import (
+    date_windows,
+    format_numbers,
+    redact_crude_rates,
+    redact_file,
+    redact_rates as redact_all,
+    redact_subgroup_rates,
+    round_counts,
+)
+
+
+def read(path):
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def rates_frame(**columns):
+    return pd.DataFrame(columns).astype(str)
+
+
+def test_format_numbers():
+    values = pd.Series(["1000.0", "3", "0.00125", "", "NA", "2.50", "1e-05"])
+    assert format_numbers(values).tolist() == [
+        "1000", "3", "0.00125", "NA", "NA", "2.5", "1e-05"
+    ]
+    assert format_numbers(pd.Series([2.0, np.nan, 0.1, np.inf])).tolist() == [
+        "2", "NA", "0.1", "Inf"
+    ]
+
+
+def test_crude_redaction():
+    rates = rates_frame(
+        **{
+            NUMERATOR: ["3.0", "5.0", "6.0", ""],
+            DENOMINATOR: ["1000.0", "1000.0", "2000.0", "10.0"],
+            "value": ["0.003", "0.005", "0.003", ""],
+            "date": "2020-03-01",
+        }
+    )
+    redacted = redact_crude_rates(rates)
+    assert redacted[NUMERATOR].tolist() == ["0", "0", "6.0", ""]
+    assert redacted["value"].tolist() == ["0", "0", "0.003", ""]
+
+
+def test_subgroup_redaction():
+    rates = rates_frame(
+        sex=["F", "F", "F", "F", "M", "M"],
+        bmi=["Obese I", "Obese I", "Not obese", "Not obese", "Obese I", "Obese I"],
+        agegroup_std=["18-39", "40-49"] * 3,
+        **{
+            NUMERATOR: ["2.0", "3.0", "3.0", "4.0", "0.0", "5.0"],
+            DENOMINATOR: "100.0",
+            "value": ["0.02", "0.03", "0.03", "0.04", "0.0", "0.05"],
+        },
+        date="2020-03-01",
+    )
+    redacted = redact_subgroup_rates(rates, "bmi")
+    # (F, Obese I): 5 deaths summed over age, (F, Not obese): 7, (M, Obese
+    # I): 5
+    assert redacted[NUMERATOR].tolist() == ["0", "0", "3.0", "4.0", "0", "0"]
+    assert redacted["value"].tolist() == ["0", "0", "0.03", "0.04", "0", "0"]
+
+
+def test_round_counts():
+    rates = rates_frame(
+        **{NUMERATOR: ["12.0", "15.0", "25.0", ""],
+           DENOMINATOR: ["1000.0", "1004.0", "995.0", "10.0"],
+           "value": "0.0"}
+    )
+    rounded = round_counts(rates, 10)
+    # half to even, as round() in R
+    assert format_numbers(rounded[NUMERATOR]).tolist() == ["10", "20", "20", "NA"]
+    assert format_numbers(rounded[DENOMINATOR]).tolist() == [
+        "1000", "1000", "1000", "10"
+    ]
+    assert format_numbers(rounded["value"]).tolist() == ["0.01", "0.02", "0.02", "NA"]
+    assert round_counts(rates, 1) is rates
+
+
+MEASURE = """sex,agegroup_std,died_ons_covid_flag_any,population,value,date
+F,18-39,2.0,1000.0,0.002,2020-03-01
+F,40-49,6.0,1000.0,0.006,2020-03-01
+M,18-39,1.0,1000.0,0.001,2020-03-01
+M,40-49,1.0,1000.0,0.001,2020-03-01
+F,18-39,1000.0,4000.0,0.25,2020-04-01
+F,40-49,,,,2020-04-01
+M,18-39,3.0,3000.0,0.001,2020-04-01
+M,40-49,3.0,3000.0,0.001,2020-04-01
+"""
+
+
+def test_redact_file(tmp_path):
+    (tmp_path / "measure.csv").write_text(MEASURE)
+    redact_file(
+        tmp_path / "measure.csv",
+        tmp_path / "sex_redacted.csv",
+        lambda rates: redact_subgroup_rates(rates, "sex"),
+    )
+    redacted = read(tmp_path / "sex_redacted.csv")
+    assert list(redacted) == list(read(tmp_path / "measure.csv"))
+    assert redacted[NUMERATOR].tolist() == ["2", "6", "0", "0", "1000", "NA", "3", "3"]
+    assert redacted[DENOMINATOR].tolist() == [
+        "1000", "1000", "1000", "1000", "4000", "NA", "3000", "3000"
+    ]
+    assert redacted["value"].tolist() == [
+        "0.002", "0.006", "0", "0", "0.25", "NA", "0.001", "0.001"
+    ]
+
+
+def test_redact_file_in_chunks(tmp_path, monkeypatch):
+    (tmp_path / "measure.csv").write_text(MEASURE)
+    redact_file(tmp_path / "measure.csv", tmp_path / "a.csv", redact_crude_rates)
+    # (chunks smaller than the rows of a date)
+    monkeypatch.setattr(redact_rates, "CHUNK_SIZE", 3)
+    redact_file(tmp_path / "measure.csv", tmp_path / "b.csv", redact_crude_rates)
+    pdt.assert_frame_equal(read(tmp_path / "a.csv"), read(tmp_path / "b.csv"))
+
+
+def test_not_sorted_by_date(tmp_path):
+    lines = MEASURE.splitlines()
+    (tmp_path / "measure.csv").write_text(
+        "\n".join([lines[0], lines[1], lines[5], lines[2]]) + "\n"
+    )
+    with pytest.raises(ValueError):
+        list(date_windows(tmp_path / "measure.csv", chunk_size=2))
+
+
+def test_empty_file(tmp_path):
+    (tmp_path / "measure.csv").write_text(MEASURE.splitlines()[0] + "\n")
+    redact_file(tmp_path / "measure.csv", tmp_path / "out.csv", redact_crude_rates)
+    assert (tmp_path / "out.csv").read_text() == MEASURE.splitlines()[0] + "\n"
+
+
+def test_redact_rates(tmp_path):
+    input_dir = tmp_path / "joined"
+    input_dir.mkdir()
+    (input_dir / "measure_crude_mortality_rate.csv").write_text(
+        "died_ons_covid_flag_any,population,value,date\n4.0,100.0,0.04,2020-03-01\n"
+    )
+    for name in ["age", "sex"]:
+        (input_dir / f"measure_{name}_mortality_rate.csv").write_text(MEASURE)
+    (input_dir / "measure_bmi_mortality_rate.csv").write_text(
+        MEASURE.replace("sex,agegroup_std", "sex,bmi").replace(",18-39,", ",Obese I,")
+        .replace(",40-49,", ",Obese II,")
+    )
+    redact_all(["bmi"], input_dir, tmp_path / "redacted")
+    assert sorted(path.name for path in (tmp_path / "redacted").iterdir()) == [
+        "age_redacted.csv", "bmi_redacted.csv", "crude_redacted.csv",
+        "sex_redacted.csv",
+    ]
+    crude = read(tmp_path / "redacted" / "crude_redacted.csv")
+    assert crude.values.tolist() == [["0", "100", "0", "2020-03-01"]]
+    # age: per row, bmi: per (sex, date, bmi) summed over age
+    age = read(tmp_path / "redacted" / "age_redacted.csv")
+    assert age[NUMERATOR].tolist() == ["0", "6", "0", "0", "1000", "NA", "0", "0"]
+    bmi = read(tmp_path / "redacted" / "bmi_redacted.csv")
+    # (a missing number of deaths counts as 0 in the sum over age: a stratum
+    # is not left unredacted because of a missing value, as sum() in R did)
+    assert bmi[NUMERATOR].tolist() == ["0", "6", "0", "0", "1000", "0", "0", "0"]
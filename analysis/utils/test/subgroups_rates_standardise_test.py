@@ -0,0 +1,157 @@
+# Test for subgroups_rates_standardise.py against the steps of the R script
+# it replaced (subgroups_rates_standardise.R with analysis/utils/dsr.R: join
+# the ESP, M_total per date, sex and level, sum dsr_i and var_dsr_i over age
+# with na.rm = TRUE, groups sorted as by group_by() in R)
+# usage: python -m pytest analysis/utils/test/subgroups_rates_standardise_test.py
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+
+from subgroups_rates_standardise import (
+    ALL_SUBGROUPS_FILE,
+    read_esp,
+    read_rates,
+    standardise,
+    write_output,
+)
+
+AGEGROUPS = ["18-39 years", "40-49 years", "90plus years"]
+ESP = {
+    (agegroup, sex): population
+    for agegroup, population in zip(AGEGROUPS, [20000, 7000, 1000])
+    for sex in ("F", "M")
+}
+
+
+def write_rates(path, subgroup, levels, seed):
+    rng = np.random.default_rng(seed)
+    rows = [
+        (date, sex, level, agegroup)
+        for date in ["2020-03-01", "2020-04-01"]
+        for sex in ["F", "M"]
+        for level in levels
+        for agegroup in AGEGROUPS
+        # (the rates of sex are grouped by sex twice)
+        if subgroup != "sex" or level == sex
+    ]
+    data = pd.DataFrame(rows, columns=["date", "sex", "level", "agegroup_std"])
+    if subgroup == "sex":
+        data = data.drop(columns="level")
+    else:
+        data = data.rename(columns={"level": subgroup})
+    data["population"] = rng.integers(100, 1000, len(data)).astype(str)
+    data["value"] = (rng.integers(0, 20, len(data)) / 1000).astype(str)
+    # (a redacted rate)
+    data.loc[data.index[0], ["population", "value"]] = ""
+    data.to_csv(path / f"{subgroup}_redacted.csv", index=False)
+
+
+def standardise_as_r(data, subgroup, esp):
+    """
+    The steps of subgroups_rates_standardise.R (one subgroup)
+    """
+    data = data.copy()
+    data["level"] = data[subgroup]
+    data["M"] = [esp.get(key, np.nan) for key in zip(data["agegroup_std"], data["sex"])]
+    groups = ["date", "sex", "level"]
+    data["M_total"] = data.groupby(groups, dropna=False)["M"].transform(
+        lambda M: M.sum(skipna=False)
+    )
+    C = 100000 * 30 / pd.to_datetime(data["date"]).dt.days_in_month
+    p = pd.to_numeric(data["value"])
+    N = pd.to_numeric(data["population"])
+    data["dsr_i"] = (C / data["M_total"]) * p * data["M"]
+    data["var_dsr_i"] = (
+        (C ** 2 / data["M_total"] ** 2) * (data["M"] ** 2 / N) * p * (1 - p)
+    )
+    return (
+        data.groupby(groups, dropna=False)[["dsr_i", "var_dsr_i"]]
+        .sum()
+        .reset_index()
+        .rename(columns={"dsr_i": "dsr", "var_dsr_i": "var_dsr"})
+    )
+
+
+def test_same_as_r(tmp_path):
+    subgroups = {"sex": ["F", "M"], "region": ["London", "East"], "imd": [5, 1, 2]}
+    for seed, (subgroup, levels) in enumerate(subgroups.items()):
+        write_rates(tmp_path, subgroup, levels, seed)
+    pattern = str(tmp_path / "{subgroup}_redacted.csv")
+    result = standardise(read_rates(list(subgroups), pattern), ESP)
+    for subgroup in subgroups:
+        data = pd.read_csv(tmp_path / f"{subgroup}_redacted.csv")
+        expected = standardise_as_r(data, subgroup, ESP)
+        actual = result[result["subgroup"] == subgroup].drop(columns="subgroup")
+        # (levels sorted as numbers: 1, 2, 5)
+        actual = actual.astype({"level": type(expected["level"].iloc[0])})
+        pdt.assert_frame_equal(
+            actual[expected.columns].reset_index(drop=True), expected
+        )
+
+
+def test_hand_computed_dsr():
+    rates = pd.DataFrame(
+        {
+            "subgroup": "region",
+            "level": "East",
+            "date": "2020-04-01",
+            "sex": "F",
+            "agegroup_std": ["18-39 years", "40-49 years"],
+            "population": [1000, 500],
+            "value": [0.001, 0.004],
+        }
+    )
+    esp = {("18-39 years", "F"): 3000, ("40-49 years", "F"): 1000}
+    result = standardise(rates, esp)
+    # C = 100000 * 30 / 30 days, M_total = 4000
+    expected_dsr = 100000 / 4000 * (0.001 * 3000 + 0.004 * 1000)
+    expected_var = (100000 ** 2 / 4000 ** 2) * (
+        3000 ** 2 / 1000 * 0.001 * 0.999 + 1000 ** 2 / 500 * 0.004 * 0.996
+    )
+    assert np.isclose(result["dsr"].item(), expected_dsr)
+    assert np.isclose(result["var_dsr"].item(), expected_var)
+
+
+def test_missing_levels_sort_last():
+    rates = pd.DataFrame(
+        {
+            "subgroup": ["imd"] * 4 + ["region"] * 3,
+            "level": ["", "10", "2", "1", "NA", "London", "East"],
+            "date": "2020-04-01",
+            "sex": "F",
+            "agegroup_std": "18-39 years",
+            "population": 100,
+            "value": 0.01,
+        }
+    )
+    result = standardise(rates, ESP)
+    assert result["level"].tolist() == ["1", "2", "10", "", "East", "London", "NA"]
+
+
+def test_output_files(tmp_path):
+    result = pd.DataFrame(
+        {
+            "subgroup": ["sex", "sex", "region"],
+            "level": ["F", "M", "East"],
+            "date": "2020-04-01",
+            "sex": ["F", "M", "F"],
+            "dsr": 1.0,
+            "var_dsr": 0.1,
+        }
+    )
+    write_output(result, tmp_path)
+    files = sorted(path.name for path in tmp_path.iterdir())
+    assert files == sorted([ALL_SUBGROUPS_FILE, "region_std.csv", "sex_std.csv"])
+    # the file of all subgroups is not matched by the pattern of the files of
+    # the subgroups
+    assert not ALL_SUBGROUPS_FILE.endswith("_std.csv")
+    assert list(pd.read_csv(tmp_path / "region_std.csv")) == [
+        "date", "sex", "region", "dsr", "var_dsr"
+    ]
+
+
+def test_read_esp():
+    esp = read_esp()
+    assert ("15-19 years", "M") in esp
+    assert ("0-4 years", "F") not in esp
+    assert {sex for _, sex in esp} == {"F", "M"}
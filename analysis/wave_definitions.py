@@ -0,0 +1,239 @@
+######################################
+
+# This script builds the study definitions of the UK pandemic waves from the
+# wave entries in config.json (keys 'wave1', 'wave2', ...).
+# - wave_study_definition(wave) builds the study definition of one wave
+# - waves_study_definition(waves) builds one study definition extracting all
+#   waves in a single run: variables that do not depend on the start or end
+#   date of a wave are extracted once, variables that do are extracted per
+#   wave with the wave as suffix (e.g. 'age_wave1', 'creatinine_wave1_date').
+#   The chain of vaccination dates is extracted once, up to the end of the
+#   last wave. The extract is split in one file per wave by
+#   analysis/split_waves.py
+
+######################################
+
+# IMPORT STATEMENTS ----
+# Import code building blocks from cohort extractor package
+from cohortextractor import (
+    StudyDefinition,
+    patients,
+)
+
+from dict_demographic_vars import demographic_variables
+
+from dict_comorbidity_vars import comorbidity_variables
+
+from dict_outcome_vars import covid_vax_dates, outcome_variables
+
+from definition_utils import (
+    index_date_dependent_columns,
+    make_renamer,
+    rewrite_definition,
+)
+
+from dependency_graph import eliminate_dead_variables
+
+from config import load_config
+
+# Import config variables (start_date and end_date of the waves)
+config = load_config()
+
+waves = tuple(config.waves)
+
+
+# DEFINE STUDY POPULATION ----
+# IN AND EXCLUSION CRITERIA
+# (= > 1 year follow up, aged > 18 and no missings in age and sex)
+# missings in age are the ones > 110
+# missings in sex can be sex = U or sex = I (so filter on M and F)
+def population_variable():
+    return patients.satisfying(
+        """
+        NOT died AND
+        (age >=18 AND age <= 110) AND
+        (sex = "M" OR sex = "F") AND
+        NOT stp = "" AND
+        index_of_multiple_deprivation != -1
+        """,
+        died=patients.died_from_any_cause(
+            on_or_before="index_date",
+            returning="binary_flag",
+            return_expectations={"incidence": 0.01},
+        ),
+    )
+
+
+def default_expectations(end_date):
+    return {
+        "date": {"earliest": "1900-01-01", "latest": end_date},
+        "rate": "uniform",
+        "incidence": 0.95,
+    }
+
+
+def wave_variables(wave):
+    """
+    Variables of one wave (demographics, comorbidities and outcomes)
+    """
+    return {
+        # DEMOGRAPHICS
+        **demographic_variables,
+        # COMORBIDITIES
+        **comorbidity_variables,
+        # OUTCOMES (depend on end_date of wave)
+        **outcome_variables(config.wave_dates(wave)[1]),
+    }
+
+
+def wave_study_definition(wave):
+    """
+    Study definition of one wave (e.g. wave = 'wave1')
+    """
+    start_date, end_date = config.wave_dates(wave)
+    return StudyDefinition(
+        # Configure the expectations framework
+        default_expectations=default_expectations(end_date),
+        # Set index date to start date
+        index_date=start_date,
+        # Define the study population
+        population=population_variable(),
+        **wave_variables(wave),
+    )
+
+
+# ALL WAVES IN ONE EXTRACTION ----
+def drop_defined_columns(definition, defined):
+    """
+    Remove hidden variables that are already defined from a (nested)
+    definition, and add the names of all variables in it to defined
+    """
+    query_type, query_args = definition
+    if "extra_columns" in query_args:
+        extra_columns = {}
+        for name, extra_definition in query_args["extra_columns"].items():
+            if name in defined:
+                continue
+            extra_columns[name] = drop_defined_columns(extra_definition, defined)
+            defined.add(name)
+        query_args = dict(query_args, extra_columns=extra_columns)
+    return query_type, query_args
+
+
+def waves_variables(waves, variables=wave_variables, population=population_variable):
+    """
+    Variables of all waves in waves: wave independent variables are defined
+    once (without suffix), the other variables once per wave with suffix
+    '_<wave>'. Population of each wave is in 'population_<wave>'.
+    variables(wave) returns the variables of a wave, population() the
+    population variable.
+    The chain of vaccination dates is defined once, up to the end date of the
+    last wave (split_waves.py removes the dates after the end of a wave).
+    """
+    result = {}
+    defined = set()
+    start_date, end_date = config.wave_dates(waves[-1])
+    for name, definition in variables(waves[-1]).items():
+        if name in covid_vax_dates:
+            result[name] = rewrite_definition(definition, None, start_date)
+            defined.add(name)
+    for wave in waves:
+        start_date, end_date = config.wave_dates(wave)
+        # (population last, as it refers to the other variables)
+        definitions = {
+            **variables(wave),
+            "population": population(),
+        }
+        dependent = index_date_dependent_columns(
+            definitions,
+            date_dependent=outcome_variables(end_date).keys() - set(covid_vax_dates),
+        )
+        # population is always specific to a wave
+        dependent.add("population")
+        rename = make_renamer({name: f"{name}_{wave}" for name in dependent})
+        for name, definition in definitions.items():
+            new_name = rename(name)
+            if new_name in defined:
+                continue
+            definition = rewrite_definition(definition, rename, start_date)
+            result[new_name] = drop_defined_columns(definition, defined)
+            defined.add(new_name)
+    return result
+
+
+def waves_study_definition(waves=waves):
+    """
+    Study definition extracting all waves in waves in one run; the
+    population is everyone that is in the population of at least one wave.
+    Hidden variables that no column needs are not extracted (see
+    dependency_graph.py)
+    """
+    return StudyDefinition(
+        # Configure the expectations framework
+        default_expectations=default_expectations(config.wave_dates(waves[-1])[1]),
+        # Set index date to start date of first wave (all date expressions
+        # are evaluated per wave in waves_variables())
+        index_date=config.wave_dates(waves[0])[0],
+        population=patients.satisfying(
+            " OR ".join(f"population_{wave}" for wave in waves)
+        ),
+        **eliminate_dead_variables(waves_variables(waves)),
+    )
+
+
+# FLOWCHART ----
+# The flowchart extract is the broader extract (registered and alive at the
+# start of a wave) without the other exclusion criteria, see
+# analysis/flowchart.R
+def flowchart_population_variable():
+    return patients.satisfying(
+        """
+        NOT died
+        """,
+        died=patients.died_from_any_cause(
+            on_or_before="index_date",
+            returning="binary_flag",
+            return_expectations={"incidence": 0.01},
+        ),
+    )
+
+
+def flowchart_variables(wave):
+    """
+    Variables of the flowchart of one wave
+    """
+    return {
+        # follow up
+        "has_follow_up": patients.registered_with_one_practice_between(
+            "index_date - 3 months", "index_date"
+        ),
+        "age": demographic_variables["age"],
+        "sex": demographic_variables["sex"],
+        "stp": demographic_variables["stp"],
+        "index_of_multiple_deprivation": demographic_variables[
+            "index_of_multiple_deprivation"
+        ],
+    }
+
+
+def flowchart_study_definition(waves=waves):
+    """
+    Study definition extracting the flowchart variables of all waves in
+    waves in one run (split in one file per wave by split_waves.py)
+    """
+    return StudyDefinition(
+        # Configure the expectations framework
+        default_expectations=default_expectations(config.wave_dates(waves[-1])[1]),
+        # Set index date to start date of first wave
+        index_date=config.wave_dates(waves[0])[0],
+        population=patients.satisfying(
+            " OR ".join(f"population_{wave}" for wave in waves)
+        ),
+        **eliminate_dead_variables(
+            waves_variables(
+                waves,
+                variables=flowchart_variables,
+                population=flowchart_population_variable,
+            )
+        ),
+    )